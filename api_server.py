@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Generator, List
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from infini_websearch.configs import MODEL_NAME
+from infini_websearch.model import load_tokenizer
+from infini_websearch.model.inference import get_stream_stats
+from infini_websearch.utils import CancellationToken, StageTimer
+from infini_websearch.utils.cancellation import (
+    cancel_on_disconnect,
+    get_avoided_work,
+    stream_until_disconnected,
+)
+from infini_websearch.utils.session_store import new_session
+from infini_websearch.workflow import MARKDOWN_CITATION_TEMPLATE, AgentWorkflow
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model-path", "-m", type=str)
+parser.add_argument("--port", type=int, default=8031)
+
+args = parser.parse_args()
+
+# tokenizer
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+TOKENIZER = load_tokenizer(args.model_path)
+
+# the agent loop, shared with the gradio app
+AGENT_WORKFLOW = AgentWorkflow(tokenizer=TOKENIZER)
+
+# roles of the conversation kept in the session, the system prompt is built
+# by the workflow
+SESSION_ROLES = ["user", "assistant", "observation"]
+
+app = FastAPI()
+
+
+def make_session(messages: List[Dict]) -> Dict:
+    """
+    Requests are stateless, the session is rebuilt from the request messages.
+    """
+    session = new_session()
+    session["messages"] = [
+        {"role": message["role"], "content": message["content"]}
+        for message in messages
+        if message.get("role") in SESSION_ROLES
+    ]
+    return session
+
+
+def make_chunk(completion_id: str, created: int, delta: Dict, **kwargs) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": MODEL_NAME,
+        "choices": [
+            {"index": 0, "delta": delta, "finish_reason": kwargs.pop("finish_reason")}
+        ],
+        **kwargs,
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def run_workflow(
+    session: Dict,
+    websearch: bool,
+    stage_timer: StageTimer,
+    traces: List[Dict],
+    cancel_token: CancellationToken,
+) -> Generator[str, None, None]:
+    """
+    Text deltas of the agent loop, search results are returned as citations
+    and the search budget traces in the metadata.
+    """
+    for event in AGENT_WORKFLOW.run(
+        session,
+        websearch,
+        stage_timer=stage_timer,
+        citation_template=MARKDOWN_CITATION_TEMPLATE,
+        cancel_token=cancel_token,
+    ):
+        if event["type"] == "text":
+            yield event["content"]
+        elif event["type"] == "observation" and event.get("trace") is not None:
+            traces.append(event["trace"])
+
+
+def get_metadata(session: Dict, stage_timer: StageTimer, traces: List[Dict]) -> Dict:
+    return {
+        "timings": stage_timer.summary(),
+        "citations": session["url_infos"],
+        "search_traces": traces,
+    }
+
+
+@app.on_event("startup")
+def start_warm_up():
+    threading.Thread(target=AGENT_WORKFLOW.warm_up, daemon=True).start()
+
+
+@app.get("/cancellation_stats")
+async def get_cancellation_stats():
+    return get_avoided_work()
+
+
+@app.get("/stream_stats")
+async def get_model_stream_stats():
+    return get_stream_stats()
+
+
+@app.get("/search_replicas")
+async def get_search_replicas():
+    return AGENT_WORKFLOW.actions_map["googleWebSearch"].load_balancer.stats()
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    data = await request.json()
+    messages = data.get("messages")
+    if not isinstance(messages, list) or len(messages) == 0:
+        raise HTTPException(status_code=400, detail="messages is required")
+    if messages[-1].get("role") != "user":
+        raise HTTPException(status_code=400, detail="the last message must be a user")
+    session = make_session(messages)
+    websearch = bool(data.get("websearch", True))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    stage_timer = StageTimer()
+    traces = []
+    # cancelled when the client disconnects, aborts the model and search requests
+    cancel_token = CancellationToken()
+
+    if data.get("stream", False) is True:
+
+        def sse_generator():
+            yield make_chunk(
+                completion_id, created, {"role": "assistant"}, finish_reason=None
+            )
+            for content in run_workflow(
+                session, websearch, stage_timer, traces, cancel_token
+            ):
+                yield make_chunk(
+                    completion_id, created, {"content": content}, finish_reason=None
+                )
+            yield make_chunk(
+                completion_id,
+                created,
+                {},
+                finish_reason="stop",
+                metadata=get_metadata(session, stage_timer, traces),
+            )
+            yield "data: [DONE]\n\n"
+
+        # the generator is blocking, it is iterated in a thread pool
+        return StreamingResponse(
+            stream_until_disconnected(request, sse_generator(), cancel_token),
+            media_type="text/event-stream",
+        )
+
+    def get_answer() -> str:
+        return "".join(
+            run_workflow(session, websearch, stage_timer, traces, cancel_token)
+        )
+
+    watcher = asyncio.create_task(cancel_on_disconnect(request, cancel_token))
+    try:
+        answer = await run_in_threadpool(get_answer)
+    finally:
+        watcher.cancel()
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": MODEL_NAME,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop",
+            }
+        ],
+        "metadata": get_metadata(session, stage_timer, traces),
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Set
+
+from infini_websearch.model import load_tokenizer
+from infini_websearch.utils import CancellationToken, StageTimer
+from infini_websearch.utils.cancellation import RequestCancelled
+from infini_websearch.utils.session_store import new_session
+from infini_websearch.workflow import MARKDOWN_CITATION_TEMPLATE, AgentWorkflow
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model-path", "-m", type=str)
+parser.add_argument(
+    "--input", type=str, required=True, help='jsonl, one {"question": ...} per line'
+)
+parser.add_argument("--output", type=str, required=True)
+parser.add_argument("--workers", type=int, default=16, help="questions in flight")
+parser.add_argument("--model-concurrency", type=int, default=8)
+parser.add_argument("--search-concurrency", type=int, default=4)
+parser.add_argument("--summarize-concurrency", type=int, default=4)
+parser.add_argument("--no-websearch", action="store_true")
+
+
+class BoundedStageTimer(StageTimer):
+    """
+    Stage timer bounding the number of requests in each stage, the time spent
+    waiting for a stage is recorded as <stage>_wait.
+    """
+
+    def __init__(self, semaphores: Dict[str, threading.Semaphore]) -> None:
+        super().__init__()
+        self.semaphores = semaphores
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        semaphore = self.semaphores.get(name)
+        if semaphore is None:
+            with super().stage(name):
+                yield
+            return
+        start = time.time()
+        with semaphore:
+            self.record(f"{name}_wait", time.time() - start)
+            with super().stage(name):
+                yield
+
+
+def load_questions(path: str) -> List[Dict]:
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            question = json.loads(line)
+            question.setdefault("id", i)
+            questions.append(question)
+    return questions
+
+
+def load_finished_ids(path: str) -> Set:
+    """
+    Ids of the questions answered by a previous run, failed ones are retried.
+    """
+    finished_ids = set()
+    if not os.path.exists(path):
+        return finished_ids
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run
+                continue
+            if result.get("error") is None:
+                finished_ids.add(result["id"])
+    return finished_ids
+
+
+def answer_question(
+    agent_workflow: AgentWorkflow,
+    question: Dict,
+    websearch: bool,
+    semaphores: Dict[str, threading.Semaphore],
+    cancel_token: CancellationToken,
+) -> Dict:
+    session = new_session()
+    session["messages"].append({"role": "user", "content": question["question"]})
+    stage_timer = BoundedStageTimer(semaphores)
+    result = {"id": question["id"], "question": question["question"]}
+    answer, traces = "", []
+    try:
+        for event in agent_workflow.run(
+            session,
+            websearch,
+            stage_timer=stage_timer,
+            citation_template=MARKDOWN_CITATION_TEMPLATE,
+            cancel_token=cancel_token,
+        ):
+            if event["type"] == "text":
+                answer += event["content"]
+            elif event["type"] == "observation" and event.get("trace") is not None:
+                traces.append(event["trace"])
+        if cancel_token.cancelled:
+            # a partial answer, retried by the next run
+            raise RequestCancelled("cancelled")
+        result.update(answer=answer, citations=session["url_infos"], error=None)
+    except Exception as e:
+        print(f"问题 {question['id']} 失败: {e}")
+        result.update(answer=None, citations=[], error=str(e))
+    result["search_traces"] = traces
+    result["timings"] = stage_timer.summary()
+    return result
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def print_summary(results: List[Dict], elapsed: float) -> None:
+    num_failed = len([result for result in results if result["error"] is not None])
+    print(f"完成 {len(results)} 个问题, 失败 {num_failed} 个, 耗时 {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"吞吐: {len(results) / elapsed:.2f} questions/s")
+    stages = sorted({stage for result in results for stage in result["timings"]})
+    print(f"{'stage':<24}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}")
+    for stage in stages:
+        values = [
+            result["timings"][stage] for result in results if stage in result["timings"]
+        ]
+        print(
+            f"{stage:<24}{sum(values) / len(values):>10.3f}"
+            f"{percentile(values, 0.5):>10.3f}{percentile(values, 0.95):>10.3f}"
+            f"{max(values):>10.3f}"
+        )
+
+
+def main() -> None:
+    args = parser.parse_args()
+
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    tokenizer = load_tokenizer(args.model_path)
+    agent_workflow = AgentWorkflow(tokenizer=tokenizer)
+    semaphores = {
+        "model": threading.Semaphore(args.model_concurrency),
+        "search": threading.Semaphore(args.search_concurrency),
+        "summarize": threading.Semaphore(args.summarize_concurrency),
+    }
+    # cancelled on interrupt, the questions in flight end without waiting for
+    # their model and search requests
+    cancel_token = CancellationToken()
+
+    questions = load_questions(args.input)
+    finished_ids = load_finished_ids(args.output)
+    questions = [
+        question for question in questions if question["id"] not in finished_ids
+    ]
+    print(f"跳过已完成的 {len(finished_ids)} 个问题, 剩余 {len(questions)} 个")
+
+    # an interrupted run may have left a partial last line
+    if os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+        with open(args.output, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    results = []
+    start = time.time()
+    # results are appended as they finish, the output file is the checkpoint
+    with open(args.output, "a", encoding="utf-8") as f, ThreadPoolExecutor(
+        max_workers=args.workers
+    ) as executor:
+        futures = [
+            executor.submit(
+                answer_question,
+                agent_workflow,
+                question,
+                not args.no_websearch,
+                semaphores,
+                cancel_token,
+            )
+            for question in questions
+        ]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+                f.flush()
+                results.append(result)
+        except KeyboardInterrupt:
+            print("中断, 已完成的结果已保存, 重新运行即可继续")
+            for future in futures:
+                future.cancel()
+            cancel_token.cancel()
+    print_summary(results, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
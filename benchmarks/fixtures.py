@@ -0,0 +1,192 @@
+"""
+Deterministic fixtures of the microbenchmarks: long multi-turn sessions, large
+web pages, long streamed answers, search service streams and a tokenizer built
+locally, so the benchmarks run offline.
+"""
+
+import json
+import os
+import random
+from typing import Dict, List, Optional
+
+from infini_websearch.configs import FUNCTION_END_TOKEN, FUNCTION_START_TOKEN
+from infini_websearch.service.page_chunks import make_page_records
+
+ENGLISH_WORDS = (
+    "the search engine returns pages about weather exchange rate current events "
+    "model inference latency python server browser query answer citation summary "
+    "market price report government policy season football match result forecast"
+).split()
+# common CJK ideographs
+CHINESE_CHARS = [chr(code) for code in range(0x4E00, 0x4E00 + 1500)]
+
+SPECIAL_TOKENS = [
+    "<|role_start|>",
+    "<|role_end|>",
+    "<|turn_end|>",
+    FUNCTION_START_TOKEN,
+    FUNCTION_END_TOKEN,
+]
+# same layout as the megrez chat template
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|role_start|>{{ message['role'] }}<|role_end|>{{ message['content'] }}<|turn_end|>"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|role_start|>assistant<|role_end|>{% endif %}"
+)
+
+
+def make_text(rng: random.Random, num_chars: int) -> str:
+    """
+    Mixed Chinese and English text with sentence punctuation.
+    """
+    parts = []
+    length = 0
+    while length < num_chars:
+        if rng.random() < 0.6:
+            part = "".join(rng.choices(CHINESE_CHARS, k=rng.randint(8, 30))) + "。"
+        else:
+            part = " ".join(rng.choices(ENGLISH_WORDS, k=rng.randint(5, 15))) + ". "
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:num_chars]
+
+
+def make_page(rng: random.Random, num_bytes: int = 200 * 1024) -> str:
+    """
+    innerText of a web page of about num_bytes (utf-8).
+    """
+    lines = []
+    size = 0
+    while size < num_bytes:
+        line = make_text(rng, rng.randint(20, 400))
+        lines.append(line)
+        size += len(line.encode("utf-8")) + 1
+    return "\n".join(lines)
+
+
+def make_answer(rng: random.Random, num_chars: int, num_citations: int = 5) -> str:
+    """
+    Model answer with a [citation:x] after most sentences.
+    """
+    sentences = []
+    length = 0
+    while length < num_chars:
+        sentence = make_text(rng, rng.randint(30, 120))
+        for _ in range(rng.randint(0, 2)):
+            sentence += f"[citation:{rng.randint(1, num_citations)}]"
+        sentences.append(sentence)
+        length += len(sentence)
+    return "".join(sentences)
+
+
+def make_function_call(query: str) -> str:
+    arguments = {"name": "googleWebSearch", "arguments": {"query": query}}
+    return (
+        f"{FUNCTION_START_TOKEN}{json.dumps(arguments, ensure_ascii=False)}"
+        f"{FUNCTION_END_TOKEN}"
+    )
+
+
+def make_session_messages(
+    rng: random.Random, num_turns: int = 30, observation_chars: int = 3000
+) -> List[Dict]:
+    """
+    Search turns: question, function call, observation of cited summaries, answer.
+    """
+    messages = []
+    for _ in range(num_turns):
+        question = make_text(rng, 40)
+        observation = "\n\n".join(
+            f"[[citation:{i + 1}]]\n{make_text(rng, observation_chars // 5)}"
+            for i in range(5)
+        )
+        messages.extend(
+            [
+                {"role": "user", "content": question},
+                {"role": "assistant", "content": make_function_call(question)},
+                {"role": "observation", "content": observation},
+                {"role": "assistant", "content": make_answer(rng, 1500)},
+            ]
+        )
+    return messages
+
+
+def split_stream(text: str, rng: random.Random, buffer_size: int = 20) -> List[str]:
+    """
+    Split an answer into streamed deltas of a few characters, grouped into
+    yields of about buffer_size characters not splitting a citation.
+    """
+    chunks = []
+    buffer = ""
+    position = 0
+    while position < len(text):
+        step = rng.randint(1, 6)
+        buffer += text[position : position + step]  # noqa: E203
+        position += step
+        if len(buffer) >= buffer_size:
+            if buffer.rfind("]") < buffer.rfind("["):
+                chunks.append(buffer[: buffer.rfind("[")])
+                buffer = buffer[buffer.rfind("[") :]  # noqa: E203
+            else:
+                chunks.append(buffer)
+                buffer = ""
+    if buffer:
+        chunks.append(buffer)
+    return chunks
+
+
+def make_search_stream(
+    rng: random.Random,
+    query: str,
+    pages: List[str],
+    chunk_bytes: Optional[int] = None,
+) -> bytes:
+    """
+    NDJSON body of a /search response with the given pages, in chunk records of
+    chunk_bytes if given.
+    """
+    organic = [
+        {"title": make_text(rng, 20), "link": f"https://example.com/{i}"}
+        for i in range(len(pages))
+    ]
+    response = {"searchParameters": {"q": query}, "organic": organic}
+    lines = []
+    for url_info, page in zip(organic, pages):
+        record = {
+            "search_status_code": 200,
+            "search_response": response,
+            "url_info": url_info,
+            "partial": False,
+            "source": "live",
+            "snippet_answer": None,
+        }
+        lines.extend(make_page_records(record, page, chunk_bytes))
+    return "".join(lines).encode("utf-8")
+
+
+def build_tokenizer(path: str, vocab_size: int = 8000) -> str:
+    """
+    Train a byte-level BPE tokenizer on fixture text and save it with a chat
+    template, it is loaded by load_tokenizer like a model directory.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    rng = random.Random(0)
+    corpus = [make_text(rng, 2000) for _ in range(200)]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(corpus, trainer=trainer)
+    os.makedirs(path, exist_ok=True)
+    tokenizer.save(os.path.join(path, "tokenizer.json"))
+    config = {"eos_token": "<|turn_end|>", "chat_template": CHAT_TEMPLATE}
+    with open(os.path.join(path, "tokenizer_config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+    return path
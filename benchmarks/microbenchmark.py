@@ -0,0 +1,194 @@
+"""
+Microbenchmarks of the pure-Python hot paths run per chunk or per turn, on
+fixtures of realistic size and a tokenizer built locally (see fixtures.py),
+so they run offline. Run them from the repository root, with it on the path:
+
+    PYTHONPATH=. python benchmarks/microbenchmark.py [--case truncate_messages ...]
+    PYTHONPATH=. python benchmarks/microbenchmark.py --update-baseline
+
+Times are the best of --repeat runs per call. Exits with status 1 if a case is
+slower than the baseline by more than --tolerance (relative). Baselines are
+machine specific, update them on the machine the benchmarks run on.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+from typing import Callable, Dict
+from unittest import mock
+
+import requests
+from fixtures import (
+    build_tokenizer,
+    make_answer,
+    make_function_call,
+    make_page,
+    make_search_stream,
+    make_session_messages,
+    split_stream,
+)
+
+from infini_websearch.actions.action_utils import parse_function_call_from_model_ouput
+from infini_websearch.actions.websearch import GoogleSearch
+from infini_websearch.configs import (
+    FUNCTION_END_TOKEN,
+    FUNCTION_START_TOKEN,
+    SESSION_MAX_INPUT_TOKENS,
+    SESSION_WINDOW_SIZE,
+    SUMMARY_PROMPT_TEMPLATE,
+    WEBPAGE_MAX_CHARS,
+    WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
+)
+from infini_websearch.model import load_tokenizer
+from infini_websearch.utils import extract_citations
+from infini_websearch.workflow import (
+    MARKDOWN_CITATION_TEMPLATE,
+    get_system_prompt,
+    render_citations,
+    truncate_messages,
+)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "microbenchmark_baseline.json")
+
+NUM_PAGES = 5
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--case", type=str, nargs="*", default=None)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--tolerance", type=float, default=0.3)
+parser.add_argument("--update-baseline", action="store_true")
+
+
+def fake_search_post(body: bytes) -> Callable:
+    """
+    requests.Session.post answering with a streamed NDJSON body from memory.
+    """
+
+    def post(session: requests.Session, url: str, **kwargs) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(body)
+        return response
+
+    return post
+
+
+def get_cases(tokenizer) -> Dict[str, Callable[[], object]]:
+    rng = random.Random(0)
+    messages = make_session_messages(rng)
+    system_prompt = get_system_prompt()
+    pages = [make_page(rng) for _ in range(NUM_PAGES)]
+    answer = make_answer(rng, 8000, num_citations=NUM_PAGES)
+    chunks = split_stream(answer, rng)
+    url_infos = [{"link": f"https://example.com/{i}"} for i in range(NUM_PAGES)]
+    model_output = make_answer(rng, 1500) + "".join(
+        make_function_call(query) for query in ["天气", "汇率", "新闻"]
+    )
+    special_tokens_map = dict(
+        function_start_token=FUNCTION_START_TOKEN,
+        function_end_token=FUNCTION_END_TOKEN,
+    )
+    search_stream = make_search_stream(rng, "query", pages)
+    # pages cut to the client budget by the search service, sent in chunks
+    chunked_search_stream = make_search_stream(
+        rng, "query", [page[:WEBPAGE_MAX_CHARS] for page in pages], chunk_bytes=8192
+    )
+
+    def render_streamed_citations() -> None:
+        for chunk in chunks:
+            render_citations(chunk, url_infos, MARKDOWN_CITATION_TEMPLATE)
+
+    def decode_search_stream(body: bytes, content: Dict) -> Callable[[], None]:
+        def decode() -> None:
+            with mock.patch.object(requests.Session, "post", fake_search_post(body)):
+                for _ in GoogleSearch.streaming_fetch_search_results(
+                    "http://localhost/search", content, {}
+                ):
+                    pass
+
+        return decode
+
+    return {
+        "truncate_messages": lambda: truncate_messages(
+            messages,
+            tokenizer,
+            SESSION_WINDOW_SIZE,
+            SESSION_MAX_INPUT_TOKENS,
+            system_prompt,
+        ),
+        # a long window tokenizes the prompt once per kept turn
+        "truncate_messages_window_30": lambda: truncate_messages(
+            messages, tokenizer, 30, 32768, system_prompt
+        ),
+        "make_summary_tasks": lambda: GoogleSearch.make_summary_tasks(
+            "query",
+            pages,
+            SUMMARY_PROMPT_TEMPLATE,
+            tokenizer,
+            WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
+        ),
+        "parse_function_call": lambda: parse_function_call_from_model_ouput(
+            model_output, ["googleWebSearch"], special_tokens_map
+        ),
+        "extract_citations": lambda: extract_citations(answer),
+        "render_streamed_citations": render_streamed_citations,
+        "decode_search_stream": decode_search_stream(search_stream, {"query": "query"}),
+        "decode_chunked_search_stream": decode_search_stream(
+            chunked_search_stream,
+            {"query": "query", "page_max_chars": WEBPAGE_MAX_CHARS},
+        ),
+    }
+
+
+def time_case(function: Callable[[], object], repeat: int) -> float:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main() -> None:
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tokenizer_path:
+        tokenizer = load_tokenizer(build_tokenizer(tokenizer_path))
+    cases = get_cases(tokenizer)
+    if args.case:
+        cases = {name: cases[name] for name in args.case}
+
+    results = {}
+    for name, function in cases.items():
+        results[name] = float(f"{time_case(function, args.repeat):.3g}")
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r") as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print(f"{'case':<30}{'time (ms)':>12}{'baseline (ms)':>15}")
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        print(
+            f"{name:<30}{seconds * 1000:>12.3f}"
+            f"{reference * 1000 if reference is not None else float('nan'):>15.3f}"
+        )
+        if reference is not None and seconds > reference * (1 + args.tolerance):
+            regressions.append(name)
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({**baseline, **results}, f, indent=4)
+            f.write("\n")
+        print(f"baseline saved to {BASELINE_PATH}")
+    elif len(regressions) > 0:
+        print(f"regressions: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
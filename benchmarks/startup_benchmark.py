@@ -0,0 +1,107 @@
+"""
+Cold start benchmark: time to import the workflow and the search service, and
+to load the tokenizer, each in a fresh interpreter.
+
+    python benchmarks/startup_benchmark.py [-m $MODEL_PATH]
+    python benchmarks/startup_benchmark.py [-m $MODEL_PATH] --update-baseline
+
+Exits with status 1 if a median is slower than the baseline by more than
+--tolerance (relative) and --min-regression (seconds).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "startup_baseline.json")
+
+TIMED_SNIPPET = """
+import time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model-path", "-m", type=str, default=None)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--tolerance", type=float, default=0.5)
+# sub-second imports are noisy, ignore differences smaller than this
+parser.add_argument("--min-regression", type=float, default=0.1)
+parser.add_argument("--update-baseline", action="store_true")
+
+
+def get_cases(model_path: Optional[str]) -> Dict[str, str]:
+    cases = {
+        "import_workflow": "import infini_websearch.workflow",
+        "import_search_service": "import search_service",
+    }
+    if model_path is not None:
+        cases["load_tokenizer"] = (
+            "from infini_websearch.model import load_tokenizer\n"
+            f"load_tokenizer({model_path!r})"
+        )
+    return cases
+
+
+def time_case(code: str, repeat: int) -> List[float]:
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(
+            [REPO_ROOT, os.path.join(REPO_ROOT, "infini_websearch", "service")]
+        ),
+    }
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", TIMED_SNIPPET.format(code=code)],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+def main() -> None:
+    args = parser.parse_args()
+    results = {}
+    for name, code in get_cases(args.model_path).items():
+        results[name] = round(statistics.median(time_case(code, args.repeat)), 3)
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r") as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print(f"{'case':<24}{'median (s)':>12}{'baseline (s)':>14}")
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        print(
+            f"{name:<24}{seconds:>12.3f}"
+            f"{reference if reference is not None else float('nan'):>14.3f}"
+        )
+        if reference is not None and seconds > max(
+            reference * (1 + args.tolerance), reference + args.min_regression
+        ):
+            regressions.append(name)
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({**baseline, **results}, f, indent=4)
+            f.write("\n")
+        print(f"baseline saved to {BASELINE_PATH}")
+    elif len(regressions) > 0:
+        print(f"startup regressions: {regressions}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
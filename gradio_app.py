@@ -1,49 +1,34 @@
 import argparse
 import os
-from typing import Dict, Generator, List, Optional, Tuple
+import threading
+from typing import Dict, Generator, List, Tuple
 
 import gradio as gr
 from gradio_toggle import Toggle
-from transformers import AutoTokenizer
 
-from infini_websearch.actions import GoogleSearch, parse_function_call_from_model_ouput
 from infini_websearch.configs import (
-    AGENT_MAX_OUTPUT_TOKENS,
-    AGENT_TEMPERATURE,
-    CHAT_MAX_OUTPUT_TOKENS,
-    CHAT_TEMPERATURE,
+    BOT_CONCURRENCY_LIMIT,
     CSS_STYLE,
-    FUNCTION_CALLING_PROMPT_TEMPLATE,
-    FUNCTION_END_TOKEN,
-    FUNCTION_START_TOKEN,
-    MAX_ACTION_TURNS,
-    MODEL_NAME,
-    MODEL_SERVER_URL,
-    NUM_SEARCH_WEBPAGES,
-    OBSERVATION_PROMPT_TEMPLATE,
-    PROXIES,
-    ROLE_PROMPT,
-    SEARCH_SERVER_URL,
-    SESSION_MAX_INPUT_TOKENS,
+    MODEL_TARGET_LATENCY,
+    SCHEDULER_CHAT_SLOTS,
+    SCHEDULER_SEARCH_SLOTS,
+    SEARCH_MAX_QUEUE_DEPTH,
+    SESSION_IDLE_SECONDS,
+    SESSION_MAX_BYTES,
+    SESSION_MAX_IN_MEMORY,
+    SESSION_SPILL_DIR,
     SESSION_WINDOW_SIZE,
-    STOP_TOKENS,
-    SUMMARY_PROMPT_TEMPLATE,
-    TIME_PROMPT_TEMPLATE,
-    WEBPAGE_LOAD_TIMETOUT,
-    WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
-    WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS,
-)
-from infini_websearch.model import (
-    get_vllm_model_output_function,
-    include_special_tokens,
-    split_text_by_special_token,
 )
+from infini_websearch.model import load_tokenizer
+from infini_websearch.model.inference import get_stream_stats
 from infini_websearch.utils import (
-    extract_citations,
+    AdmissionScheduler,
+    CancellationToken,
+    SessionStore,
     format_search_results,
-    functions2str,
-    get_datetime_now,
 )
+from infini_websearch.utils.cancellation import get_avoided_work
+from infini_websearch.workflow import AgentWorkflow
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--model-path", "-m", type=str)
@@ -56,41 +41,32 @@ SERVER_PORT = args.port
 
 # tokenizer
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-
-
-# function name -> action
-ACTIONS_MAP = {
-    "googleWebSearch": GoogleSearch(
-        server_url=SEARCH_SERVER_URL,
-        num_search_webpages=NUM_SEARCH_WEBPAGES,
-        summary_prompt_template=SUMMARY_PROMPT_TEMPLATE,
-        observation_prompt_template=OBSERVATION_PROMPT_TEMPLATE,
-        webpage_summary_max_input_tokens=WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
-        webpage_load_timetout=WEBPAGE_LOAD_TIMETOUT,
-        proxies=PROXIES,
-    ),
-}
-# tool -> function name
-TOOLS_TO_ACTION_NAMES = {
-    "websearch": "googleWebSearch",
-}
-
-
-def get_system_prompt(functions: Optional[List] = None) -> str:
-    """
-    Get system prompt for current conversation.
-    """
-    if functions is None:
-        functions = []
-    current_time, weekday = get_datetime_now()
-    time_info = TIME_PROMPT_TEMPLATE.format(current_time=current_time, weekday=weekday)
-    system_prompt = ROLE_PROMPT + "\n" + time_info
-    if len(functions) > 0:
-        system_prompt += "\n" + FUNCTION_CALLING_PROMPT_TEMPLATE.format(
-            functions=functions2str(functions)
-        )
-    return system_prompt
+TOKENIZER = load_tokenizer(MODEL_PATH)
+
+
+# conversation state of all sessions
+SESSION_STORE = SessionStore(
+    spill_dir=SESSION_SPILL_DIR,
+    max_sessions_in_memory=SESSION_MAX_IN_MEMORY,
+    max_session_bytes=SESSION_MAX_BYTES,
+    idle_seconds=SESSION_IDLE_SECONDS,
+)
+
+# admission control of bot turns, chat and search turns have separate pools
+SCHEDULER = AdmissionScheduler(
+    pools={"chat": SCHEDULER_CHAT_SLOTS, "search": SCHEDULER_SEARCH_SLOTS},
+    target_model_latency=MODEL_TARGET_LATENCY,
+    max_search_queue_depth=SEARCH_MAX_QUEUE_DEPTH,
+)
+
+# the agent loop, shared with the API server
+AGENT_WORKFLOW = AgentWorkflow(
+    tokenizer=TOKENIZER, model_latency_callback=SCHEDULER.record_model_latency
+)
+
+# session id -> cancellation token of its running bot turn, cancelled by Stop
+CANCEL_TOKENS: Dict[str, CancellationToken] = {}
+CANCEL_TOKENS_LOCK = threading.Lock()
 
 
 def user(
@@ -99,7 +75,10 @@ def user(
     """
     Add user input message to history.
     """
-    session_state["messages"] += [{"role": "user", "content": user_message}]
+    if session_state.get("session_id") is None:
+        session_state["session_id"] = SESSION_STORE.create()
+    session = SESSION_STORE.get(session_state["session_id"])
+    session["messages"] += [{"role": "user", "content": user_message}]
     return "", history + [{"role": "user", "content": user_message}], session_state
 
 
@@ -109,352 +88,158 @@ def bot(
     session_state: gr.State,
 ) -> Generator[List[Dict], None, None]:
     """
-    Main workflow.
+    Wait for admission, run the main workflow, then compact the session.
+    The turn is cancelled by Stop, or when gradio closes this generator because
+    the client has disconnected.
     """
-    # get registered tools
-    registered_tools = []
-    if websearch is True:
-        registered_tools.append("websearch")
-        temperature = AGENT_TEMPERATURE
-        max_gen_length = AGENT_MAX_OUTPUT_TOKENS
-    else:
-        temperature = CHAT_TEMPERATURE
-        max_gen_length = CHAT_MAX_OUTPUT_TOKENS
-    registered_function_names = [
-        TOOLS_TO_ACTION_NAMES[tool] for tool in registered_tools
-    ]
-    registered_functions = [
-        ACTIONS_MAP[function_name] for function_name in registered_function_names
-    ]
-    functions = [
-        function.function_defination
-        for function in registered_functions
-        if function.function_defination is not None
-    ]
-
-    # get system prompt
-    system_prompt = get_system_prompt(functions=functions)
-    # get model streaming output function
-    llm_streaming_output_func = get_vllm_model_output_function(
-        url=MODEL_SERVER_URL,
-        model_name=MODEL_NAME,
-        chat_mode=True,
-        stream=True,
-        model_config={
-            "temperature": temperature,
-            "max_tokens": max_gen_length,
-            "stop": STOP_TOKENS,
-        },
-    )
-
-    input_dict = {
-        "temperature": temperature,
-        "max_gen_length": max_gen_length,
-        "use_websearch": "websearch" in registered_tools,
-        "MODEL_NAME": MODEL_NAME,
-    }
-
-    for _ in range(MAX_ACTION_TURNS * 2):
-        # ASSISTANT answers two times per action turn
-        # answer1: <|function_start|>xxx<|function_end|>
-        # answer2: observation -> final answer
-
-        """
-        retain SESSION_WINDOW_SIZE turns (max_sequence_length is short -> 4096)
-        """
-        messages_truncated = truncate_messages(
-            messages=session_state["messages"],
-            tokenizer=TOKENIZER,
-            session_window_size=SESSION_WINDOW_SIZE,
-            max_input_tokens=SESSION_MAX_INPUT_TOKENS,
-            system_prompt=system_prompt,
-        )
-
-        messages_input = [
-            {"role": "system", "content": system_prompt}
-        ] + messages_truncated
-        input_dict.update(dict(messages=messages_input))
-        # print input prompt
-        print(
-            TOKENIZER.apply_chat_template(
-                messages_input, tokenize=False, add_generation_prompt=True
-            )
-        )
-
-        response_raw = ""
-        response_gradio = ""
-        """
-        streaming output status:
-            1. [chat]: generating chat message
-            2. [function start]: start generating function calling information ([chat] -> [function])
-            3. [function]: generating function calling information
-            4. [function end]: end generating function calling information ([function] -> [chat])
-        """
-        # in [function] status?
-        function_status = False
-        chunk_buffer = ""
-        for chunk in llm_streaming_output_func(messages=input_dict["messages"]):
-            chunk_buffer += chunk
-            # '<|function_start|>' and '<|function_end|>' appear to be truncated ?
-            if chunk_buffer.rfind("|>") < chunk_buffer.rfind("<|"):
-                continue
-            # [function start] status: ([chat] -> [function])
-            if function_status is False and include_special_tokens(
-                chunk_buffer, [FUNCTION_START_TOKEN]
-            ):
-                function_status = True
-                chat_part, tool_part = split_text_by_special_token(
-                    chunk_buffer, FUNCTION_START_TOKEN
-                )
-                tool_part = FUNCTION_START_TOKEN + tool_part
-                # add chat message to history
-                if len(response_gradio + chat_part) > 0:
-                    history.append(
-                        {"role": "assistant", "content": response_gradio + chat_part}
-                    )
-                response_gradio = tool_part
-                response_raw += chat_part + tool_part
-                chunk_buffer = ""
-                yield history + [
-                    {
-                        "role": "assistant",
-                        "content": response_gradio,
-                        "metadata": {"title": "tool parameters"},
-                    }
-                ]
-            # [function end] status: ([function] -> [chat])
-            elif function_status is True and include_special_tokens(
-                chunk_buffer, [FUNCTION_END_TOKEN]
-            ):
-                chat_part, _ = split_text_by_special_token(
-                    chunk_buffer, FUNCTION_END_TOKEN
-                )
-                response_gradio += chat_part + FUNCTION_END_TOKEN
-                response_raw += chat_part + FUNCTION_END_TOKEN
-                chunk_buffer = ""
-                history.append(
-                    {
-                        "role": "assistant",
-                        "content": response_gradio,
-                        "metadata": {"title": "tool parameters"},
-                    }
-                )
-                yield history
-                break
-            # [function] status
-            elif function_status is True:
-                response_gradio += chunk_buffer
-                response_raw += chunk_buffer
-                chunk_buffer = ""
-                yield history + [
-                    {
-                        "role": "assistant",
-                        "content": response_gradio,
-                        "metadata": {"title": "tool parameters"},
-                    }
-                ]
-            # [chat] status
-            elif function_status is False:
-                citations = extract_citations(chunk_buffer)
-                if len(citations) > 0 and len(session_state["url_infos"]) > 0:
-                    chunk_new = chunk_buffer
-                    for citation in citations:
-                        url_ind = int(citation) - 1
-                        # hardcoding for out-of-bounds
-                        if url_ind < 0:
-                            url_ind = 0
-                        elif url_ind >= len(session_state["url_infos"]):
-                            url_ind = len(session_state["url_infos"]) - 1
-                        # Add a space before the <a> tag to prevent rendering
-                        # errors when multiple <a></a> tags are adjacent to
-                        # each other.
-                        chunk_new = chunk_new.replace(
-                            f"[citation:{citation}]",
-                            f' <a href="{session_state["url_infos"][url_ind]["link"]}" class="circle-link">{citation}</a>',  # noqa: E501
-                        )
-                    response_gradio += chunk_new
-                else:
-                    response_gradio += chunk_buffer
-                response_raw += chunk_buffer
-
-                chunk_buffer = ""
-                yield history + [{"role": "assistant", "content": response_gradio}]
-
-                if session_state["stop_generation"] is True:
-                    session_state["stop_generation"] = False
-                    break
-
-        # if streaming ends with [chat] status, add response to history
-        if not include_special_tokens(response_gradio, FUNCTION_END_TOKEN):
-            history.append({"role": "assistant", "content": response_gradio})
-
-        session_state["messages"].append({"role": "assistant", "content": response_raw})
-
-        # no tool registered, end this turn
-        if len(registered_tools) == 0:
-            break
-
-        function_name, function_arguments = parse_function_call_from_model_ouput(
-            response_raw,
-            registered_function_names,
-            speical_tokens_map=dict(
-                function_start_token=FUNCTION_START_TOKEN,
-                function_end_token=FUNCTION_END_TOKEN,
-            ),
+    session_id = session_state["session_id"]
+    # the session is not spilled while the turn writes to it
+    SESSION_STORE.pin(session_id)
+    cancel_token = CancellationToken()
+    with CANCEL_TOKENS_LOCK:
+        CANCEL_TOKENS[session_id] = cancel_token
+    ticket = SCHEDULER.submit(session_id, "search" if websearch is True else "chat")
+    try:
+        while not SCHEDULER.wait(ticket, timeout=1.0):
+            if cancel_token.cancelled:
+                return
+            position = SCHEDULER.position(ticket)
+            yield history + [
+                {
+                    "role": "assistant",
+                    "content": f"排队中, 前面还有{position}个请求",
+                    "metadata": {"title": "queue"},
+                }
+            ]
+        yield from workflow(history, websearch, session_state, cancel_token)
+    finally:
+        # aborts the requests still running if the turn has not finished
+        cancel_token.cancel()
+        with CANCEL_TOKENS_LOCK:
+            if CANCEL_TOKENS.get(session_id) is cancel_token:
+                del CANCEL_TOKENS[session_id]
+        SCHEDULER.release(ticket)
+        # keep only what the next turns need
+        SESSION_STORE.compact(
+            session_state["session_id"], SESSION_WINDOW_SIZE, TOKENIZER
         )
+        SESSION_STORE.unpin(session_id)
 
-        # no tool use this turn, end this turn
-        if function_arguments is None:
-            break
 
-        # something is wrong, use function_arguments as observation (error
-        # message)
-        if function_name is None and isinstance(function_arguments, str):
-            history.append({"role": "observation", "content": function_arguments})
-            session_state["messages"].append(
-                {"role": "observation", "content": function_arguments}
-            )
-            continue
-
-        url_infos, html_contents = [], []
-        latest_tool_response = None
-        action = ACTIONS_MAP[function_name]
-        observation = None
-        if function_name == "googleWebSearch":
-            observation_genrator = action.run(
-                user_question=session_state["messages"][-2]["content"],
-                arguments=function_arguments,
-                llm_completion_funcion=get_vllm_model_output_function(
-                    url=MODEL_SERVER_URL,
-                    model_name=MODEL_NAME,
-                    chat_mode=False,
-                    stream=False,
-                    model_config={
-                        "temperature": temperature,
-                        "max_tokens": WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS,
-                        "stop": STOP_TOKENS,
-                    },
-                ),
-                tokenizer=TOKENIZER,
-                return_webpage_details=True,
+def workflow(
+    history: List[Dict],
+    websearch: bool,
+    session_state: gr.State,
+    cancel_token: CancellationToken,
+) -> Generator[List[Dict], None, None]:
+    """
+    Main workflow, render the events of the agent loop as chat messages.
+    """
+    session = SESSION_STORE.get(session_state["session_id"])
+
+    response_gradio = ""
+    function_text = ""
+    url_infos, latest_tool_response = [], None
+    for event in AGENT_WORKFLOW.run(
+        session,
+        websearch,
+        cancel_token=cancel_token,
+        progress=lambda items: gr.Progress().tqdm(items, desc="summarizing..."),
+    ):
+        if event["type"] == "text":
+            response_gradio += event["content"]
+            yield history + [{"role": "assistant", "content": response_gradio}]
+        elif event["type"] == "function_call":
+            # add chat message to history
+            if len(response_gradio) > 0:
+                history.append({"role": "assistant", "content": response_gradio})
+                response_gradio = ""
+            function_text += event["content"]
+            yield history + [
+                {
+                    "role": "assistant",
+                    "content": function_text,
+                    "metadata": {"title": "tool parameters"},
+                }
+            ]
+        elif event["type"] == "function_call_end":
+            function_text = ""
+            history.append(
+                {
+                    "role": "assistant",
+                    "content": event["content"],
+                    "metadata": {"title": "tool parameters"},
+                }
             )
-            for item in gr.Progress().tqdm(observation_genrator, desc="summarizing..."):
-                if isinstance(item, dict):
-                    if "observation" in item:
-                        observation = item["observation"]
-                        break
-                    url_infos.append(item["url_info"])
-                    html_contents.append(item["html_content"])
-                    yield history + [
-                        {
-                            "role": "assistant",
-                            "content": format_search_results(url_infos),
-                            "metadata": {"title": "tool results"},
-                        }
-                    ]
-                # error message
-                elif isinstance(item, str):
-                    latest_tool_response = item
-                    yield history + [
-                        {
-                            "role": "assistant",
-                            "content": latest_tool_response,
-                            "metadata": {"title": "tool results"},
-                        }
-                    ]
-                else:
-                    raise NotImplementedError
-
-            if len(url_infos) > 0:
+            yield history
+        elif event["type"] == "model_end":
+            # if streaming ends with [chat] status, add response to history
+            if not event["function_called"]:
                 history.append(
-                    {
-                        "role": "assistant",
-                        "content": format_search_results(url_infos),
-                        "metadata": {"title": "tool results"},
-                    }
+                    {"role": "assistant", "content": response_gradio + function_text}
                 )
-            else:
+            response_gradio, function_text = "", ""
+        elif event["type"] == "tool_result":
+            url_infos.append(event["url_info"])
+            yield history + [
+                {
+                    "role": "assistant",
+                    "content": format_search_results(url_infos),
+                    "metadata": {"title": "tool results"},
+                }
+            ]
+        elif event["type"] == "tool_message":
+            latest_tool_response = event["content"]
+            yield history + [
+                {
+                    "role": "assistant",
+                    "content": latest_tool_response,
+                    "metadata": {"title": "tool results"},
+                }
+            ]
+        elif event["type"] == "observation":
+            if len(url_infos) > 0 or latest_tool_response is not None:
                 history.append(
                     {
                         "role": "assistant",
-                        "content": latest_tool_response,
+                        "content": (
+                            format_search_results(url_infos)
+                            if len(url_infos) > 0
+                            else latest_tool_response
+                        ),
                         "metadata": {"title": "tool results"},
                     }
                 )
+            history.append({"role": "observation", "content": event["content"]})
+            url_infos, latest_tool_response = [], None
 
-            # update url_infos
-            session_state["url_infos"] = url_infos
-        else:
-            observation = action.run(function_arguments)
-
-        assert observation is not None
-        history.append({"role": "observation", "content": observation})
-        session_state["messages"].append(
-            {"role": "observation", "content": observation}
-        )
 
-
-def truncate_messages(
-    messages: List[Dict],
-    tokenizer: AutoTokenizer,
-    session_window_size: int,
-    max_input_tokens: int,
-    system_prompt: str,
-) -> List[Dict]:
+def record_search_load(loads: List[Dict]) -> None:
     """
-    truncate messages for model input by session_window_size and max_input_tokens
+    Feed the scheduler the queue depth polled by the load balancer, with several
+    replicas the one of the least loaded, where the next search goes.
     """
-    # get parts for each turn
-    turn_start_inds = []
-    for ind, message in enumerate(messages):
-        if message["role"] == "user":
-            turn_start_inds.append(ind)
-    # only latest turns are used as input
-    turn_start_inds_used = turn_start_inds[-session_window_size:]
-    messages_parts = []
-    for i in range(len(turn_start_inds_used)):
-        turn_start_ind = turn_start_inds_used[i]
-        turn_end_ind = (
-            len(messages)
-            if i + 1 >= len(turn_start_inds_used)
-            else turn_start_inds_used[i + 1]
-        )
-        messages_parts.append(messages[turn_start_ind:turn_end_ind])
-    # truncate by max_input_tokens
-    messages_truncated = []
-    for i, messages_part in enumerate(reversed(messages_parts)):
-        if (
-            i == 0
-            or len(
-                tokenizer.apply_chat_template(
-                    [{"role": "system", "content": system_prompt}]
-                    + messages_truncated
-                    + messages_part,
-                    tokenize=True,
-                )
-            )
-            < max_input_tokens
-        ):
-            messages_truncated = messages_part + messages_truncated
-        else:
-            break
-    return messages_truncated
+    if len(loads) > 0:
+        SCHEDULER.record_search_queue_depth(min(load["queue_depth"] for load in loads))
 
 
 def stop_response(session_state: gr.State) -> gr.State:
-    session_state["stop_generation"] = True
+    with CANCEL_TOKENS_LOCK:
+        cancel_token = CANCEL_TOKENS.get(session_state.get("session_id"))
+    if cancel_token is not None:
+        cancel_token.cancel()
     return session_state
 
 
 def clear(history: List[Dict], session_state: gr.State) -> Tuple[List[Dict], gr.State]:
-    session_state["messages"] = []
-    session_state["url_infos"] = []
-    session_state["stop_generation"] = False
+    if session_state.get("session_id") is not None:
+        SESSION_STORE.reset(session_state["session_id"])
     return [], session_state
 
 
 def toggle_change(session_state: gr.State) -> gr.State:
-    session_state["messages"] = []
+    if session_state.get("session_id") is not None:
+        SESSION_STORE.get(session_state["session_id"])["messages"] = []
     return session_state
 
 
@@ -469,13 +254,7 @@ with gr.Blocks(
             )
 
     # conversation state vars
-    session_state = gr.State(
-        dict(
-            messages=[],
-            url_infos=[],
-            stop_generation=False,
-        )
-    )
+    session_state = gr.State(dict(session_id=None))
     toggle_is_interactive = gr.State(value=True)
 
     # bottom bar
@@ -500,11 +279,38 @@ with gr.Blocks(
         bot,
         [chatbot, websearch, session_state],
         outputs=[chatbot],
-        concurrency_limit=2,
+        concurrency_limit=BOT_CONCURRENCY_LIMIT,
     )
     clear_btn.click(clear, [chatbot, session_state], outputs=[chatbot, session_state])
     stop_btn.click(stop_response, [session_state], outputs=[session_state], queue=False)
 
 
 if __name__ == "__main__":
-    demo.launch(share=False, server_port=SERVER_PORT)
+    import uvicorn
+    from fastapi import FastAPI
+
+    # the routes are registered before the gradio app is mounted, not added to
+    # a server already running
+    server_app = FastAPI()
+    # per-session memory accounting
+    server_app.add_api_route("/session_stats", SESSION_STORE.stats, methods=["GET"])
+    # pool limits, model latency and queue lengths
+    server_app.add_api_route("/scheduler_stats", SCHEDULER.stats, methods=["GET"])
+    # work avoided by cancelled turns
+    server_app.add_api_route("/cancellation_stats", get_avoided_work, methods=["GET"])
+    # time to first token and gaps between re-renders of the model output
+    server_app.add_api_route("/stream_stats", get_stream_stats, methods=["GET"])
+    # load, health and failures of the search service replicas
+    server_app.add_api_route(
+        "/search_replicas",
+        AGENT_WORKFLOW.actions_map["googleWebSearch"].load_balancer.stats,
+        methods=["GET"],
+    )
+    demo.max_threads = BOT_CONCURRENCY_LIMIT + 8
+    server_app = gr.mount_gradio_app(server_app, demo, path="/")
+
+    AGENT_WORKFLOW.actions_map["googleWebSearch"].load_balancer.add_load_listener(
+        record_search_load
+    )
+    threading.Thread(target=AGENT_WORKFLOW.warm_up, daemon=True).start()
+    uvicorn.run(server_app, host="127.0.0.1", port=SERVER_PORT)
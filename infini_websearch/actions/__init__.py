@@ -1,4 +1,13 @@
-from infini_websearch.actions.action_utils import parse_function_call_from_model_ouput
+from infini_websearch.actions.action_utils import (
+    parse_function_call_from_model_ouput,
+    parse_function_calls_from_model_ouput,
+)
+from infini_websearch.actions.search_client import SearchServiceClient
 from infini_websearch.actions.websearch import GoogleSearch
 
-__all__ = ["parse_function_call_from_model_ouput", "GoogleSearch"]
+__all__ = [
+    "parse_function_call_from_model_ouput",
+    "parse_function_calls_from_model_ouput",
+    "GoogleSearch",
+    "SearchServiceClient",
+]
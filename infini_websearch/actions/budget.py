@@ -0,0 +1,83 @@
+import math
+from typing import Dict, List, Optional
+
+from infini_websearch.utils.retrieval import tokenize_for_retrieval
+
+
+def score_webpages(
+    query: str,
+    webpage_details: List[Dict],
+    webpage_texts: List[str],
+    webpage_num_tokens: List[int],
+    rank_weight: float = 0.4,
+    overlap_weight: float = 0.4,
+    length_weight: float = 0.2,
+    full_length_tokens: int = 1024,
+) -> List[float]:
+    """
+    Score pages by serper rank, lexical overlap with the query and length.
+    A page without any query term scores zero.
+    """
+    query_terms = set(tokenize_for_retrieval(query))
+    scores = []
+    for i, (webpage_detail, webpage_text, num_tokens) in enumerate(
+        zip(webpage_details, webpage_texts, webpage_num_tokens)
+    ):
+        position = webpage_detail["url_info"].get("position", i + 1)
+        rank_score = 1.0 / math.sqrt(max(1, position))
+        if len(query_terms) > 0:
+            page_terms = set(tokenize_for_retrieval(webpage_text))
+            overlap_score = len(query_terms & page_terms) / len(query_terms)
+        else:
+            overlap_score = 1.0
+        length_score = min(1.0, math.log1p(num_tokens) / math.log1p(full_length_tokens))
+        if overlap_score == 0:
+            scores.append(0.0)
+            continue
+        scores.append(
+            rank_weight * rank_score
+            + overlap_weight * overlap_score
+            + length_weight * length_score
+        )
+    return scores
+
+
+def allocate_tokens(
+    scores: List[float],
+    total_tokens: int,
+    caps: Optional[List[int]] = None,
+    min_tokens: int = 0,
+) -> List[int]:
+    """
+    Split total_tokens proportionally to scores. A page never gets more than
+    its cap, tokens above a cap are redistributed to the other pages.
+    Pages with a positive score get at least min_tokens if the total allows.
+    """
+    num_pages = len(scores)
+    if caps is None:
+        caps = [total_tokens] * num_pages
+    allocation = [0] * num_pages
+    active = [i for i in range(num_pages) if scores[i] > 0 and caps[i] > 0]
+    if len(active) == 0:
+        return allocation
+
+    floor = min(min_tokens, total_tokens // len(active))
+    for i in active:
+        allocation[i] = min(floor, caps[i])
+    remaining = total_tokens - sum(allocation)
+    # water filling: give the remaining tokens by score until all caps are hit
+    while remaining > 0 and len(active) > 0:
+        total_score = sum(scores[i] for i in active)
+        capped, given = [], 0
+        for i in active:
+            share = int(remaining * scores[i] / total_score)
+            share = min(share, caps[i] - allocation[i])
+            allocation[i] += share
+            given += share
+            if allocation[i] >= caps[i]:
+                capped.append(i)
+        remaining -= given
+        active = [i for i in active if i not in capped]
+        if len(capped) == 0:
+            break
+    return allocation
@@ -0,0 +1,179 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urljoin
+
+import requests
+
+# assumed page load capacity of a replica not reporting one
+DEFAULT_REPLICA_CAPACITY = 16
+
+
+def fetch_search_service_load(
+    url: str, proxies: Dict, timeout: float = 1.0
+) -> Optional[Dict]:
+    """
+    Get the in-flight work of the search service from its /load endpoint.
+    """
+    try:
+        response = requests.get(urljoin(url, "load"), proxies=proxies, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        print(f"获取搜索服务负载失败: {e}")
+        return None
+
+
+class Replica:
+    def __init__(self, url: str) -> None:
+        self.url = url
+        # last /load report, None until polled or when the poll failed
+        self.load: Optional[Dict] = None
+        # page loads sent since the last poll, not yet in the report
+        self.pending = 0
+        self.in_flight = 0
+        self.num_requests = 0
+        self.num_failures = 0
+        # not chosen while it has recently failed, unless nothing else is left
+        self.failed_until = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.load is not None and self.failed_until <= now
+
+    def score(self) -> float:
+        """
+        Queued page loads relative to the capacity of the replica.
+        """
+        load = self.load or {}
+        capacity = load.get("capacity") or DEFAULT_REPLICA_CAPACITY
+        return (load.get("queue_depth", 0) + self.pending) / capacity
+
+
+class SearchLoadBalancer:
+    """
+    Route searches to the least loaded healthy replica of the search service.
+    The /load endpoint of every replica is polled in the background, a
+    replica whose poll fails, or which fails a request, is skipped for
+    failure_cooldown seconds. Until the first poll has finished, requests go
+    to the replicas in turn. With a single replica nothing is polled, unless
+    a load listener is added.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        proxies: Dict,
+        poll_interval: float = 2.0,
+        failure_cooldown: float = 10.0,
+        load_timeout: float = 1.0,
+    ) -> None:
+        if len(urls) == 0:
+            raise ValueError("at least one search service url is required")
+        self.replicas = [Replica(url) for url in urls]
+        self.proxies = proxies
+        self.poll_interval = poll_interval
+        self.failure_cooldown = failure_cooldown
+        self.load_timeout = load_timeout
+        self.lock = threading.Lock()
+        self.poll_thread: Optional[threading.Thread] = None
+        self.polled = False
+        # next replica in turn before the first poll
+        self.next_index = 0
+        # called with the /load reports of the replicas answering every poll
+        self.load_listeners: List[Callable[[List[Dict]], None]] = []
+
+    @property
+    def urls(self) -> List[str]:
+        return [replica.url for replica in self.replicas]
+
+    def get_replica(self, url: str) -> Replica:
+        return next(replica for replica in self.replicas if replica.url == url)
+
+    def poll(self) -> None:
+        for replica in self.replicas:
+            load = fetch_search_service_load(
+                replica.url, self.proxies, timeout=self.load_timeout
+            )
+            with self.lock:
+                replica.load = load
+                replica.pending = 0
+        with self.lock:
+            self.polled = True
+        loads = [replica.load for replica in self.replicas if replica.load is not None]
+        for listener in self.load_listeners:
+            listener(loads)
+
+    def add_load_listener(self, listener: Callable[[List[Dict]], None]) -> None:
+        """
+        Call listener with the loads of the replicas after every poll, polling
+        starts now.
+        """
+        self.load_listeners.append(listener)
+        self.start_polling()
+
+    def poll_forever(self) -> None:
+        while True:
+            self.poll()
+            time.sleep(self.poll_interval)
+
+    def start_polling(self) -> None:
+        with self.lock:
+            if self.poll_thread is not None:
+                return
+            # the first poll too, requests do not wait for it
+            self.poll_thread = threading.Thread(target=self.poll_forever, daemon=True)
+            self.poll_thread.start()
+
+    def acquire(self, cost: int = 1, exclude: Iterable[str] = ()) -> Optional[str]:
+        """
+        Choose the replica for a request loading `cost` pages, None if every
+        replica is excluded. Release it with release().
+        """
+        if len(self.replicas) > 1 and self.poll_thread is None:
+            self.start_polling()
+        now = time.time()
+        with self.lock:
+            candidates = [
+                replica for replica in self.replicas if replica.url not in exclude
+            ]
+            if len(candidates) == 0:
+                return None
+            if not self.polled:
+                ready = [r for r in candidates if r.failed_until <= now] or candidates
+                replica = ready[self.next_index % len(ready)]
+                self.next_index += 1
+            elif len(candidates) > 1:
+                healthy = [replica for replica in candidates if replica.is_healthy(now)]
+                # all unhealthy, try the least loaded anyway
+                candidates = healthy or candidates
+                replica = min(candidates, key=lambda replica: replica.score())
+            else:
+                replica = candidates[0]
+            replica.pending += cost
+            replica.in_flight += 1
+            replica.num_requests += 1
+            return replica.url
+
+    def release(self, url: str, failed: bool = False) -> None:
+        with self.lock:
+            replica = self.get_replica(url)
+            replica.in_flight -= 1
+            if failed:
+                replica.num_failures += 1
+                replica.failed_until = time.time() + self.failure_cooldown
+
+    def stats(self) -> List[Dict]:
+        now = time.time()
+        with self.lock:
+            return [
+                {
+                    "url": replica.url,
+                    "healthy": replica.is_healthy(now),
+                    "load": replica.load,
+                    "score": round(replica.score(), 3),
+                    "in_flight": replica.in_flight,
+                    "requests": replica.num_requests,
+                    "failures": replica.num_failures,
+                }
+                for replica in self.replicas
+            ]
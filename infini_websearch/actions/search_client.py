@@ -0,0 +1,213 @@
+import json
+import threading
+import time
+from typing import Dict, Generator, Iterable, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from infini_websearch.utils.cancellation import (
+    CancellationToken,
+    abort_requests_response,
+    record_avoided_work,
+)
+
+# statuses of a replica restarting or overloaded, retried before the first byte
+RETRY_STATUS_CODES = {502, 503, 504}
+# search results carry whole pages, read the stream in large blocks
+STREAM_CHUNK_SIZE = 64 * 1024
+# fields of the records of a page sent in chunks
+CHUNK_FIELDS = ("chunk", "more_chunks")
+
+
+class SearchDeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+class RecordDecoder:
+    """
+    Decode the NDJSON records of a search stream read in blocks.
+    """
+
+    def __init__(self) -> None:
+        self.pending = b""
+
+    def feed(self, chunk: bytes) -> List[Dict]:
+        lines = (self.pending + chunk).split(b"\n")
+        self.pending = lines.pop()
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def close(self) -> List[Dict]:
+        pending, self.pending = self.pending, b""
+        return [json.loads(pending)] if pending.strip() else []
+
+
+def split_records(chunks: Iterable[bytes]) -> Generator[Dict, None, None]:
+    decoder = RecordDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+def assemble_pages(
+    records: Iterable[Dict], max_chars: Optional[int] = None
+) -> Generator[Dict, None, None]:
+    """
+    Join the chunk records of the pages of a search stream (see chunked_pages
+    of the search service), a page is yielded once its last chunk arrives.
+    With max_chars, a page is yielded as soon as it has max_chars characters,
+    cut to them, and its further chunks are dropped as they arrive.
+    """
+    pages: Dict[str, Dict] = {}
+    chunks: Dict[str, List[str]] = {}
+    num_chars: Dict[str, int] = {}
+    for record in records:
+        link = record["url_info"]["link"]
+        if record.get("chunk", 0) == 0:
+            pages[link] = {
+                key: value for key, value in record.items() if key not in CHUNK_FIELDS
+            }
+            chunks[link], num_chars[link] = [], 0
+        elif link not in pages:
+            # the rest of a page yielded at max_chars
+            continue
+        chunks[link].append(record["html_content"])
+        num_chars[link] += len(record["html_content"])
+        full = max_chars is not None and num_chars[link] >= max_chars
+        if full or not record.get("more_chunks", False):
+            page = pages.pop(link)
+            page["html_content"] = "".join(chunks.pop(link))[:max_chars]
+            del num_chars[link]
+            yield page
+    # pages whose stream ended before their last chunk
+    for link, page in pages.items():
+        page["html_content"] = "".join(chunks[link])
+        page["partial"] = True
+        yield page
+
+
+class SearchServiceClient:
+    """
+    Long-lived client of the search service, shared by all sessions: the
+    connections are pooled and every search is bounded by a connect timeout,
+    a timeout between two reads and a total deadline (checked as records
+    arrive, a silent stream is ended by the read timeout). Failed connections
+    and RETRY_STATUS_CODES are retried up to max_retries times, a search whose
+    response has started, or timed out, is not retried.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 20.0,
+        total_timeout: float = 60.0,
+        max_retries: int = 2,
+        retry_backoff: float = 0.2,
+        pool_size: int = 32,
+    ) -> None:
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.num_retries = 0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(
+        self, url: str, content: Dict, proxies: Optional[Dict], deadline: float
+    ) -> requests.Response:
+        """
+        Send the search and wait for the response headers, with retries.
+        """
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SearchDeadlineExceeded(f"search of {url} exceeded its deadline")
+            try:
+                response = self.session.post(
+                    url,
+                    json=content,
+                    stream=True,
+                    proxies=proxies,
+                    timeout=(
+                        min(self.connect_timeout, remaining),
+                        min(self.read_timeout, remaining),
+                    ),
+                )
+            except requests.exceptions.ConnectionError:
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if (
+                    response.status_code not in RETRY_STATUS_CODES
+                    or attempt == self.max_retries
+                ):
+                    return response
+                response.close()
+            self.num_retries += 1
+            time.sleep(self.retry_backoff * 2**attempt)
+
+    def stream(
+        self,
+        url: str,
+        content: Dict,
+        proxies: Optional[Dict] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        deadline: Optional[float] = None,
+    ) -> Generator[Dict, None, None]:
+        """
+        Search and yield the records of the response as they arrive.
+        deadline: ends the search earlier than total_timeout.
+        cancel_token: closes the stream, the search service stops loading the
+            pages of a closed stream.
+        """
+        total_deadline = time.time() + self.total_timeout
+        if deadline is not None:
+            total_deadline = min(total_deadline, deadline)
+        with self.post(url, content, proxies, total_deadline) as response:
+            handle = None
+            if cancel_token is not None:
+
+                def abort() -> None:
+                    record_avoided_work("search_streams_closed")
+                    abort_requests_response(response)
+
+                handle = cancel_token.add_callback(abort)
+            try:
+                response.raise_for_status()
+                for record in split_records(
+                    response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                ):
+                    yield record
+                    if time.time() > total_deadline:
+                        raise SearchDeadlineExceeded(
+                            f"search of {url} exceeded its deadline"
+                        )
+            except Exception:
+                # reading a stream aborted by the cancellation fails
+                if cancel_token is None or not cancel_token.cancelled:
+                    raise
+            finally:
+                if cancel_token is not None:
+                    cancel_token.remove_callback(handle)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+SEARCH_CLIENT: Optional[SearchServiceClient] = None
+SEARCH_CLIENT_LOCK = threading.Lock()
+
+
+def get_search_client() -> SearchServiceClient:
+    """
+    Client shared by the searches not given their own.
+    """
+    global SEARCH_CLIENT
+    with SEARCH_CLIENT_LOCK:
+        if SEARCH_CLIENT is None:
+            SEARCH_CLIENT = SearchServiceClient()
+        return SEARCH_CLIENT
@@ -0,0 +1,110 @@
+import re
+from typing import TYPE_CHECKING, Dict, List
+
+from infini_websearch.utils.retrieval import tokenize_for_retrieval
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+SUMMARY_PATH_RAW = "raw"
+SUMMARY_PATH_EXTRACTIVE = "extractive"
+SUMMARY_PATH_LLM = "llm"
+SUMMARY_PATH_SKIP = "skip"
+
+SENTENCE_END_PATTERN = re.compile(r"(?<=[。！？!?；;])|(?<=\. )|\n")
+
+
+def split_sentences(text: str) -> List[str]:
+    return [
+        sentence.strip()
+        for sentence in SENTENCE_END_PATTERN.split(text)
+        if sentence.strip()
+    ]
+
+
+def get_query_density(query: str, sentences: List[str]) -> float:
+    """
+    Fraction of sentences mentioning a query term.
+    A dense page spreads the answer over many sentences, picking a few of them
+    loses information.
+    """
+    query_terms = set(tokenize_for_retrieval(query))
+    if len(sentences) == 0 or len(query_terms) == 0:
+        return 0.0
+    num_relevant = sum(
+        1
+        for sentence in sentences
+        if query_terms & set(tokenize_for_retrieval(sentence))
+    )
+    return num_relevant / len(sentences)
+
+
+def extractive_summary(
+    query: str, text: str, tokenizer: "AutoTokenizer", max_tokens: int
+) -> str:
+    """
+    Pick the sentences sharing the most terms with the query until max_tokens,
+    and keep them in their original order.
+    """
+    query_terms = set(tokenize_for_retrieval(query))
+    sentences = split_sentences(text)
+    scored = []
+    for i, sentence in enumerate(sentences):
+        sentence_terms = set(tokenize_for_retrieval(sentence))
+        overlap = len(query_terms & sentence_terms)
+        # earlier sentences win ties, they tend to carry the main point
+        scored.append((overlap, -i, sentence))
+    selected, num_tokens = [], 0
+    for overlap, neg_ind, sentence in sorted(scored, reverse=True):
+        if overlap == 0 and len(selected) > 0:
+            break
+        sentence_tokens = len(tokenizer.encode(sentence, add_special_tokens=False))
+        if num_tokens + sentence_tokens > max_tokens:
+            continue
+        selected.append((-neg_ind, sentence))
+        num_tokens += sentence_tokens
+    return "\n".join(sentence for _, sentence in sorted(selected))
+
+
+def plan_summaries(
+    query: str,
+    webpage_texts: List[str],
+    webpage_num_tokens: List[int],
+    token_budgets: List[int],
+    raw_max_tokens: int = 256,
+    extractive_max_tokens: int = 1024,
+    llm_max_output_tokens: int = 512,
+    dense_threshold: float = 0.5,
+) -> List[Dict]:
+    """
+    Choose how each page is summarized:
+        1. [raw]: short pages are used verbatim
+        2. [extractive]: medium pages get the sentences most related to the query
+        3. [llm]: long or dense pages are summarized by the model
+        4. [skip]: pages without token budget are left out
+    The token budget of a page bounds its raw text, extractive summary or llm
+    output in the observation.
+    """
+    plans = []
+    for webpage_text, num_tokens, share in zip(
+        webpage_texts, webpage_num_tokens, token_budgets
+    ):
+        if share <= 0:
+            path, max_output_tokens = SUMMARY_PATH_SKIP, 0
+        elif num_tokens <= min(raw_max_tokens, share):
+            path, max_output_tokens = SUMMARY_PATH_RAW, num_tokens
+        elif num_tokens <= extractive_max_tokens and (
+            get_query_density(query, split_sentences(webpage_text)) < dense_threshold
+        ):
+            path, max_output_tokens = SUMMARY_PATH_EXTRACTIVE, share
+        else:
+            path = SUMMARY_PATH_LLM
+            max_output_tokens = min(llm_max_output_tokens, share)
+        plans.append(
+            {
+                "path": path,
+                "num_tokens": num_tokens,
+                "max_output_tokens": max_output_tokens,
+            }
+        )
+    return plans
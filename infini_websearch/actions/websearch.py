@@ -1,32 +1,121 @@
-import json
-from typing import Callable, Dict, Generator, List, Optional
+import math
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Callable, Dict, Generator, List, Optional, Union
 
 import requests
-from transformers import AutoTokenizer
 
 from infini_websearch.actions.base_action import BaseAction
+from infini_websearch.actions.budget import allocate_tokens, score_webpages
+from infini_websearch.actions.load_balancer import SearchLoadBalancer
+from infini_websearch.actions.search_client import (
+    SearchServiceClient,
+    assemble_pages,
+    get_search_client,
+)
+from infini_websearch.actions.summary_policy import (
+    SUMMARY_PATH_EXTRACTIVE,
+    SUMMARY_PATH_LLM,
+    SUMMARY_PATH_RAW,
+    SUMMARY_PATH_SKIP,
+    extractive_summary,
+    plan_summaries,
+)
+from infini_websearch.utils.cancellation import CancellationToken, record_avoided_work
+from infini_websearch.utils.retrieval import PassageIndex, is_time_sensitive
+from infini_websearch.utils.timing import StageTimer
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+WEBPAGE_LOAD_TIMEOUT_MESSAGE = "搜索页面加载超时, 请重试"
+NO_RELEVANT_CONTENT_MESSAGE = "无相关内容"
+SEARCH_CANCELLED_MESSAGE = "搜索已取消"
+# pages always get at least this long to load, even with a short deadline
+MIN_PAGE_LOAD_BUDGET = 2.0
+# part of the fetch deadline kept for sending the pages harvested at the page
+# load deadline of the search service to us
+SEARCH_RESPONSE_MARGIN = 0.3
+# the search service answers after its serper search (at most 10s), the longest
+# silence of a search stream
+SEARCH_READ_TIMEOUT = 15.0
 
 
 class GoogleSearch(BaseAction):
     def __init__(
         self,
-        server_url: str,
+        server_url: Union[str, List[str]],
         summary_prompt_template: str,
         observation_prompt_template: str,
         num_search_webpages: int = 5,
         webpage_summary_max_input_tokens: int = 2048,
         webpage_load_timetout: float = 10.0,
         proxies: Optional[Dict] = None,
+        max_queries_per_turn: int = 3,
+        passage_index_max_context_chars: int = 2000,
+        webpage_summary_max_output_tokens: int = 512,
+        webpage_raw_max_tokens: int = 256,
+        webpage_extractive_max_tokens: int = 1024,
+        observation_max_tokens: int = 1536,
+        observation_deadline: Optional[float] = 6.0,
+        summary_reserve_seconds: float = 2.0,
+        summary_quorum: float = 0.6,
+        snippet_answer_threshold: Optional[float] = 0.7,
+        max_search_attempts: int = 2,
+        webpage_max_chars: Optional[int] = 16000,
+        load_poll_interval: float = 2.0,
     ) -> None:
-        self.server_url = server_url
+        """
+        server_url: the search service, or a list of its replicas, each search
+            goes to the least loaded healthy one.
+        observation_deadline: seconds from the start of run() to the observation,
+            None waits for every page and summary.
+        summary_reserve_seconds: part of the deadline kept for summarizing, pages
+            arriving later are dropped.
+        summary_quorum: fraction of the model summaries after which the
+            observation is built without waiting for the others.
+        snippet_answer_threshold: the search service answers a query from the
+            answer box, knowledge graph and snippets of its serper response,
+            without loading pages, when they score at least this. None disables it.
+        max_search_attempts: replicas a query is tried on, a search failing
+            mid-stream is continued on another replica.
+        webpage_max_chars: text kept per page, the search service sends no more
+            than this. None keeps whole pages.
+        load_poll_interval: seconds between polls of the /load endpoints of the
+            replicas.
+        """
+        server_urls = [server_url] if isinstance(server_url, str) else server_url
+        self.server_url = server_urls[0]
         self.summary_prompt_template = summary_prompt_template
         self.observation_prompt_template = observation_prompt_template
         self.num_search_webpages = num_search_webpages
         self.webpage_summary_max_input_tokens = webpage_summary_max_input_tokens
         self.webpage_load_timetout = webpage_load_timetout
+        self.max_queries_per_turn = max_queries_per_turn
+        self.passage_index_max_context_chars = passage_index_max_context_chars
+        self.webpage_summary_max_output_tokens = webpage_summary_max_output_tokens
+        self.webpage_raw_max_tokens = webpage_raw_max_tokens
+        self.webpage_extractive_max_tokens = webpage_extractive_max_tokens
+        self.observation_max_tokens = observation_max_tokens
+        self.observation_deadline = observation_deadline
+        self.summary_reserve_seconds = summary_reserve_seconds
+        self.summary_quorum = summary_quorum
+        self.snippet_answer_threshold = snippet_answer_threshold
+        self.max_search_attempts = max_search_attempts
+        self.webpage_max_chars = webpage_max_chars
         if proxies is None:
             proxies = {"http": None, "https": None}
         self.proxies = proxies
+        self.load_balancer = SearchLoadBalancer(
+            server_urls, proxies, poll_interval=load_poll_interval
+        )
+        # pooled connections to the search service, shared by all sessions
+        self.search_client = SearchServiceClient(
+            read_timeout=SEARCH_READ_TIMEOUT,
+            total_timeout=webpage_load_timetout + SEARCH_READ_TIMEOUT,
+        )
 
     @property
     def function_defination(self) -> Optional[Dict]:
@@ -46,7 +135,8 @@ class GoogleSearch(BaseAction):
                         "description": (
                             "Content that users want to search for, such as 'weather', 'current events', etc."
                             "If special characters such as '\n' appear in the search, "
-                            "these special characters must be ignored."
+                            "these special characters must be ignored. "
+                            "To compare several things, call this function once per thing."
                         ),
                     }
                 },
@@ -59,83 +149,494 @@ class GoogleSearch(BaseAction):
         user_question: str,
         arguments: Dict,
         llm_completion_funcion: Callable,
-        tokenizer: AutoTokenizer,
+        tokenizer: "AutoTokenizer",
         return_webpage_details: bool,
+        passage_index: Optional[PassageIndex] = None,
+        observation_max_tokens: Optional[int] = None,
+        stage_timer: Optional[StageTimer] = None,
+        cancel_token: Optional[CancellationToken] = None,
     ) -> Generator[Dict, None, None]:
-        if "query" not in arguments:
-            return {"observation": "调用工具失败, 缺乏必要输入参数, 请重试"}
+        """
+        observation_max_tokens: tokens left for the observation in the session
+            window, the page summaries are budgeted to fit into it.
+        stage_timer: times the search and summarize stages.
+        cancel_token: closes the search streams and aborts the summaries, the
+            observation is SEARCH_CANCELLED_MESSAGE.
+        """
+        if stage_timer is None:
+            stage_timer = StageTimer()
+        start = time.time()
+        deadline, fetch_deadline = None, None
+        page_load_budget = self.webpage_load_timetout
+        if self.observation_deadline is not None:
+            deadline = start + self.observation_deadline
+            fetch_deadline = deadline - self.summary_reserve_seconds
+            # the search service counts the budget from the arrival of the
+            # search, serper latency included
+            page_load_budget = min(
+                page_load_budget,
+                max(
+                    MIN_PAGE_LOAD_BUDGET,
+                    fetch_deadline - start - SEARCH_RESPONSE_MARGIN,
+                ),
+            )
+        queries = self.get_queries(arguments)
+        if len(queries) == 0:
+            yield {"observation": "调用工具失败, 缺乏必要输入参数, 请重试"}
+            return
+        queries = queries[: self.max_queries_per_turn]
+
+        # follow-up questions are answered from pages fetched earlier in the
+        # session, unless they ask about things that change quickly
+        if passage_index is not None and all(
+            not is_time_sensitive(query) and passage_index.covers(query)
+            for query in queries
+        ):
+            print(f"命中会话索引: {queries}")
+            yield from self.run_with_passage_index(
+                user_question, queries, passage_index, return_webpage_details
+            )
+            return
+
+        # several queries share the pages of one search
+        num_search_pages = max(2, math.ceil(self.num_search_webpages / len(queries)))
+
+        search_content = {
+            "num_search_pages": num_search_pages,
+            "page_load_budget": page_load_budget,
+        }
+        if self.snippet_answer_threshold is not None:
+            search_content["snippet_answer_threshold"] = self.snippet_answer_threshold
+        if self.webpage_max_chars is not None:
+            search_content["page_max_chars"] = self.webpage_max_chars
 
         # get webpage content
         webpage_detail_list = []
         try:
-            for webpage_detail in self.streaming_fetch_search_results(
-                self.server_url,
-                {
-                    "query": arguments["query"],
-                    "num_search_pages": self.num_search_webpages,
-                },
-                self.proxies,
-            ):
-                webpage_detail_list.append(webpage_detail)
-                if return_webpage_details:
-                    yield webpage_detail
+            with stage_timer.stage("search"):
+                webpage_details = self.streaming_fetch_multi_query_results(
+                    self.server_url,
+                    queries,
+                    search_content,
+                    self.proxies,
+                    deadline=fetch_deadline,
+                    cancel_token=cancel_token,
+                    load_balancer=self.load_balancer,
+                    max_search_attempts=self.max_search_attempts,
+                    client=self.search_client,
+                )
+                for webpage_detail in webpage_details:
+                    webpage_detail_list.append(webpage_detail)
+                    if return_webpage_details:
+                        yield webpage_detail
+            # pages not loaded by the fetch deadline are dropped
+            fetch_deadline_hit = (
+                fetch_deadline is not None and time.time() >= fetch_deadline
+            )
         except Exception as e:
             print(e)
             yield {"observation": '输出"websearch server发生错误, 请重试"'}
             return
+        if cancel_token is not None and cancel_token.cancelled:
+            yield {"observation": SEARCH_CANCELLED_MESSAGE}
+            return
+
+        # the fast path decision of each query, reported in the trace
+        snippet_answers = {
+            webpage_detail["query"]: webpage_detail["snippet_answer"]
+            for webpage_detail in webpage_detail_list
+            if webpage_detail.get("snippet_answer") is not None
+        }
+        if len(webpage_detail_list) > 0 and all(
+            webpage_detail.get("source") == "snippet"
+            for webpage_detail in webpage_detail_list
+        ):
+            yield self.get_snippet_answer_observation(
+                user_question, queries, webpage_detail_list, snippet_answers, start
+            )
+            return
 
         webpage_texts = [
             webpage_detail["html_content"] for webpage_detail in webpage_detail_list
         ]
+        # partially loaded pages (stopped at the deadline) still count as loaded
+        loaded_inds = [
+            i
+            for i, webpage_text in enumerate(webpage_texts)
+            if webpage_text and webpage_text != WEBPAGE_LOAD_TIMEOUT_MESSAGE
+        ]
 
-        no_webpages_loaded = True
-        for webpage_text in webpage_texts:
-            if webpage_text != "搜索页面加载超时, 请重试":
-                no_webpages_loaded = False
-                break
+        if passage_index is not None:
+            for i in loaded_inds:
+                # snippets are too short to answer follow-up questions from
+                if webpage_detail_list[i].get("source") == "snippet":
+                    continue
+                passage_index.add_page(
+                    webpage_detail_list[i]["url_info"], webpage_texts[i]
+                )
 
         # all web pages are timing out when loading
-        if no_webpages_loaded:
-            summaries = webpage_texts
-            yield {"observation": "搜索页面加载超时, 请重试"}
+        if len(loaded_inds) == 0:
+            yield {"observation": WEBPAGE_LOAD_TIMEOUT_MESSAGE}
         else:
-            summary_prompts = self.make_summary_tasks(
-                query=arguments["query"],
-                webpage_texts=webpage_texts,
-                summary_prompt_template=self.summary_prompt_template,
-                tokenizer=tokenizer,
-                webpage_summary_max_input_tokens=self.webpage_summary_max_input_tokens,
+            # keep one summary per page so that citation numbers match url_infos
+            summaries = [NO_RELEVANT_CONTENT_MESSAGE] * len(webpage_texts)
+            summary_paths = [None] * len(webpage_texts)
+            loaded_texts = [webpage_texts[i] for i in loaded_inds]
+            loaded_num_tokens = [
+                len(tokenizer.encode(webpage_text, add_special_tokens=False))
+                for webpage_text in loaded_texts
+            ]
+            scores = score_webpages(
+                "; ".join(queries),
+                [webpage_detail_list[i] for i in loaded_inds],
+                loaded_texts,
+                loaded_num_tokens,
+            )
+            context_max_tokens = self.get_context_max_tokens(
+                user_question,
+                queries,
+                len(webpage_texts),
+                tokenizer,
+                observation_max_tokens,
+            )
+            # relevant pages get more room in the observation
+            output_budgets = allocate_tokens(
+                scores,
+                context_max_tokens,
+                caps=[
+                    min(num_tokens, self.webpage_summary_max_output_tokens)
+                    for num_tokens in loaded_num_tokens
+                ],
+                min_tokens=32,
+            )
+            summary_plans = plan_summaries(
+                query="; ".join(queries),
+                webpage_texts=loaded_texts,
+                webpage_num_tokens=loaded_num_tokens,
+                token_budgets=output_budgets,
+                raw_max_tokens=self.webpage_raw_max_tokens,
+                extractive_max_tokens=self.webpage_extractive_max_tokens,
+                llm_max_output_tokens=self.webpage_summary_max_output_tokens,
             )
-            response_message = llm_completion_funcion(messages=summary_prompts)
-            summaries = [choice.text for choice in response_message.choices]
+            llm_inds, llm_scores = [], []
+            num_llm_summaries_ready = 0
+            llm_num_tokens, llm_max_output_tokens = [], []
+            for i, summary_plan, score, num_tokens in zip(
+                loaded_inds, summary_plans, scores, loaded_num_tokens
+            ):
+                summary_paths[i] = summary_plan["path"]
+                if summary_plan["path"] == SUMMARY_PATH_SKIP:
+                    continue
+                if summary_plan["path"] == SUMMARY_PATH_LLM:
+                    llm_inds.append(i)
+                    llm_scores.append(score)
+                    llm_num_tokens.append(num_tokens)
+                    llm_max_output_tokens.append(summary_plan["max_output_tokens"])
+                elif summary_plan["path"] == SUMMARY_PATH_EXTRACTIVE:
+                    summaries[i] = extractive_summary(
+                        webpage_detail_list[i]["query"],
+                        webpage_texts[i],
+                        tokenizer,
+                        summary_plan["max_output_tokens"],
+                    )
+                else:
+                    summaries[i] = webpage_texts[i]
+            print(f"网页总结方式: {summary_paths}")
+
+            if len(llm_inds) > 0:
+                # the summary input of all pages is shared by relevance as well,
+                # a page may use up to twice the default input
+                input_budgets = allocate_tokens(
+                    llm_scores,
+                    self.webpage_summary_max_input_tokens * len(llm_inds),
+                    caps=[
+                        min(num_tokens, self.webpage_summary_max_input_tokens * 2)
+                        for num_tokens in llm_num_tokens
+                    ],
+                )
+                summary_prompts = self.make_summary_tasks(
+                    query=[webpage_detail_list[i]["query"] for i in llm_inds],
+                    webpage_texts=[webpage_texts[i] for i in llm_inds],
+                    summary_prompt_template=self.summary_prompt_template,
+                    tokenizer=tokenizer,
+                    webpage_summary_max_input_tokens=input_budgets,
+                )
+                with stage_timer.stage("summarize"):
+                    llm_summaries = self.summarize_webpages(
+                        summary_prompts,
+                        llm_max_output_tokens,
+                        llm_completion_funcion,
+                        deadline=deadline,
+                        min_done=math.ceil(self.summary_quorum * len(llm_inds)),
+                        cancel_token=cancel_token,
+                    )
+                if cancel_token is not None and cancel_token.cancelled:
+                    yield {"observation": SEARCH_CANCELLED_MESSAGE}
+                    return
+                for i, summary in zip(llm_inds, llm_summaries):
+                    # summaries not ready by the deadline or quorum are dropped
+                    if summary is not None:
+                        summaries[i] = summary
+                        num_llm_summaries_ready += 1
             context = "\n".join(
                 [
                     f"[[citation:{str(i+1)}]]\n{summary}"
                     for i, summary in enumerate(summaries)
                 ]
             )
+            trace = {
+                "deadline": self.observation_deadline,
+                "elapsed": round(time.time() - start, 3),
+                "deadline_hit": deadline is not None and time.time() > deadline,
+                "quorum": self.summary_quorum,
+                "num_pages": len(webpage_texts),
+                "fetch_deadline_hit": fetch_deadline_hit,
+                "num_llm_summaries": len(llm_inds),
+                "num_llm_summaries_ready": num_llm_summaries_ready,
+                "snippet_answers": snippet_answers,
+                "fast_path": False,
+                "citations_used": [
+                    i + 1
+                    for i, summary in enumerate(summaries)
+                    if summary != NO_RELEVANT_CONTENT_MESSAGE
+                ],
+            }
+            print(f"搜索耗时预算: {trace}")
             yield {
                 "observation": self.observation_prompt_template.format(
-                    context=context, question=user_question, keywords=arguments["query"]
-                )
+                    context=context, question=user_question, keywords="; ".join(queries)
+                ),
+                "summary_paths": summary_paths,
+                "trace": trace,
             }
         return
 
+    def get_snippet_answer_observation(
+        self,
+        user_question: str,
+        queries: List[str],
+        webpage_detail_list: List[Dict],
+        snippet_answers: Dict[str, Dict],
+        start: float,
+    ) -> Dict:
+        """
+        Build the observation from the answer box, knowledge graph and snippets
+        the search service returned instead of pages, they are short enough to
+        be used verbatim.
+        """
+        context = "\n".join(
+            [
+                f"[[citation:{str(i+1)}]]\n{webpage_detail['html_content']}"
+                for i, webpage_detail in enumerate(webpage_detail_list)
+            ]
+        )
+        trace = {
+            "deadline": self.observation_deadline,
+            "elapsed": round(time.time() - start, 3),
+            "deadline_hit": False,
+            "num_pages": len(webpage_detail_list),
+            "snippet_answers": snippet_answers,
+            "fast_path": True,
+            "citations_used": list(range(1, len(webpage_detail_list) + 1)),
+        }
+        print(f"搜索耗时预算: {trace}")
+        return {
+            "observation": self.observation_prompt_template.format(
+                context=context, question=user_question, keywords="; ".join(queries)
+            ),
+            "summary_paths": [SUMMARY_PATH_RAW] * len(webpage_detail_list),
+            "trace": trace,
+        }
+
+    def run_with_passage_index(
+        self,
+        user_question: str,
+        queries: List[str],
+        passage_index: PassageIndex,
+        return_webpage_details: bool,
+    ) -> Generator[Dict, None, None]:
+        """
+        Build the observation from the passages of already fetched pages,
+        without searching, loading or summarizing web pages.
+        """
+        max_chars = self.passage_index_max_context_chars // len(queries)
+        webpage_detail_list = []
+        links = set()
+        for query in queries:
+            for url_info, text in passage_index.retrieve_pages(
+                query, max_chars=max_chars
+            ):
+                if url_info["link"] in links:
+                    continue
+                links.add(url_info["link"])
+                webpage_detail = {
+                    "url_info": url_info,
+                    "html_content": text,
+                    "query": query,
+                    "source": "session_index",
+                }
+                webpage_detail_list.append(webpage_detail)
+                if return_webpage_details:
+                    yield webpage_detail
+        context = "\n".join(
+            [
+                f"[[citation:{str(i+1)}]]\n{webpage_detail['html_content']}"
+                for i, webpage_detail in enumerate(webpage_detail_list)
+            ]
+        )
+        yield {
+            "observation": self.observation_prompt_template.format(
+                context=context, question=user_question, keywords="; ".join(queries)
+            )
+        }
+
+    def get_context_max_tokens(
+        self,
+        user_question: str,
+        queries: List[str],
+        num_webpages: int,
+        tokenizer: "AutoTokenizer",
+        observation_max_tokens: Optional[int],
+    ) -> int:
+        """
+        Tokens left for the page summaries once the observation prompt and the
+        citation headers are in.
+        """
+        if observation_max_tokens is None:
+            observation_max_tokens = self.observation_max_tokens
+        observation_max_tokens = min(
+            observation_max_tokens, self.observation_max_tokens
+        )
+        prompt_tokens = len(
+            tokenizer.encode(
+                self.observation_prompt_template.format(
+                    context="", question=user_question, keywords="; ".join(queries)
+                ),
+                add_special_tokens=False,
+            )
+        )
+        citation_tokens = num_webpages * len(
+            tokenizer.encode(
+                f"[[citation:{num_webpages}]]\n\n", add_special_tokens=False
+            )
+        )
+        return max(0, observation_max_tokens - prompt_tokens - citation_tokens)
+
+    @staticmethod
+    def summarize_webpages(
+        summary_prompts: List[str],
+        max_output_tokens: List[int],
+        llm_completion_funcion: Callable,
+        deadline: Optional[float] = None,
+        min_done: Optional[int] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> List[Optional[str]]:
+        """
+        Summarize pages concurrently, each with its own max_tokens. There is no
+        batched summary call: every page is its own request, and the continuous
+        batching of the model server (vLLM) runs them as one batch, so a short
+        summary returns without waiting for the longest one.
+        Return as soon as min_done summaries are ready (all by default), the
+        deadline passes or the token is cancelled. Summaries not ready by then
+        are None and their requests are aborted.
+        """
+        # cancelled on return, aborts the summaries nobody waits for
+        summary_token = CancellationToken()
+        # completed when the request is cancelled, wakes up the wait below
+        cancelled = Future()
+
+        def summarize(summary_prompt: str, max_tokens: int) -> str:
+            kwargs = {"cancel_token": summary_token}
+            if deadline is not None:
+                kwargs["timeout"] = max(1.0, deadline - time.time())
+            try:
+                response_message = llm_completion_funcion(
+                    messages=[summary_prompt], max_tokens=max_tokens, **kwargs
+                )
+                return response_message.choices[0].text
+            except Exception as e:
+                print(e)
+                return NO_RELEVANT_CONTENT_MESSAGE
+
+        if len(summary_prompts) == 0:
+            return []
+        if min_done is None:
+            min_done = len(summary_prompts)
+        handle = None
+        if cancel_token is not None:
+            handle = cancel_token.add_callback(lambda: cancelled.set_result(None))
+        executor = ThreadPoolExecutor(max_workers=len(summary_prompts))
+        futures = []
+        try:
+            futures = [
+                executor.submit(summarize, summary_prompt, max_tokens)
+                for summary_prompt, max_tokens in zip(
+                    summary_prompts, max_output_tokens
+                )
+            ]
+            pending = set(futures)
+            while len(pending) > 0 and len(futures) - len(pending) < min_done:
+                timeout = None if deadline is None else deadline - time.time()
+                if (timeout is not None and timeout <= 0) or cancelled.done():
+                    break
+                _, pending = wait(
+                    pending | {cancelled}, timeout=timeout, return_when=FIRST_COMPLETED
+                )
+                pending.discard(cancelled)
+            return [
+                future.result() if future.done() and not cancelled.done() else None
+                for future in futures
+            ]
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(handle)
+            # do not wait for the dropped summaries, abort the running ones
+            num_skipped = sum(1 for future in futures if future.cancel())
+            if num_skipped > 0:
+                record_avoided_work("summaries_skipped", num_skipped)
+            summary_token.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def get_queries(arguments: Dict) -> List[str]:
+        """
+        Get the deduplicated search queries, `query` may be a string or a list.
+        """
+        query = arguments.get("query")
+        if isinstance(query, str):
+            query = [query]
+        elif not isinstance(query, list):
+            return []
+        queries = []
+        for q in query:
+            if isinstance(q, str) and q.strip() and q.strip() not in queries:
+                queries.append(q.strip())
+        return queries
+
     @staticmethod
     def make_summary_tasks(
-        query: str,
+        query: Union[str, List[str]],
         webpage_texts: List[str],
         summary_prompt_template: str,
-        tokenizer: AutoTokenizer,
-        webpage_summary_max_input_tokens: int = 2048,
+        tokenizer: "AutoTokenizer",
+        webpage_summary_max_input_tokens: Union[int, List[int]] = 2048,
     ) -> List[str]:
+        # one query for all pages, or the query each page was searched with
+        queries = [query] * len(webpage_texts) if isinstance(query, str) else query
+        # one input budget for all pages, or a budget per page
+        max_input_tokens = (
+            [webpage_summary_max_input_tokens] * len(webpage_texts)
+            if isinstance(webpage_summary_max_input_tokens, int)
+            else webpage_summary_max_input_tokens
+        )
         messages_all = []
-        for webpage_text in webpage_texts:
+        for query, webpage_text, max_tokens in zip(
+            queries, webpage_texts, max_input_tokens
+        ):
             if len(webpage_text) > 0:
                 webpage_tokens = tokenizer.encode(webpage_text)
-                webpage_text = tokenizer.decode(
-                    webpage_tokens[:webpage_summary_max_input_tokens]
-                )
+                webpage_text = tokenizer.decode(webpage_tokens[:max_tokens])
             messages = [
                 {"role": "system", "content": "You are a helpful assistant."},
                 {
@@ -154,16 +655,191 @@ class GoogleSearch(BaseAction):
 
     @staticmethod
     def streaming_fetch_search_results(
-        url: str, content: Dict, proxies: Dict
-    ) -> Generator[Dict, None, str]:
-        try:
-            with requests.post(
-                url, json=content, stream=True, proxies=proxies
-            ) as response:
-                response.raise_for_status()
-                for line in response.iter_lines():
-                    if line:
-                        yield json.loads(line)
-        except requests.exceptions.HTTPError as error:
+        url: str,
+        content: Dict,
+        proxies: Dict,
+        cancel_token: Optional[CancellationToken] = None,
+        client: Optional[SearchServiceClient] = None,
+    ) -> Generator[Dict, None, None]:
+        """
+        Long pages are received in chunks and joined, a page is cut to the
+        page_max_chars of content. An HTTP error of the search service is
+        raised, streaming_fetch_balanced_results retries it on another replica.
+        cancel_token: closes the stream, the search service stops loading the
+            pages of a closed stream.
+        client: pooled client with the timeouts of the search, the shared one
+            by default.
+        """
+        if client is None:
+            client = get_search_client()
+        records = client.stream(
+            url, {**content, "chunked_pages": True}, proxies, cancel_token=cancel_token
+        )
+        yield from assemble_pages(records, content.get("page_max_chars"))
+
+    @staticmethod
+    def streaming_fetch_balanced_results(
+        load_balancer: SearchLoadBalancer,
+        content: Dict,
+        proxies: Dict,
+        cancel_token: Optional[CancellationToken] = None,
+        max_attempts: int = 2,
+        client: Optional[SearchServiceClient] = None,
+    ) -> Generator[Dict, None, Optional[str]]:
+        """
+        Search on the replica chosen by the load balancer. If it fails, e.g. the
+        connection drops mid-stream, the search is continued on another replica,
+        the pages already received are excluded from it.
+        Once every attempt has failed an HTTP error ends the search with the
+        timeout text as the return value, other errors are raised.
+        """
+        seen_links = set()
+        tried_urls = []
+        error = None
+        for _ in range(max_attempts):
+            if cancel_token is not None and cancel_token.cancelled:
+                return
+            attempt_content = dict(content)
+            if len(seen_links) > 0:
+                attempt_content["exclude_links"] = sorted(seen_links)
+                if "num_search_pages" in content:
+                    attempt_content["num_search_pages"] = content[
+                        "num_search_pages"
+                    ] - len(seen_links)
+                    if attempt_content["num_search_pages"] <= 0:
+                        return
+            url = load_balancer.acquire(
+                cost=attempt_content.get("num_search_pages", 1), exclude=tried_urls
+            )
+            if url is None:
+                break
+            tried_urls.append(url)
+            failed = False
+            try:
+                for webpage_detail in GoogleSearch.streaming_fetch_search_results(
+                    url,
+                    attempt_content,
+                    proxies,
+                    cancel_token=cancel_token,
+                    client=client,
+                ):
+                    link = webpage_detail["url_info"]["link"]
+                    if link not in seen_links:
+                        seen_links.add(link)
+                        yield webpage_detail
+                return
+            except Exception as e:
+                failed = True
+                error = e
+                print(f"搜索服务 {url} 出错, 换一个副本重试: {e}")
+            finally:
+                load_balancer.release(url, failed=failed)
+        if isinstance(error, requests.exceptions.HTTPError):
             print(f"HTTP error occurred: {error}")
             return "网页加载超时"
+        if error is not None:
+            raise error
+        return None
+
+    @staticmethod
+    def streaming_fetch_multi_query_results(
+        url: str,
+        queries: List[str],
+        content: Dict,
+        proxies: Dict,
+        deadline: Optional[float] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        load_balancer: Optional[SearchLoadBalancer] = None,
+        max_search_attempts: int = 2,
+        client: Optional[SearchServiceClient] = None,
+    ) -> Generator[Dict, None, None]:
+        """
+        Search several queries concurrently and merge their streams.
+        Web pages are deduplicated by link across queries, each result is tagged
+        with the query that found it.
+        The stream ends at the deadline or when the token is cancelled, the
+        search streams still open are closed and their pages dropped.
+        With load_balancer the queries go to its replicas instead of url, see
+        streaming_fetch_balanced_results.
+        """
+
+        def search(query: str, token: Optional[CancellationToken]) -> Generator:
+            if load_balancer is None:
+                return GoogleSearch.streaming_fetch_search_results(
+                    url,
+                    {"query": query, **content},
+                    proxies,
+                    cancel_token=token,
+                    client=client,
+                )
+            return GoogleSearch.streaming_fetch_balanced_results(
+                load_balancer,
+                {"query": query, **content},
+                proxies,
+                cancel_token=token,
+                max_attempts=max_search_attempts,
+                client=client,
+            )
+
+        if len(queries) == 1 and deadline is None and cancel_token is None:
+            for webpage_detail in search(queries[0], None):
+                yield {**webpage_detail, "query": queries[0]}
+            return
+
+        done = object()
+        cancelled = object()
+        results = queue.Queue()
+        # set when the consumer stops early, the fetches close their streams
+        stopped = threading.Event()
+        # cancelled when the consumer stops, closes the streams still open
+        stream_token = CancellationToken()
+
+        def fetch(query: str) -> None:
+            webpage_details = search(query, stream_token)
+            try:
+                for webpage_detail in webpage_details:
+                    if stopped.is_set():
+                        break
+                    results.put({**webpage_detail, "query": query})
+            except Exception as e:
+                results.put(e)
+            finally:
+                webpage_details.close()
+                results.put(done)
+
+        seen_links = set()
+        errors = []
+        handle = None
+        if cancel_token is not None:
+            handle = cancel_token.add_callback(lambda: results.put(cancelled))
+        executor = ThreadPoolExecutor(max_workers=len(queries))
+        try:
+            for query in queries:
+                executor.submit(fetch, query)
+            num_running = len(queries)
+            while num_running > 0:
+                timeout = None if deadline is None else deadline - time.time()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = results.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is cancelled:
+                    break
+                if item is done:
+                    num_running -= 1
+                elif isinstance(item, Exception):
+                    errors.append(item)
+                elif item["url_info"]["link"] not in seen_links:
+                    seen_links.add(item["url_info"]["link"])
+                    yield item
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(handle)
+            stopped.set()
+            stream_token.cancel()
+            executor.shutdown(wait=False)
+        # fail only if every query failed
+        if num_running == 0 and len(errors) == len(queries):
+            raise errors[0]
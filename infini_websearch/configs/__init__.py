@@ -9,20 +9,43 @@ from infini_websearch.configs.prompt import (
 from infini_websearch.configs.server import (
     AGENT_MAX_OUTPUT_TOKENS,
     AGENT_TEMPERATURE,
+    BOT_CONCURRENCY_LIMIT,
     CHAT_MAX_OUTPUT_TOKENS,
     CHAT_TEMPERATURE,
     FUNCTION_END_TOKEN,
     FUNCTION_START_TOKEN,
     MAX_ACTION_TURNS,
+    MAX_SEARCH_ATTEMPTS,
     MODEL_NAME,
     MODEL_SERVER_URL,
+    MODEL_TARGET_LATENCY,
     NUM_SEARCH_WEBPAGES,
+    OBSERVATION_DEADLINE,
+    OBSERVATION_MAX_TOKENS,
     PROXIES,
+    SCHEDULER_CHAT_SLOTS,
+    SCHEDULER_SEARCH_SLOTS,
+    SEARCH_LOAD_POLL_INTERVAL,
+    SEARCH_MAX_QUEUE_DEPTH,
     SEARCH_SERVER_URL,
+    SEARCH_SERVER_URLS,
+    SESSION_IDLE_SECONDS,
+    SESSION_INDEX_MAX_CHARS,
+    SESSION_MAX_BYTES,
+    SESSION_MAX_IN_MEMORY,
     SESSION_MAX_INPUT_TOKENS,
+    SESSION_SPILL_DIR,
     SESSION_WINDOW_SIZE,
+    SNIPPET_ANSWER_THRESHOLD,
     STOP_TOKENS,
+    STREAM_BUFFER_SIZE,
+    STREAM_FLUSH_INTERVAL,
+    SUMMARY_QUORUM,
+    SUMMARY_RESERVE_SECONDS,
+    WEBPAGE_EXTRACTIVE_MAX_TOKENS,
     WEBPAGE_LOAD_TIMETOUT,
+    WEBPAGE_MAX_CHARS,
+    WEBPAGE_RAW_MAX_TOKENS,
     WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
     WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS,
 )
@@ -44,12 +67,35 @@ __all__ = [
     "MODEL_NAME",
     "MODEL_SERVER_URL",
     "NUM_SEARCH_WEBPAGES",
+    "OBSERVATION_MAX_TOKENS",
     "PROXIES",
     "SEARCH_SERVER_URL",
     "STOP_TOKENS",
     "WEBPAGE_LOAD_TIMETOUT",
     "WEBPAGE_SUMMARY_MAX_INPUT_TOKENS",
+    "SESSION_IDLE_SECONDS",
+    "SESSION_INDEX_MAX_CHARS",
+    "SESSION_MAX_BYTES",
+    "SESSION_MAX_IN_MEMORY",
     "SESSION_MAX_INPUT_TOKENS",
+    "SESSION_SPILL_DIR",
     "SESSION_WINDOW_SIZE",
     "WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS",
+    "WEBPAGE_RAW_MAX_TOKENS",
+    "WEBPAGE_EXTRACTIVE_MAX_TOKENS",
+    "BOT_CONCURRENCY_LIMIT",
+    "MODEL_TARGET_LATENCY",
+    "SCHEDULER_CHAT_SLOTS",
+    "SCHEDULER_SEARCH_SLOTS",
+    "SEARCH_LOAD_POLL_INTERVAL",
+    "SEARCH_MAX_QUEUE_DEPTH",
+    "OBSERVATION_DEADLINE",
+    "SUMMARY_QUORUM",
+    "SUMMARY_RESERVE_SECONDS",
+    "SNIPPET_ANSWER_THRESHOLD",
+    "SEARCH_SERVER_URLS",
+    "MAX_SEARCH_ATTEMPTS",
+    "STREAM_FLUSH_INTERVAL",
+    "STREAM_BUFFER_SIZE",
+    "WEBPAGE_MAX_CHARS",
 ]
@@ -1,10 +1,37 @@
 # gradio
 SESSION_WINDOW_SIZE = 2
+# max characters of fetched page text kept per session for follow-up questions
+SESSION_INDEX_MAX_CHARS = 200000
+# sessions idle longer than SESSION_IDLE_SECONDS, or beyond SESSION_MAX_IN_MEMORY,
+# are moved to SESSION_SPILL_DIR
+SESSION_SPILL_DIR = "sessions"
+SESSION_MAX_IN_MEMORY = 1000
+SESSION_MAX_BYTES = 512 * 1024
+SESSION_IDLE_SECONDS = 600
+# gradio worker threads, admission is done by the scheduler below
+BOT_CONCURRENCY_LIMIT = 64
+
+# admission control: (initial, min, max) concurrent turns per pool, limits shrink
+# when the model time to first token exceeds MODEL_TARGET_LATENCY or (search
+# turns only) the search service has more than SEARCH_MAX_QUEUE_DEPTH page loads
+SCHEDULER_CHAT_SLOTS = (4, 1, 16)
+SCHEDULER_SEARCH_SLOTS = (2, 1, 8)
+MODEL_TARGET_LATENCY = 2.0
+SEARCH_MAX_QUEUE_DEPTH = 20
+SEARCH_LOAD_POLL_INTERVAL = 2.0
 
 # websearch service
 SEARCH_SERVER_URL = "http://localhost:8021/search"
+# replicas of the search service, each search goes to the least loaded healthy one
+# and is continued on another one (up to MAX_SEARCH_ATTEMPTS) if it fails
+SEARCH_SERVER_URLS = [SEARCH_SERVER_URL]
+MAX_SEARCH_ATTEMPTS = 2
 NUM_SEARCH_WEBPAGES = 5
 WEBPAGE_LOAD_TIMETOUT = 10.0
+# text kept per page, enough for the largest summary input (twice
+# WEBPAGE_SUMMARY_MAX_INPUT_TOKENS) of english text, the search service sends
+# no more than this
+WEBPAGE_MAX_CHARS = 16000
 PROXIES = {
     "http": None,
     "https": None,
@@ -14,12 +41,30 @@ PROXIES = {
 # model
 MODEL_NAME = "megrez"
 MODEL_SERVER_URL = "http://localhost:8011/v1/"
+# streamed model output is yielded every STREAM_FLUSH_INTERVAL seconds, or once
+# STREAM_BUFFER_SIZE characters are buffered, whichever comes first
+STREAM_FLUSH_INTERVAL = 0.1
+STREAM_BUFFER_SIZE = 200
 STOP_TOKENS = ["<|turn_end|>"]
 FUNCTION_START_TOKEN, FUNCTION_END_TOKEN = "<|function_start|>", "<|function_end|>"
 MAX_ACTION_TURNS = 1
 
 WEBPAGE_SUMMARY_MAX_INPUT_TOKENS = 2048
 WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS = 512
+# shorter pages are used verbatim, longer ones (up to WEBPAGE_EXTRACTIVE_MAX_TOKENS)
+# get an extractive summary, the longest or densest ones are summarized by the model
+WEBPAGE_RAW_MAX_TOKENS = 256
+WEBPAGE_EXTRACTIVE_MAX_TOKENS = 1024
+OBSERVATION_MAX_TOKENS = 1536
+# seconds from the start of a search to its observation, the last
+# SUMMARY_RESERVE_SECONDS are kept for summarizing; the observation is built once
+# SUMMARY_QUORUM of the model summaries are ready or at the deadline
+OBSERVATION_DEADLINE = 6.0
+SUMMARY_RESERVE_SECONDS = 2.0
+SUMMARY_QUORUM = 0.6
+# searches whose answer box, knowledge graph or snippets score at least this are
+# answered from the serper response without loading pages, None disables it
+SNIPPET_ANSWER_THRESHOLD = 0.7
 SESSION_MAX_INPUT_TOKENS = 3072
 CHAT_TEMPERATURE = 0.4
 CHAT_MAX_OUTPUT_TOKENS = 2048
@@ -3,9 +3,12 @@ from infini_websearch.model.postprocessing import (
     include_special_tokens,
     split_text_by_special_token,
 )
+from infini_websearch.model.tokenizer import FastTokenizer, load_tokenizer
 
 __all__ = [
     "get_vllm_model_output_function",
     "include_special_tokens",
     "split_text_by_special_token",
+    "FastTokenizer",
+    "load_tokenizer",
 ]
@@ -1,7 +1,78 @@
+import threading
+import time
+from collections import deque
 from functools import partial
-from typing import Callable, Dict, Generator, List, Union
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-import openai
+from infini_websearch.utils.cancellation import (
+    CancellationToken,
+    RequestCancelled,
+    abort_httpx_response,
+    record_avoided_work,
+)
+
+if TYPE_CHECKING:
+    from openai.types import Completion
+
+# text after an unclosed '[' ('[citation:x]') or '<|' (special token) is held
+# back, unless it is longer than any citation or special token
+MAX_HELD_CHARS = 32
+
+# timings of recent streams, for tuning flush_interval and buffer_size:
+# first_token: request to the first model delta
+# first_flush: request to the first text yielded (what the user sees)
+# flush_gap: time between two yields (UI re-renders)
+# flush_chars, deltas_per_flush: size of the yields
+STREAM_STATS_WINDOW = 1000
+STREAM_STATS = {
+    name: deque(maxlen=STREAM_STATS_WINDOW)
+    for name in [
+        "first_token",
+        "first_flush",
+        "flush_gap",
+        "flush_chars",
+        "deltas_per_flush",
+    ]
+}
+STREAM_STATS_LOCK = threading.Lock()
+
+
+def record_stream_stats(values: Dict[str, List[float]]) -> None:
+    with STREAM_STATS_LOCK:
+        for name, name_values in values.items():
+            STREAM_STATS[name].extend(name_values)
+
+
+def get_stream_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Count, mean, median, p90 and max of each stream statistic.
+    """
+    with STREAM_STATS_LOCK:
+        values = {
+            name: sorted(name_values) for name, name_values in STREAM_STATS.items()
+        }
+    stats = {}
+    for name, name_values in values.items():
+        if len(name_values) == 0:
+            stats[name] = {"count": 0}
+            continue
+        stats[name] = {
+            "count": len(name_values),
+            "mean": round(sum(name_values) / len(name_values), 4),
+            "p50": round(name_values[len(name_values) // 2], 4),
+            "p90": round(name_values[int(len(name_values) * 0.9)], 4),
+            "max": round(name_values[-1], 4),
+        }
+    return stats
 
 
 def get_vllm_model_output_function(
@@ -10,12 +81,16 @@ def get_vllm_model_output_function(
     chat_mode: bool,
     model_config: Dict,
     stream: bool,
-    buffer_size: int = 20,
+    buffer_size: int = 200,
+    flush_interval: float = 0.1,
     timeout: int = 60,
 ) -> Callable:
     """
     Get model generate function: streaming/non-streaming
     """
+    # imported on first use, it is slow to import
+    import openai
+
     data = {
         "model": model_name,
         "stream": stream,
@@ -38,6 +113,7 @@ def get_vllm_model_output_function(
             model_config=data,
             chat_mode=chat_mode,
             buffer_size=buffer_size,
+            flush_interval=flush_interval,
             timeout=timeout,
         )
     else:
@@ -50,32 +126,110 @@ def get_vllm_model_output_function(
         )
 
 
+def abort_on_cancel(stream, cancel_token: CancellationToken) -> Optional[int]:
+    """
+    Abort the connection of a streamed request once the token is cancelled,
+    the model server aborts requests whose client has gone.
+    """
+
+    def abort() -> None:
+        record_avoided_work("model_requests_aborted")
+        abort_httpx_response(stream.response)
+
+    return cancel_token.add_callback(abort)
+
+
+def split_flushable(buffer: str) -> Tuple[str, str]:
+    """
+    Split the buffer into the text that can be yielded and the text held back
+    because it may be the start of a citation or special token.
+    """
+    cut = len(buffer)
+    if buffer.endswith("<"):
+        cut = len(buffer) - 1
+    for opening, closing in [("[", "]"), ("<|", "|>")]:
+        start = buffer.rfind(opening)
+        if (
+            start != -1
+            and buffer.find(closing, start) == -1
+            and len(buffer) - start <= MAX_HELD_CHARS
+        ):
+            cut = min(cut, start)
+    return buffer[:cut], buffer[cut:]
+
+
 def get_model_streaming_output(
     messages: List[Union[Dict, str]],
     model_config: Dict,
     llm_function: Callable,
     chat_mode: bool,
     buffer_size: int,
+    flush_interval: float,
     timeout: int,
+    cancel_token: Optional[CancellationToken] = None,
 ) -> Generator[str, None, None]:
+    """
+    Model deltas are coalesced, the text is yielded once flush_interval has
+    passed since the last yield or buffer_size characters are buffered,
+    whichever comes first (checked as deltas arrive). The first text is
+    yielded as soon as it arrives.
+    cancel_token: aborts the request, the output ends where it was cut off.
+    """
     if chat_mode is True:
         model_config["messages"] = messages
     else:
         model_config["prompt"] = messages
     buffer = ""
-    for chunk in llm_function(**model_config, timeout=timeout):
-        if chunk.choices[0].delta.content:
-            buffer += chunk.choices[0].delta.content
-            if len(buffer) >= buffer_size:
-                # '[citation:x]' has been truncated?
-                if buffer.rfind("]") < buffer.rfind("["):
-                    yield buffer[: buffer.rfind("[")]
-                    buffer = buffer[buffer.rfind("[") :]  # noqa: E203
-                else:
-                    yield buffer
-                    buffer = ""
-    if buffer:
-        yield buffer
+    start = time.time()
+    last_flush = None
+    num_deltas = 0
+    stats = {name: [] for name in STREAM_STATS}
+
+    def flush(text: str, now: float) -> str:
+        nonlocal last_flush, num_deltas
+        if last_flush is None:
+            stats["first_flush"].append(now - start)
+        else:
+            stats["flush_gap"].append(now - last_flush)
+        stats["flush_chars"].append(len(text))
+        stats["deltas_per_flush"].append(num_deltas)
+        last_flush = now
+        num_deltas = 0
+        return text
+
+    stream = llm_function(**model_config, timeout=timeout)
+    handle = None if cancel_token is None else abort_on_cancel(stream, cancel_token)
+    try:
+        try:
+            for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                now = time.time()
+                if len(stats["first_token"]) == 0:
+                    stats["first_token"].append(now - start)
+                buffer += chunk.choices[0].delta.content
+                num_deltas += 1
+                if (
+                    last_flush is None
+                    or now - last_flush >= flush_interval
+                    or len(buffer) >= buffer_size
+                ):
+                    text, buffer = split_flushable(buffer)
+                    if text:
+                        yield flush(text, now)
+        except Exception:
+            # reading a connection aborted by the cancellation fails
+            if cancel_token is None or not cancel_token.cancelled:
+                raise
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(handle)
+            stream.close()
+        if buffer:
+            yield flush(buffer, time.time())
+    finally:
+        # also for streams closed early by the consumer
+        record_stream_stats(stats)
 
 
 def get_model_output(
@@ -84,10 +238,49 @@ def get_model_output(
     llm_function: Callable,
     chat_mode: bool,
     timeout: int,
+    cancel_token: Optional[CancellationToken] = None,
+    **kwargs,
 ) -> str:
+    """
+    kwargs override model_config for this request only, e.g. max_tokens.
+    cancel_token: aborts the request and raises RequestCancelled, completions
+        (not chat) requests only.
+    """
+    # do not modify the shared model_config, requests may run concurrently
+    model_config = {**model_config, **kwargs}
     if chat_mode is True:
         model_config["messages"] = messages
     else:
         model_config["prompt"] = messages
-    response = llm_function(**model_config, timeout=timeout)
-    return response
+    if cancel_token is None or chat_mode is True:
+        return llm_function(**model_config, timeout=timeout)
+
+    # streamed, a blocking request can not be aborted by another thread
+    if cancel_token.cancelled:
+        raise RequestCancelled("request cancelled before it was sent")
+    model_config["stream"] = True
+    chunks = []
+    stream = llm_function(**model_config, timeout=timeout)
+    handle = abort_on_cancel(stream, cancel_token)
+    try:
+        for chunk in stream:
+            chunks.append(chunk)
+    except Exception:
+        if not cancel_token.cancelled:
+            raise
+    finally:
+        aborted = not cancel_token.remove_callback(handle)
+        stream.close()
+    if aborted:
+        raise RequestCancelled("request cancelled")
+    return merge_completion_chunks(chunks)
+
+
+def merge_completion_chunks(chunks: List) -> "Completion":
+    """
+    Merge the chunks of a streamed completion into one completion.
+    """
+    text = "".join(chunk.choices[0].text for chunk in chunks if chunk.choices)
+    last_chunk = chunks[-1]
+    choice = last_chunk.choices[0].model_copy(update={"text": text})
+    return last_chunk.model_copy(update={"choices": [choice]})
@@ -0,0 +1,88 @@
+import json
+import os
+from typing import TYPE_CHECKING, Dict, List, Union
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+SPECIAL_TOKEN_NAMES = ["bos_token", "eos_token", "unk_token", "pad_token"]
+
+
+def raise_exception(message: str) -> None:
+    raise ValueError(message)
+
+
+def get_chat_template(config: Dict) -> str:
+    """
+    The chat template of tokenizer_config.json, the "default" one if it holds a
+    list of named templates, like transformers uses without a template name.
+    """
+    chat_template = config["chat_template"]
+    if isinstance(chat_template, list):
+        templates = {item["name"]: item["template"] for item in chat_template}
+        return templates["default"]
+    return chat_template
+
+
+class FastTokenizer:
+    """
+    Tokenizer loaded from tokenizer.json by the `tokenizers` library, with the
+    chat template of tokenizer_config.json rendered by jinja2 the same way as
+    transformers does. Loading it does not import transformers or torch.
+    """
+
+    def __init__(self, model_path: str) -> None:
+        from jinja2.sandbox import ImmutableSandboxedEnvironment
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        with open(
+            os.path.join(model_path, "tokenizer_config.json"), "r", encoding="utf-8"
+        ) as f:
+            config = json.load(f)
+        self.special_tokens = {}
+        for name in SPECIAL_TOKEN_NAMES:
+            token = config.get(name)
+            # tokens may be saved as AddedToken dicts
+            if isinstance(token, dict):
+                token = token.get("content")
+            if token is not None:
+                self.special_tokens[name] = token
+        env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True)
+        env.globals["raise_exception"] = raise_exception
+        self.chat_template = env.from_string(get_chat_template(config))
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+    def decode(self, token_ids: List[int], skip_special_tokens: bool = False) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=skip_special_tokens)
+
+    def apply_chat_template(
+        self,
+        messages: List[Dict],
+        tokenize: bool = True,
+        add_generation_prompt: bool = False,
+    ) -> Union[str, List[int]]:
+        prompt = self.chat_template.render(
+            messages=messages,
+            add_generation_prompt=add_generation_prompt,
+            **self.special_tokens,
+        )
+        if tokenize:
+            return self.encode(prompt, add_special_tokens=False)
+        return prompt
+
+
+def load_tokenizer(model_path: str) -> Union[FastTokenizer, "AutoTokenizer"]:
+    """
+    Load the fast tokenizer.json tokenizer, or the transformers tokenizer if the
+    model has no tokenizer.json or chat template.
+    """
+    try:
+        return FastTokenizer(model_path)
+    except (OSError, KeyError, ImportError) as e:
+        print(f"加载tokenizer.json失败, 使用AutoTokenizer: {e}")
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
@@ -0,0 +1,130 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+# key length, payload length
+RECORD_HEADER = struct.Struct("<II")
+
+SERPER_KEY_PREFIX = "serper:"
+PAGE_KEY_PREFIX = "page:"
+
+
+class SearchArchive:
+    """
+    Append-only archive of serper responses and extracted pages, for replaying
+    identical inputs across runs.
+
+    Each record is a header (key length, payload length), the utf-8 key and the
+    zlib-compressed json payload. Keys are stored uncompressed so that the
+    offset index (key -> offset of its latest record) is built by skipping from
+    header to header over the memory-mapped file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.index: Dict[str, int] = {}
+        self.mmap: Optional[mmap.mmap] = None
+        self.num_bytes = 0
+        open(path, "ab").close()
+        self.remap()
+        # drop a record cut off by a crash, new records are appended after it
+        if os.path.getsize(path) > self.num_bytes:
+            print(f"存档末尾记录不完整, 截断到 {self.num_bytes} 字节")
+            os.truncate(path, self.num_bytes)
+
+    def remap(self) -> None:
+        """
+        Map the records written so far and index the new ones.
+        """
+        with self.lock:
+            num_bytes = os.path.getsize(self.path)
+            if num_bytes == 0 or num_bytes == self.num_bytes:
+                return
+            with open(self.path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = self.num_bytes
+            while offset + RECORD_HEADER.size <= num_bytes:
+                key_length, payload_length = RECORD_HEADER.unpack_from(data, offset)
+                end = offset + RECORD_HEADER.size + key_length + payload_length
+                # a record cut off by a crash
+                if end > num_bytes:
+                    break
+                key_start = offset + RECORD_HEADER.size
+                key = data[key_start : key_start + key_length]  # noqa: E203
+                self.index[key.decode("utf-8")] = offset
+                offset = end
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = data
+            self.num_bytes = offset
+
+    def append(self, key: str, record: Dict) -> None:
+        key_bytes = key.encode("utf-8")
+        payload = zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        with self.lock:
+            with open(self.path, "ab") as f:
+                f.write(RECORD_HEADER.pack(len(key_bytes), len(payload)))
+                f.write(key_bytes)
+                f.write(payload)
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self.lock:
+            offset = self.index.get(key)
+            if offset is None:
+                return None
+            key_length, payload_length = RECORD_HEADER.unpack_from(self.mmap, offset)
+            start = offset + RECORD_HEADER.size + key_length
+            payload = self.mmap[start : start + payload_length]  # noqa: E203
+        return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+    def record_serper(
+        self, query: str, status_code: int, response, latency: float
+    ) -> None:
+        self.append(
+            SERPER_KEY_PREFIX + query,
+            {
+                "query": query,
+                "status_code": status_code,
+                "response": response,
+                "latency": latency,
+                "recorded_at": time.time(),
+            },
+        )
+
+    def record_page(
+        self, link: str, content: str, partial: bool, latency: float
+    ) -> None:
+        self.append(
+            PAGE_KEY_PREFIX + link,
+            {
+                "link": link,
+                "content": content,
+                "partial": partial,
+                "latency": latency,
+                "recorded_at": time.time(),
+            },
+        )
+
+    def get_serper(self, query: str) -> Optional[Dict]:
+        return self.get(SERPER_KEY_PREFIX + query)
+
+    def get_page(self, link: str) -> Optional[Dict]:
+        return self.get(PAGE_KEY_PREFIX + link)
+
+    def stats(self) -> Dict:
+        self.remap()
+        with self.lock:
+            keys = list(self.index)
+        return {
+            "num_bytes": os.path.getsize(self.path),
+            "num_serper_responses": len(
+                [key for key in keys if key.startswith(SERPER_KEY_PREFIX)]
+            ),
+            "num_pages": len([key for key in keys if key.startswith(PAGE_KEY_PREFIX)]),
+        }
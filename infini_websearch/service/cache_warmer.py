@@ -0,0 +1,206 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from infini_websearch.service.rate_limiter import AdaptiveRateLimiter, RateLimitTimeout
+from infini_websearch.utils.cancellation import CancellationToken
+
+
+class QueryTracker:
+    """
+    Frequency of the queries of live searches, decayed with a half-life so
+    that the hot topics of the moment rank first.
+    """
+
+    def __init__(self, half_life: float = 3600.0, max_queries: int = 10000) -> None:
+        self.half_life = half_life
+        self.max_queries = max_queries
+        self.lock = threading.Lock()
+        # query -> (score, updated_at, num_search_pages)
+        self.queries: Dict[str, Tuple[float, float, int]] = {}
+
+    def decayed(self, score: float, updated_at: float, now: float) -> float:
+        return score * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def record(self, query: str, num_search_pages: int) -> None:
+        now = time.time()
+        with self.lock:
+            score, updated_at, pages = self.queries.get(query, (0.0, now, 0))
+            self.queries[query] = (
+                self.decayed(score, updated_at, now) + 1.0,
+                now,
+                max(pages, num_search_pages),
+            )
+            if len(self.queries) > self.max_queries:
+                # drop the coldest quarter at once instead of one per search
+                ranked = sorted(
+                    self.queries.items(),
+                    key=lambda item: self.decayed(item[1][0], item[1][1], now),
+                    reverse=True,
+                )
+                self.queries = dict(ranked[: self.max_queries * 3 // 4])
+
+    def top(self, num_queries: int, min_score: float) -> List[Tuple[str, int]]:
+        """
+        (query, num_search_pages) of the most frequent queries scoring at least
+        min_score.
+        """
+        now = time.time()
+        with self.lock:
+            scores = [
+                (self.decayed(score, updated_at, now), query, pages)
+                for query, (score, updated_at, pages) in self.queries.items()
+            ]
+        scores = sorted((item for item in scores if item[0] >= min_score), reverse=True)
+        return [(query, pages) for _, query, pages in scores[:num_queries]]
+
+    def __len__(self) -> int:
+        return len(self.queries)
+
+
+class CacheWarmer:
+    """
+    Background thread refreshing the cached serper results and pages of the
+    most frequent queries before they expire, so that their searches are
+    served from the cache.
+
+    It works only while is_idle() (no live searches, spare browsers), a live
+    search cancels the refresh in progress (yield_to_live), and it spends at
+    most serper_budget serper requests per hour.
+    refresh(query, num_search_pages, cancel_token) searches the query and loads
+    its pages into the cache, expires_in(query) is the remaining time of its
+    cached serper results, None if it has none.
+    """
+
+    def __init__(
+        self,
+        tracker: QueryTracker,
+        refresh: Callable[[str, int, CancellationToken], bool],
+        expires_in: Callable[[str], Optional[float]],
+        is_idle: Callable[[], bool],
+        serper_budget: float,
+        num_queries: int = 100,
+        min_score: float = 2.0,
+        refresh_ahead: float = 60.0,
+        interval: float = 5.0,
+    ) -> None:
+        self.tracker = tracker
+        self.refresh = refresh
+        self.expires_in = expires_in
+        self.is_idle = is_idle
+        self.num_queries = num_queries
+        self.min_score = min_score
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        # an hour of budget, up to a tenth of it spent at once
+        self.budget = AdaptiveRateLimiter(
+            serper_budget / 3600, burst=max(1, int(serper_budget / 10)), max_wait=0.0
+        )
+        self.lock = threading.Lock()
+        self.cancel_token: Optional[CancellationToken] = None
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        # last refresh of each query, a failing query is not retried every round
+        self.last_attempts: Dict[str, float] = {}
+        self.num_refreshed = 0
+        self.num_failed = 0
+        self.num_yielded = 0
+        self.num_busy_rounds = 0
+        self.num_over_budget = 0
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.yield_to_live()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"缓存预热失败: {e}")
+
+    def yield_to_live(self) -> None:
+        """
+        Cancel the refresh in progress, its page loads are stopped.
+        """
+        with self.lock:
+            cancel_token = self.cancel_token
+        if cancel_token is not None and not cancel_token.cancelled:
+            cancel_token.cancel()
+            with self.lock:
+                self.num_yielded += 1
+
+    def get_due_queries(self) -> List[Tuple[str, int]]:
+        """
+        Hot queries whose cached results expire within refresh_ahead, or have
+        expired, hottest first.
+        """
+        now = time.time()
+        due = []
+        for query, num_search_pages in self.tracker.top(
+            self.num_queries, self.min_score
+        ):
+            expires_in = self.expires_in(query)
+            if expires_in is not None and expires_in > self.refresh_ahead:
+                continue
+            if now - self.last_attempts.get(query, 0.0) < self.refresh_ahead:
+                continue
+            due.append((query, num_search_pages))
+        return due
+
+    def run_once(self) -> int:
+        """
+        Refresh the due queries while the service is idle, return how many.
+        """
+        num_refreshed = 0
+        for query, num_search_pages in self.get_due_queries():
+            if self.stop_event.is_set():
+                break
+            if not self.is_idle():
+                self.num_busy_rounds += 1
+                break
+            try:
+                self.budget.acquire(max_wait=0.0)
+            except RateLimitTimeout:
+                self.num_over_budget += 1
+                break
+            self.last_attempts[query] = time.time()
+            cancel_token = CancellationToken()
+            with self.lock:
+                self.cancel_token = cancel_token
+            try:
+                refreshed = self.refresh(query, num_search_pages, cancel_token)
+            finally:
+                with self.lock:
+                    self.cancel_token = None
+            if cancel_token.cancelled:
+                break
+            if refreshed:
+                num_refreshed += 1
+                self.num_refreshed += 1
+            else:
+                self.num_failed += 1
+        # forget the attempts of queries no longer due
+        self.last_attempts = {
+            query: attempt
+            for query, attempt in self.last_attempts.items()
+            if time.time() - attempt < self.refresh_ahead
+        }
+        return num_refreshed
+
+    def stats(self) -> Dict:
+        budget = self.budget.stats()
+        return {
+            "tracked_queries": len(self.tracker),
+            "refreshed": self.num_refreshed,
+            "failed": self.num_failed,
+            "yielded_to_live": self.num_yielded,
+            "busy_rounds": self.num_busy_rounds,
+            "over_budget": self.num_over_budget,
+            "serper_budget_per_hour": round(budget["max_rate"] * 3600, 1),
+            "serper_requests": budget["requests"],
+        }
@@ -0,0 +1,384 @@
+import math
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from infini_websearch.utils.retrieval import (
+    tokenize_for_retrieval,
+    tokenize_query_words,
+)
+
+
+def encode_varints(numbers: List[int]) -> bytes:
+    data = bytearray()
+    for number in numbers:
+        while number >= 0x80:
+            data.append((number & 0x7F) | 0x80)
+            number >>= 7
+        data.append(number)
+    return bytes(data)
+
+
+def decode_varints(data: bytes) -> List[int]:
+    numbers, number, shift = [], 0, 0
+    for byte in data:
+        number |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(number)
+            number, shift = 0, 0
+    return numbers
+
+
+def encode_postings(postings: List[Tuple[int, int]]) -> bytes:
+    numbers, last_doc_id = [], 0
+    for doc_id, tf in postings:
+        numbers.extend([doc_id - last_doc_id, tf])
+        last_doc_id = doc_id
+    return encode_varints(numbers)
+
+
+def decode_postings(data: bytes) -> List[Tuple[int, int]]:
+    """
+    Postings are stored as varints of (doc id delta, term frequency) pairs.
+    """
+    numbers = decode_varints(data)
+    postings, doc_id = [], 0
+    for i in range(0, len(numbers), 2):
+        doc_id += numbers[i]
+        postings.append((doc_id, numbers[i + 1]))
+    return postings
+
+
+class LocalCorpus:
+    """
+    Disk-backed inverted index of extracted web pages shared by all requests
+    and service processes (sqlite in WAL mode).
+
+    Page text is stored zlib-compressed, postings are delta + varint encoded
+    and only ever appended to: a re-fetched page gets a new doc id and the
+    postings of its old id are dropped lazily at query time, and for good by
+    purge(), which also deletes old documents. The document frequency of a
+    term counts live documents only.
+
+    A query is answered only by documents containing every query word (all
+    terms of the word) with a BM25 score of at least min_term_score per query
+    term. Terms whose postings exceed max_posting_bytes are in so many
+    documents that they are treated as stop words, and not decoded.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        k1: float = 1.2,
+        b: float = 0.75,
+        min_term_score: float = 1.0,
+        max_posting_bytes: int = 64 * 1024,
+    ) -> None:
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.min_term_score = min_term_score
+        self.max_posting_bytes = max_posting_bytes
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, link TEXT UNIQUE, "
+                "title TEXT, snippet TEXT, content BLOB, length INTEGER, "
+                "fetched_at REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term TEXT PRIMARY KEY, data BLOB, last_doc_id INTEGER, df INTEGER)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(postings)")}
+            if "df" not in columns:
+                # corpora indexed before df was kept, the postings length is used
+                # until the next purge
+                conn.execute("ALTER TABLE postings ADD COLUMN df INTEGER")
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self.local.conn = conn
+        return conn
+
+    def add(self, url_info: Dict, content: str) -> None:
+        terms = Counter(tokenize_for_retrieval(content))
+        if len(terms) == 0:
+            return
+        with self.write_lock, self.connection() as conn:
+            old = conn.execute(
+                "SELECT content FROM documents WHERE link = ?", (url_info["link"],)
+            ).fetchone()
+            if old is not None:
+                # the old doc id stays in the postings until the next purge,
+                # it no longer counts towards the document frequency
+                old_terms = set(
+                    tokenize_for_retrieval(zlib.decompress(old[0]).decode("utf-8"))
+                )
+                conn.executemany(
+                    "UPDATE postings SET df = df - 1 WHERE term = ? AND df > 0",
+                    [(term,) for term in old_terms],
+                )
+                conn.execute(
+                    "DELETE FROM documents WHERE link = ?", (url_info["link"],)
+                )
+            cursor = conn.execute(
+                "INSERT INTO documents "
+                "(link, title, snippet, content, length, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    url_info["link"],
+                    url_info.get("title", ""),
+                    url_info.get("snippet", ""),
+                    zlib.compress(content.encode("utf-8")),
+                    sum(terms.values()),
+                    time.time(),
+                ),
+            )
+            doc_id = cursor.lastrowid
+            for term, tf in terms.items():
+                row = conn.execute(
+                    "SELECT data, last_doc_id FROM postings WHERE term = ?", (term,)
+                ).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO postings (term, data, last_doc_id, df) "
+                        "VALUES (?, ?, ?, 1)",
+                        (term, encode_varints([doc_id, tf]), doc_id),
+                    )
+                else:
+                    data, last_doc_id = row
+                    conn.execute(
+                        "UPDATE postings SET data = ?, last_doc_id = ?, df = df + 1 "
+                        "WHERE term = ?",
+                        (
+                            data + encode_varints([doc_id - last_doc_id, tf]),
+                            doc_id,
+                            term,
+                        ),
+                    )
+
+    def search(
+        self, query: str, num_docs: int, max_age: Optional[float] = None
+    ) -> List[Tuple[Dict, str]]:
+        """
+        Return (url_info, content) of the top num_docs fresh documents by BM25.
+        Return nothing unless num_docs documents each contain every query word
+        and score high enough, so that uncovered topics go to live search.
+        The postings of the rarest terms are decoded first, the search stops
+        as soon as fewer than num_docs documents are left.
+        """
+        words = tokenize_query_words(query)
+        terms = {term for word in words for term in word}
+        if len(terms) == 0:
+            return []
+        conn = self.connection()
+        num_total, total_length = conn.execute(
+            "SELECT COUNT(*), SUM(length) FROM documents"
+        ).fetchone()
+        if num_total < num_docs or num_total == 0:
+            return []
+        avg_length = total_length / num_total
+
+        rows = {}
+        for term in terms:
+            row = conn.execute(
+                "SELECT data, df FROM postings WHERE term = ?", (term,)
+            ).fetchone()
+            # a query word missing from every document
+            if row is None:
+                return []
+            rows[term] = row
+        # too common to be worth decoding, and to weigh in the coverage
+        search_terms = sorted(
+            (term for term in terms if len(rows[term][0]) <= self.max_posting_bytes),
+            key=lambda term: len(rows[term][0]),
+        )
+        if len(search_terms) == 0:
+            return []
+
+        term_postings = {}
+        candidate_ids = None
+        for term in search_terms:
+            term_postings[term] = dict(decode_postings(rows[term][0]))
+            if candidate_ids is None:
+                candidate_ids = set(term_postings[term])
+            else:
+                candidate_ids &= term_postings[term].keys()
+            if len(candidate_ids) < num_docs:
+                return []
+
+        min_fetched_at = 0.0 if max_age is None else time.time() - max_age
+        docs = {}
+        candidate_ids = list(candidate_ids)
+        # stay below the sqlite variable limit
+        for i in range(0, len(candidate_ids), 500):
+            batch = candidate_ids[i : i + 500]  # noqa: E203
+            rows_batch = conn.execute(
+                "SELECT id, length FROM documents WHERE fetched_at >= ? AND id IN "
+                f"({', '.join('?' * len(batch))})",
+                (min_fetched_at, *batch),
+            ).fetchall()
+            docs.update(dict(rows_batch))
+        # deleted, re-fetched or stale documents
+        if len(docs) < num_docs:
+            return []
+
+        scores = dict.fromkeys(docs, 0.0)
+        for term in search_terms:
+            postings = term_postings[term]
+            df = rows[term][1]
+            if df is None:
+                df = len(postings)
+            df = min(max(df, 1), num_total)
+            idf = math.log(1 + (num_total - df + 0.5) / (df + 0.5))
+            for doc_id in docs:
+                tf = postings[doc_id]
+                norm = self.k1 * (1 - self.b + self.b * docs[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        min_score = self.min_term_score * len(search_terms)
+        ranked = [
+            doc_id
+            for doc_id in sorted(scores, key=scores.get, reverse=True)
+            if scores[doc_id] >= min_score
+        ][:num_docs]
+        if len(ranked) < num_docs:
+            return []
+
+        results = []
+        for doc_id in ranked:
+            link, title, snippet, content = conn.execute(
+                "SELECT link, title, snippet, content FROM documents WHERE id = ?",
+                (doc_id,),
+            ).fetchone()
+            url_info = {"title": title, "link": link, "snippet": snippet}
+            results.append((url_info, zlib.decompress(content).decode("utf-8")))
+        return results
+
+    def purge(self, max_age: float, max_documents: Optional[int] = None) -> int:
+        """
+        Delete the documents fetched more than max_age seconds ago, and the
+        oldest ones beyond max_documents, then rewrite the postings without the
+        doc ids of deleted and re-fetched documents.
+        Return the number of deleted documents.
+        """
+        with self.write_lock, self.connection() as conn:
+            cursor = conn.execute(
+                "DELETE FROM documents WHERE fetched_at < ?", (time.time() - max_age,)
+            )
+            num_deleted = cursor.rowcount
+            if max_documents is not None:
+                cursor = conn.execute(
+                    "DELETE FROM documents WHERE id NOT IN "
+                    "(SELECT id FROM documents ORDER BY fetched_at DESC LIMIT ?)",
+                    (max_documents,),
+                )
+                num_deleted += cursor.rowcount
+            doc_ids = {row[0] for row in conn.execute("SELECT id FROM documents")}
+            for term, data in conn.execute(
+                "SELECT term, data FROM postings"
+            ).fetchall():
+                postings = decode_postings(data)
+                live_postings = [
+                    (doc_id, tf) for doc_id, tf in postings if doc_id in doc_ids
+                ]
+                if len(live_postings) == 0:
+                    conn.execute("DELETE FROM postings WHERE term = ?", (term,))
+                elif len(live_postings) < len(postings):
+                    conn.execute(
+                        "UPDATE postings SET data = ?, last_doc_id = ?, df = ? "
+                        "WHERE term = ?",
+                        (
+                            encode_postings(live_postings),
+                            live_postings[-1][0],
+                            len(live_postings),
+                            term,
+                        ),
+                    )
+                else:
+                    # df of corpora indexed before it was kept
+                    conn.execute(
+                        "UPDATE postings SET df = ? WHERE term = ? AND df IS NULL",
+                        (len(live_postings), term),
+                    )
+        return num_deleted
+
+
+class CorpusIndexer:
+    """
+    Background thread adding pages to a LocalCorpus, so that indexing does not
+    delay the search responses the pages are sent in. Pages arriving while
+    max_pending pages wait are dropped. Every purge_interval seconds documents
+    older than max_age (and beyond max_documents) are purged.
+    """
+
+    def __init__(
+        self,
+        corpus: LocalCorpus,
+        max_age: float,
+        max_documents: Optional[int] = None,
+        max_pending: int = 1000,
+        purge_interval: float = 3600.0,
+    ) -> None:
+        self.corpus = corpus
+        self.max_age = max_age
+        self.max_documents = max_documents
+        self.purge_interval = purge_interval
+        self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.last_purge = 0.0
+        self.num_indexed = 0
+        self.num_dropped = 0
+        self.num_purged = 0
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, url_info: Dict, content: str) -> bool:
+        try:
+            self.pending.put_nowait((url_info, content))
+            return True
+        except queue.Full:
+            self.num_dropped += 1
+            return False
+
+    def run(self) -> None:
+        while True:
+            if time.time() - self.last_purge > self.purge_interval:
+                self.last_purge = time.time()
+                try:
+                    self.num_purged += self.corpus.purge(
+                        self.max_age, self.max_documents
+                    )
+                except Exception as e:
+                    print(f"清理本地语料失败: {e}")
+            try:
+                url_info, content = self.pending.get(timeout=self.purge_interval)
+            except queue.Empty:
+                continue
+            try:
+                self.corpus.add(url_info, content)
+                self.num_indexed += 1
+            except Exception as e:
+                print(f"写入本地语料失败: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "pending": self.pending.qsize(),
+            "indexed": self.num_indexed,
+            "dropped": self.num_dropped,
+            "purged": self.num_purged,
+        }
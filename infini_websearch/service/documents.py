@@ -0,0 +1,300 @@
+import importlib.util
+import io
+import re
+import time
+import zipfile
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+
+import requests
+
+from infini_websearch.utils.cancellation import (
+    CancellationToken,
+    abort_requests_response,
+)
+
+DOCUMENT_TYPES = {
+    ".pdf": "pdf",
+    ".docx": "docx",
+    ".pptx": "pptx",
+}
+CONTENT_TYPES = {
+    "application/pdf": "pdf",
+    "application/x-pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": "pptx",
+}
+HTML_CONTENT_TYPES = {"text/html", "application/xhtml+xml"}
+# links without an extension which often serve a pdf, e.g. arxiv.org/pdf/xxxx
+PDF_LINK_PATTERN = re.compile(r"[/=.]pdf\b", re.IGNORECASE)
+# pdf links are left to the browser where pypdf (see requirements.txt) is missing
+PDF_READER_AVAILABLE = importlib.util.find_spec("pypdf") is not None
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DRAWING_NAMESPACE = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# a guessed link turning out to be a web page is read from its body, unless
+# its text is shorter than this (rendered by scripts), then chrome loads it
+MIN_HTML_TEXT_CHARS = 100
+HTML_SKIPPED_TAGS = {"head", "script", "style", "noscript", "template", "svg"}
+# a line break before and after these
+HTML_BLOCK_TAGS = set(
+    "address article aside blockquote br dd div dl dt figcaption footer h1 h2 h3 "
+    "h4 h5 h6 header hr li main nav ol p pre section table td th tr ul".split()
+)
+META_CHARSET_PATTERN = re.compile(rb"<meta[^>]+charset=[\"']?([\w-]+)", re.IGNORECASE)
+
+
+def guess_document_type(url: str) -> Optional[str]:
+    """
+    Guess from the link whether it points to a document (not a web page),
+    the content type of the response decides.
+    """
+    path = urlparse(url).path.lower()
+    for extension, document_type in DOCUMENT_TYPES.items():
+        if path.endswith(extension):
+            return document_type
+    if PDF_LINK_PATTERN.search(url):
+        return "pdf"
+    return None
+
+
+def get_document_type(content_type: str) -> Optional[str]:
+    """
+    "pdf", "docx" or "pptx", "html" for a web page, None for anything else.
+    """
+    mime_type = content_type.split(";")[0].strip().lower()
+    if mime_type in HTML_CONTENT_TYPES:
+        return "html"
+    return CONTENT_TYPES.get(mime_type)
+
+
+def download_document(
+    response: requests.Response, max_bytes: int, deadline: float
+) -> Tuple[bytes, bool]:
+    """
+    Read the body up to max_bytes or the deadline.
+    Return the body and whether it has been cut off.
+    """
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes or time.time() >= deadline:
+            return b"".join(chunks)[:max_bytes], True
+    return b"".join(chunks), False
+
+
+def extract_pdf_text(data: bytes, max_pages: int, max_chars: int) -> Tuple[str, bool]:
+    """
+    Extract the text of the first pages until max_chars.
+    Return the text and whether pages have been left out.
+    """
+    # optional dependency, imported on first use
+    from pypdf import PdfReader
+
+    # non-strict, a cut off file is parsed as far as it goes
+    reader = PdfReader(io.BytesIO(data), strict=False)
+    texts = []
+    num_chars = 0
+    num_pages = len(reader.pages)
+    for i in range(min(num_pages, max_pages)):
+        text = reader.pages[i].extract_text() or ""
+        texts.append(text)
+        num_chars += len(text)
+        if num_chars >= max_chars:
+            return "\n".join(texts)[:max_chars], True
+    return "\n".join(texts), num_pages > max_pages
+
+
+class HTMLTextParser(HTMLParser):
+    """
+    Visible text of an html page, a line per block element.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.texts: List[str] = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag: str, attrs: List) -> None:
+        if tag in HTML_SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self.texts.append("\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in HTML_SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in HTML_BLOCK_TAGS:
+            self.texts.append("\n")
+
+    def handle_data(self, data: str) -> None:
+        if self.skip_depth == 0:
+            self.texts.append(data)
+
+    def get_text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self.texts).split("\n"))
+        return "\n".join(line for line in lines if line)
+
+
+def decode_html(data: bytes, response: requests.Response) -> str:
+    """
+    Decode with the charset of the headers, or of the meta tag, utf-8 otherwise.
+    """
+    encoding = None
+    if "charset" in response.headers.get("Content-Type", "").lower():
+        encoding = response.encoding
+    else:
+        match = META_CHARSET_PATTERN.search(data[:4096])
+        if match is not None:
+            encoding = match.group(1).decode("ascii")
+    try:
+        return data.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
+def extract_html_text(data: str, max_pages: int, max_chars: int) -> Tuple[str, bool]:
+    parser = HTMLTextParser()
+    parser.feed(data)
+    parser.close()
+    text = parser.get_text()
+    return text[:max_chars], len(text) > max_chars
+
+
+def read_paragraphs(
+    xml_file, paragraph_tag: str, text_tag: str, max_chars: int
+) -> Tuple[List[str], bool]:
+    """
+    Paragraph texts of an office xml part, parsed incrementally until max_chars.
+    """
+    paragraphs = []
+    texts = []
+    num_chars = 0
+    for _, element in ElementTree.iterparse(xml_file, events=("end",)):
+        if element.tag == text_tag and element.text:
+            texts.append(element.text)
+        elif element.tag == paragraph_tag:
+            if texts:
+                paragraph = "".join(texts)
+                paragraphs.append(paragraph)
+                num_chars += len(paragraph) + 1
+                texts = []
+            element.clear()
+            if num_chars >= max_chars:
+                return paragraphs, True
+    return paragraphs, False
+
+
+def extract_docx_text(data: bytes, max_pages: int, max_chars: int) -> Tuple[str, bool]:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        with archive.open("word/document.xml") as xml_file:
+            paragraphs, truncated = read_paragraphs(
+                xml_file, f"{WORD_NAMESPACE}p", f"{WORD_NAMESPACE}t", max_chars
+            )
+    return "\n".join(paragraphs)[:max_chars], truncated
+
+
+def extract_pptx_text(data: bytes, max_pages: int, max_chars: int) -> Tuple[str, bool]:
+    """
+    Slides are pages.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        slide_names = sorted(
+            (
+                name
+                for name in archive.namelist()
+                if re.fullmatch(r"ppt/slides/slide\d+\.xml", name)
+            ),
+            key=lambda name: int(re.search(r"(\d+)\.xml$", name).group(1)),
+        )
+        slides = []
+        num_chars = 0
+        for name in slide_names[:max_pages]:
+            with archive.open(name) as xml_file:
+                paragraphs, truncated = read_paragraphs(
+                    xml_file,
+                    f"{DRAWING_NAMESPACE}p",
+                    f"{DRAWING_NAMESPACE}t",
+                    max_chars - num_chars,
+                )
+            slides.append("\n".join(paragraphs))
+            num_chars += len(slides[-1]) + 1
+            if truncated or num_chars >= max_chars:
+                return "\n".join(slides)[:max_chars], True
+    return "\n".join(slides), len(slide_names) > max_pages
+
+
+EXTRACTORS = {
+    "pdf": extract_pdf_text,
+    "docx": extract_docx_text,
+    "pptx": extract_pptx_text,
+    "html": extract_html_text,
+}
+
+
+def get_document_content(
+    url: str,
+    timeout: float,
+    max_bytes: int,
+    max_pages: int,
+    max_chars: int,
+    cancel_token: Optional[CancellationToken] = None,
+    proxies: Optional[Dict] = None,
+) -> Optional[Tuple[str, bool, str]]:
+    """
+    Download a document and extract the text of its first pages, without a
+    browser. Only the first max_bytes are downloaded and only the first
+    max_pages (until max_chars) are parsed.
+    A link turning out to be a web page is not downloaded again by the browser,
+    the text of the body already received is used, unless it has too little
+    (the page is rendered by scripts).
+    Return (text, partial, document type), or None if the link is left to the
+    browser: an error response, another content type, a page rendered by
+    scripts, or a pdf without pypdf installed.
+    proxies: of the download, like the other fetches of the service.
+    """
+    if guess_document_type(url) == "pdf" and not PDF_READER_AVAILABLE:
+        return None
+    deadline = time.time() + timeout
+    try:
+        response = requests.get(url, stream=True, timeout=timeout, proxies=proxies)
+    except Exception as e:
+        print(f"下载文档失败: {e}")
+        return None
+    with response:
+        document_type = get_document_type(response.headers.get("Content-Type", ""))
+        if not response.ok or document_type is None:
+            return None
+        if document_type == "pdf" and not PDF_READER_AVAILABLE:
+            return None
+        handle = None
+        if cancel_token is not None:
+            handle = cancel_token.add_callback(
+                lambda: abort_requests_response(response)
+            )
+        try:
+            data, cut_off = download_document(response, max_bytes, deadline)
+        except Exception as e:
+            # reading fails once the download is aborted by the cancellation
+            if cancel_token is None or not cancel_token.cancelled:
+                print(f"下载文档失败: {e}")
+            return "", False, document_type
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(handle)
+        if document_type == "html":
+            data = decode_html(data, response)
+    try:
+        text, truncated = EXTRACTORS[document_type](data, max_pages, max_chars)
+    except Exception as e:
+        print(f"解析文档失败: {e}")
+        return "", cut_off, document_type
+    if document_type == "html" and len(text.strip()) < MIN_HTML_TEXT_CHARS:
+        return None
+    return text, cut_off or truncated, document_type
@@ -0,0 +1,219 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN = "closed", "open", "half_open"
+
+
+def get_domain(url: str) -> str:
+    netloc = urlparse(url).netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return netloc
+
+
+class DomainHealthTracker:
+    """
+    Per-domain health of page fetches with a circuit breaker.
+
+    Each domain keeps EWMAs of load latency, failure rate (timeouts without
+    content, driver errors) and empty-content rate (captcha walls, blocked
+    headless chrome). A domain whose failure or empty rate crosses the
+    threshold is opened and skipped; after `open_seconds` one request is let
+    through as a half-open probe, which closes the circuit on success and
+    reopens it (with a doubled cool-down) on failure. A probe that is not
+    recorded (e.g. cancelled) must be released, one that is neither recorded
+    nor released within `probe_timeout` is given up.
+    """
+
+    def __init__(
+        self,
+        state_path: Optional[str] = None,
+        alpha: float = 0.3,
+        failure_threshold: float = 0.6,
+        degraded_threshold: float = 0.3,
+        min_samples: int = 3,
+        open_seconds: float = 300.0,
+        max_open_seconds: float = 3600.0,
+        default_latency: float = 3.0,
+        save_interval: float = 30.0,
+        probe_timeout: float = 120.0,
+    ) -> None:
+        self.state_path = state_path
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.degraded_threshold = degraded_threshold
+        self.min_samples = min_samples
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.default_latency = default_latency
+        self.save_interval = save_interval
+        self.probe_timeout = probe_timeout
+        self.domains: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.last_save = time.time()
+        self.load()
+
+    def new_stats(self) -> Dict:
+        return {
+            "latency": self.default_latency,
+            "failure_rate": 0.0,
+            "empty_rate": 0.0,
+            "samples": 0,
+            "state": CIRCUIT_CLOSED,
+            "opened_at": 0.0,
+            "open_seconds": self.open_seconds,
+            "probe_in_flight": False,
+            "probe_started_at": 0.0,
+        }
+
+    def allow(self, domain: str) -> bool:
+        """
+        Whether a page of this domain may be fetched now.
+        Moves an open circuit to half-open once its cool-down has passed.
+        """
+        with self.lock:
+            stats = self.domains.get(domain)
+            if stats is None or stats["state"] == CIRCUIT_CLOSED:
+                return True
+            if stats["state"] == CIRCUIT_OPEN:
+                if time.time() - stats["opened_at"] < stats["open_seconds"]:
+                    return False
+                stats["state"] = CIRCUIT_HALF_OPEN
+                stats["probe_in_flight"] = False
+            # half-open: only one probe at a time
+            if (
+                stats["probe_in_flight"]
+                and time.time() - stats["probe_started_at"] < self.probe_timeout
+            ):
+                return False
+            stats["probe_in_flight"] = True
+            stats["probe_started_at"] = time.time()
+            return True
+
+    def release_probe(self, domain: str) -> None:
+        """
+        The page allowed by allow() was not fetched, or its outcome says nothing
+        about the domain (cancelled), let the next request probe the domain.
+        """
+        with self.lock:
+            stats = self.domains.get(domain)
+            if stats is not None and stats["state"] == CIRCUIT_HALF_OPEN:
+                stats["probe_in_flight"] = False
+
+    def record(self, domain: str, latency: float, failed: bool, empty: bool) -> None:
+        with self.lock:
+            stats = self.domains.setdefault(domain, self.new_stats())
+            alpha = self.alpha
+            stats["latency"] = (1 - alpha) * stats["latency"] + alpha * latency
+            stats["failure_rate"] = (1 - alpha) * stats["failure_rate"] + alpha * failed
+            stats["empty_rate"] = (1 - alpha) * stats["empty_rate"] + alpha * empty
+            stats["samples"] += 1
+
+            if stats["state"] == CIRCUIT_HALF_OPEN:
+                stats["probe_in_flight"] = False
+                if failed or empty:
+                    stats["state"] = CIRCUIT_OPEN
+                    stats["opened_at"] = time.time()
+                    stats["open_seconds"] = min(
+                        stats["open_seconds"] * 2, self.max_open_seconds
+                    )
+                else:
+                    stats["state"] = CIRCUIT_CLOSED
+                    stats["open_seconds"] = self.open_seconds
+                    stats["failure_rate"], stats["empty_rate"] = 0.0, 0.0
+            elif (
+                stats["state"] == CIRCUIT_CLOSED
+                and stats["samples"] >= self.min_samples
+                and max(stats["failure_rate"], stats["empty_rate"])
+                >= self.failure_threshold
+            ):
+                print(f"熔断域名: {domain}")
+                stats["state"] = CIRCUIT_OPEN
+                stats["opened_at"] = time.time()
+        self.maybe_save()
+
+    def expected_cost(self, domain: str) -> float:
+        """
+        Expected seconds until useful content, failures and empty pages count extra.
+        """
+        stats = self.domains.get(domain)
+        if stats is None:
+            return self.default_latency
+        return stats["latency"] * (1.0 + stats["failure_rate"] + stats["empty_rate"])
+
+    def is_degraded(self, domain: str) -> bool:
+        stats = self.domains.get(domain)
+        if stats is None:
+            return False
+        return (
+            max(stats["failure_rate"], stats["empty_rate"]) >= self.degraded_threshold
+        )
+
+    def select(self, url_infos: List[Dict], num_pages: int) -> List[Dict]:
+        """
+        Choose up to num_pages results to fetch and order them fast-first.
+        Open domains are skipped and replaced by later results, degraded domains
+        are only used when there are not enough healthy ones.
+        """
+        healthy, degraded = [], []
+        for url_info in url_infos:
+            domain = get_domain(url_info["link"])
+            if self.is_degraded(domain):
+                degraded.append(url_info)
+            else:
+                healthy.append(url_info)
+        selected = []
+        for url_info in healthy + degraded:
+            if len(selected) >= num_pages:
+                break
+            if self.allow(get_domain(url_info["link"])):
+                selected.append(url_info)
+        return sorted(
+            selected,
+            key=lambda url_info: self.expected_cost(get_domain(url_info["link"])),
+        )
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self.lock:
+            return {domain: dict(stats) for domain, stats in self.domains.items()}
+
+    def load(self) -> None:
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                domains = json.load(f)
+        except Exception as e:
+            print(f"读取域名健康状态失败: {e}")
+            return
+        for domain, stats in domains.items():
+            # a probe cannot survive a restart
+            stats["probe_in_flight"] = False
+            self.domains[domain] = {**self.new_stats(), **stats}
+
+    def save(self) -> None:
+        if self.state_path is None:
+            return
+        domains = self.snapshot()
+        tmp_path = self.state_path + ".tmp"
+        with self.save_lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(domains, f, ensure_ascii=False)
+                os.replace(tmp_path, self.state_path)
+            except Exception as e:
+                print(f"保存域名健康状态失败: {e}")
+            self.last_save = time.time()
+
+    def maybe_save(self) -> None:
+        if time.time() - self.last_save < self.save_interval:
+            return
+        # another thread is already saving
+        if self.save_lock.locked():
+            return
+        self.save()
@@ -0,0 +1,62 @@
+import json
+from typing import Dict, Generator, List, Optional, Tuple
+
+
+def truncate_utf8(text: str, max_bytes: int) -> Tuple[str, bool]:
+    """
+    Cut text to at most max_bytes of utf-8, on a character boundary.
+    Return the text and whether it has been cut.
+    """
+    # a character is at most 4 bytes, shorter texts fit without encoding them
+    if len(text) * 4 <= max_bytes:
+        return text, False
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text, False
+    # the character cut in half at the end is dropped
+    return data[:max_bytes].decode("utf-8", errors="ignore"), True
+
+
+def split_utf8(text: str, chunk_bytes: int) -> List[str]:
+    """
+    Split text into chunks of at most chunk_bytes of utf-8, on character boundaries.
+    """
+    data = text.encode("utf-8")
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(len(data), start + chunk_bytes)
+        # back off to the first byte of a character
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        chunks.append(data[start:end].decode("utf-8"))
+        start = end
+    return chunks
+
+
+def make_page_records(
+    record: Dict, content: str, chunk_bytes: Optional[int] = None
+) -> Generator[str, None, None]:
+    """
+    NDJSON lines of one page of a search stream. A page is one record with its
+    content in html_content, or, with chunk_bytes and a longer content, a first
+    record with the fields of record and the first chunk, followed by records
+    with only the link and the next chunks. Chunk records carry the index of
+    the chunk and whether more chunks follow.
+    """
+    chunks = [content] if chunk_bytes is None else split_utf8(content, chunk_bytes)
+    if len(chunks) <= 1:
+        yield json.dumps({**record, "html_content": content}, ensure_ascii=False) + "\n"
+        return
+    url_info = {"link": record["url_info"]["link"]}
+    for i, chunk in enumerate(chunks):
+        fields = record if i == 0 else {"url_info": url_info}
+        yield json.dumps(
+            {
+                **fields,
+                "html_content": chunk,
+                "chunk": i,
+                "more_chunks": i < len(chunks) - 1,
+            },
+            ensure_ascii=False,
+        ) + "\n"
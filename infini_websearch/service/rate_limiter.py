@@ -0,0 +1,160 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header, in seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket of an upstream API shared by all requests of the process.
+
+    Requests reserve the next free slot in arrival order (GCRA), up to burst
+    requests pass at once, then one every 1 / rate seconds. A request whose
+    slot is more than max_wait away is rejected instead of queued.
+    The rate adapts with AIMD: a rate limited response (429) halves it, down
+    to min_rate, and pauses the bucket for its Retry-After, every success
+    raises it by increase_step (default max_rate / 20), up to max_rate.
+    A pause releases the slots of the waiting requests, they reserve again
+    after it, in the order of their old slots.
+    """
+
+    def __init__(
+        self,
+        max_rate: float,
+        burst: int,
+        min_rate: float = 0.5,
+        increase_step: Optional[float] = None,
+        max_wait: float = 3.0,
+        default_retry_after: float = 1.0,
+    ) -> None:
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase_step = max_rate / 20 if increase_step is None else increase_step
+        self.max_wait = max_wait
+        self.default_retry_after = default_retry_after
+        self.lock = threading.Lock()
+        # theoretical arrival time of the next request
+        self.next_arrival = 0.0
+        self.paused_until = 0.0
+        # incremented by every pause, slots reserved before it are released
+        self.epoch = 0
+        self.num_requests = 0
+        self.num_delayed = 0
+        self.num_rejected = 0
+        self.num_rate_limited = 0
+        self.num_waiting = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+
+    def reserve(self, now: float, max_wait: float) -> Optional[float]:
+        """
+        Reserve a slot, return the time to wait for it, None if it is too far.
+        """
+        interval = 1.0 / self.rate
+        arrival = max(self.next_arrival, now, self.paused_until)
+        start = max(now, self.paused_until, arrival - (self.burst - 1) * interval)
+        wait = start - now
+        if wait > max_wait:
+            return None
+        self.next_arrival = arrival + interval
+        return wait
+
+    def acquire(self, max_wait: Optional[float] = None) -> float:
+        """
+        Wait for a slot, return the time waited. Raise RateLimitTimeout if the
+        bucket has no slot within max_wait (default self.max_wait).
+        """
+        if max_wait is None:
+            max_wait = self.max_wait
+        start = time.time()
+        waited = 0.0
+        with self.lock:
+            self.num_waiting += 1
+        try:
+            while True:
+                now = time.time()
+                with self.lock:
+                    wait = self.reserve(now, max(0.0, max_wait - (now - start)))
+                    epoch = self.epoch
+                    if wait is None:
+                        self.num_rejected += 1
+                        raise RateLimitTimeout(
+                            f"rate limited, no slot within {max_wait:.1f}s"
+                        )
+                if wait > 0:
+                    time.sleep(wait)
+                # paused by a rate limited response while waiting, the slot has
+                # been released, queue again
+                with self.lock:
+                    if self.epoch == epoch:
+                        break
+            waited = time.time() - start
+            with self.lock:
+                self.num_requests += 1
+                if waited > 0.001:
+                    self.num_delayed += 1
+                self.total_wait += waited
+                self.longest_wait = max(self.longest_wait, waited)
+            return waited
+        finally:
+            with self.lock:
+                self.num_waiting -= 1
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def record_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        if retry_after is None:
+            retry_after = self.default_retry_after
+        with self.lock:
+            self.num_rate_limited += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.paused_until = max(self.paused_until, time.time() + retry_after)
+            # the slots of the waiting requests are released, and there is no
+            # burst right after the pause, one request per interval
+            self.epoch += 1
+            self.next_arrival = self.paused_until + (self.burst - 1) / self.rate
+
+    def stats(self) -> Dict:
+        """
+        utilization: share of the burst already reserved, 1 means requests queue.
+        """
+        now = time.time()
+        with self.lock:
+            backlog = max(0.0, self.next_arrival - now)
+            return {
+                "rate": round(self.rate, 3),
+                "max_rate": self.max_rate,
+                "utilization": round(min(1.0, backlog * self.rate / self.burst), 3),
+                "paused_for": round(max(0.0, self.paused_until - now), 3),
+                "waiting": self.num_waiting,
+                "requests": self.num_requests,
+                "delayed": self.num_delayed,
+                "rejected": self.num_rejected,
+                "rate_limited": self.num_rate_limited,
+                "mean_wait": round(self.total_wait / max(1, self.num_requests), 4),
+                "longest_wait": round(self.longest_wait, 4),
+            }
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    In-memory cache shared by all requests of the search service. An entry
+    expires ttl seconds after it was stored, the least recently used entries
+    are evicted beyond max_entries, or beyond max_size of the entry sizes.
+    """
+
+    def __init__(self, max_entries: int, max_size: Optional[int] = None) -> None:
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key -> (value, expires_at, size), least recently used first
+        self.entries: "OrderedDict[Hashable, Tuple[Any, float, int]]" = OrderedDict()
+        self.size = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evicted = 0
+
+    def get(self, key: Hashable, min_remaining: float = 0.0) -> Optional[Any]:
+        """
+        The value of key, None if it is missing or expires within min_remaining
+        seconds.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] - time.time() <= min_remaining:
+                self.num_misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.num_hits += 1
+            return entry[0]
+
+    def expires_in(self, key: Hashable) -> Optional[float]:
+        """
+        Seconds until key expires (negative once expired), None if it is missing.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry[1] - time.time()
+
+    def put(self, key: Hashable, value: Any, ttl: float, size: int = 1) -> None:
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (value, time.time() + ttl, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or (
+                self.max_size is not None and self.size > self.max_size
+            ):
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.num_evicted += 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            num_total = self.num_hits + self.num_misses
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "evicted": self.num_evicted,
+                "hit_ratio": self.num_hits / num_total if num_total else 0.0,
+            }
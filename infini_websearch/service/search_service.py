@@ -1,34 +1,225 @@
 import argparse
+import asyncio
 import json
 import os
+import random
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, Generator, Optional, Tuple, Union
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Generator, Optional, Tuple, Union
 
 import requests
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
+
+from infini_websearch.configs import PROXIES
+from infini_websearch.service.archive import SearchArchive
+from infini_websearch.service.cache_warmer import CacheWarmer, QueryTracker
+from infini_websearch.service.corpus import CorpusIndexer, LocalCorpus
+from infini_websearch.service.documents import get_document_content, guess_document_type
+from infini_websearch.service.domain_health import DomainHealthTracker, get_domain
+from infini_websearch.service.page_chunks import make_page_records, truncate_utf8
+from infini_websearch.service.rate_limiter import (
+    AdaptiveRateLimiter,
+    RateLimitTimeout,
+    parse_retry_after,
+)
+from infini_websearch.service.search_cache import TTLCache
+from infini_websearch.service.single_flight import SingleFlight
+from infini_websearch.utils.cancellation import (
+    CancellationToken,
+    get_avoided_work,
+    record_avoided_work,
+    stream_until_disconnected,
+)
+from infini_websearch.utils.retrieval import is_time_sensitive
+from infini_websearch.utils.snippets import get_snippet_documents, score_snippet_answer
+
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--chrome", type=str)
 parser.add_argument("--chromedriver", type=str)
 parser.add_argument("--port", type=int)
+parser.add_argument("--domain-health-path", type=str, default="domain_health.json")
+# empty path disables the local corpus
+parser.add_argument("--corpus-path", type=str, default="corpus.db")
+parser.add_argument("--corpus-max-age", type=float, default=7 * 24 * 3600)
+# documents older than --corpus-max-age, and the oldest beyond this, are purged
+parser.add_argument("--corpus-max-documents", type=int, default=100000)
+# record serper responses and loaded pages to an archive, or serve /search from one
+parser.add_argument("--record", type=str, default="")
+parser.add_argument("--replay", type=str, default="")
+# replayed latencies are the recorded ones times this scale, 0 replays instantly
+parser.add_argument("--replay-latency-scale", type=float, default=1.0)
+# concurrent page loads (chrome instances) the replica is sized for, /load reports
+# the utilization against it for client-side load balancing
+parser.add_argument("--browser-capacity", type=int, default=16)
+# serper requests per second (adapted down on 429), burst, and the longest a
+# request is queued before it fails
+parser.add_argument("--serper-rate", type=float, default=10.0)
+parser.add_argument("--serper-burst", type=int, default=20)
+parser.add_argument("--serper-max-wait", type=float, default=3.0)
+# seconds serper results and loaded pages are cached for (0 disables the cache),
+# shorter for time sensitive queries
+parser.add_argument("--search-cache-ttl", type=float, default=1800.0)
+parser.add_argument("--time-sensitive-cache-ttl", type=float, default=300.0)
+# serper requests per hour the cache warmer may spend refreshing the most frequent
+# queries while the service is idle, 0 disables it
+parser.add_argument("--warm-serper-budget", type=float, default=200.0)
+parser.add_argument("--warm-num-queries", type=int, default=100)
+
+
+@lru_cache(maxsize=None)
+def get_args() -> argparse.Namespace:
+    """
+    Arguments of the service, unknown ones (e.g. of a benchmark importing this
+    module) are ignored.
+    """
+    args, _ = parser.parse_known_args()
+    if args.record and args.replay:
+        parser.error("--record and --replay can not be used together")
+    return args
 
-args = parser.parse_args()
 
 app = FastAPI()
 
+# state of the service, built from the arguments by init_service() on startup so
+# that importing the module has no side effects (no files are created)
+DOMAIN_HEALTH: Optional[DomainHealthTracker] = None
+CORPUS: Optional[LocalCorpus] = None
+# pages are indexed in the background, not between the pages of a response
+CORPUS_INDEXER: Optional[CorpusIndexer] = None
+ARCHIVE: Optional[SearchArchive] = None
+
 SERPER_API_KEY = os.environ.get("SERPER_API_KEY")
 
+# concurrent identical serper queries and page loads share one upstream call
+SERPER_FLIGHTS = SingleFlight()
+PAGE_LOAD_FLIGHTS = SingleFlight()
+# bursts of serper requests are queued instead of being rate limited by serper
+SERPER_RATE_LIMITER: Optional[AdaptiveRateLimiter] = None
+SERPER_MAX_ATTEMPTS = 3
+# rate limited requests are retried after a random delay of up to this, doubled
+# per attempt, so that they do not come back at once
+SERPER_RETRY_BACKOFF = 0.5
+
+WEBPAGE_LOAD_TIMEOUT_MESSAGE = "搜索页面加载超时, 请重试"
+# total time budget for loading all pages of one request (seconds)
+DEFAULT_PAGE_LOAD_BUDGET = 10.0
+# a page always gets at least this long, even when the budget is nearly spent
+MIN_PAGE_LOAD_TIMEOUT = 2.0
+# time reserved for stopping the page and harvesting innerText
+CONTENT_HARVEST_MARGIN = 0.5
+# pages with less text than this are most likely captcha walls or blocked
+MIN_CONTENT_CHARS = 100
+
+# searches answered from the serper response alone, reported by /metrics
+SNIPPET_ANSWER_STATS = {"checked": 0, "fast_path": 0}
+
+# pdf and office results are downloaded and parsed instead of loaded by chrome,
+# only the first pages are parsed, enough to fill the summary budget
+DOCUMENT_MAX_BYTES = 16 * 1024 * 1024
+DOCUMENT_MAX_PAGES = 20
+DOCUMENT_MAX_CHARS = 16000
+# links guessed to be documents, by whether they were, reported by /metrics:
+# parsed documents, web pages read from the body already downloaded, and links
+# left to chrome
+DOCUMENT_STATS = {"extracted": 0, "html_bodies": 0, "web_pages": 0}
+
+# text kept per page (utf-8), longer pages are cut when their text is extracted
+PAGE_MAX_BYTES = 256 * 1024
+# clients reading chunked pages get longer pages in records of this size
+PAGE_CHUNK_BYTES = 32 * 1024
+# pages cut to PAGE_MAX_BYTES, to the page_max_chars of the client, and pages
+# sent in chunks, reported by /metrics
+PAGE_STATS = {"capped": 0, "cut_to_client_budget": 0, "chunked": 0}
+
+# in-flight work, reported by /load
+SERVICE_LOAD = {"active_requests": 0, "active_fetches": 0}
+SERVICE_LOAD_LOCK = threading.Lock()
+
+# serper results by query and page texts by link, not used when recording,
+# None while the cache is disabled
+SERPER_CACHE: Optional[TTLCache] = None
+# sized by the utf-8 bytes of the page texts
+PAGE_CACHE: Optional[TTLCache] = None
+# the warmer refreshes queries searched at least WARM_MIN_SCORE times (decayed
+# with a half-life of an hour) whose results expire within WARM_REFRESH_AHEAD,
+# while no live search runs and at most WARM_MAX_UTILIZATION of the browsers
+# and the serper rate are in use
+WARM_MIN_SCORE = 2.0
+WARM_REFRESH_AHEAD = 60.0
+WARM_INTERVAL = 5.0
+WARM_MAX_UTILIZATION = 0.5
+QUERY_TRACKER = QueryTracker()
+# links indexed within the cache ttl, pages served from the page cache are not
+# indexed again
+RECENTLY_INDEXED = TTLCache(max_entries=10000)
+
+
+def update_service_load(key: str, delta: int) -> None:
+    with SERVICE_LOAD_LOCK:
+        SERVICE_LOAD[key] += delta
+
+
+def get_page_load_timeout(deadline: Optional[float], max_timeout: float) -> float:
+    """
+    Get the page load timeout from the remaining time of the request deadline.
+    """
+    if deadline is None:
+        return max_timeout
+    remaining = deadline - time.time() - CONTENT_HARVEST_MARGIN
+    return max(MIN_PAGE_LOAD_TIMEOUT, min(max_timeout, remaining))
+
 
-def get_webpage_content(url: str, chrome_path: str, chromedriver_path: str) -> str:
+def get_inner_text(driver: "webdriver.Chrome", max_chars: int) -> str:
+    """
+    Text of the current page, cut in the browser so that a huge page is never
+    copied out of it whole.
+    """
+    return driver.execute_script(
+        "return document.body ? document.body.innerText.slice(0, arguments[0]) : '';",
+        max_chars,
+    )
+
+
+def harvest_webpage_content(driver: "webdriver.Chrome", max_chars: int) -> str:
+    """
+    Stop loading the current page and return the text already in the DOM.
+    """
+    try:
+        driver.execute_script("window.stop();")
+    except Exception as e:
+        print(e)
+    return get_inner_text(driver, max_chars)
+
+
+def get_webpage_content(
+    url: str,
+    chrome_path: str,
+    chromedriver_path: str,
+    deadline: Optional[float] = None,
+    max_timeout: float = DEFAULT_PAGE_LOAD_BUDGET,
+    cancel_token: Optional[CancellationToken] = None,
+) -> Tuple[str, bool]:
     """
     Load the content of web pages by chromedriver.
+    Return the page text and whether the page was only partially loaded.
+    cancel_token: the page is not loaded, or its browser is closed mid-load.
     """
+    if cancel_token is not None and cancel_token.cancelled:
+        record_avoided_work("page_loads_skipped")
+        return "", False
+    # selenium is slow to import, it is imported on first use (or by warm_up)
+    from selenium import webdriver
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
     options = Options()
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
@@ -57,24 +248,45 @@ def get_webpage_content(url: str, chrome_path: str, chromedriver_path: str) -> s
     options.add_experimental_option("prefs", prefs)
     service = Service(executable_path=chromedriver_path)
     driver = webdriver.Chrome(options=options, service=service)
+    handle = None
+    if cancel_token is not None:
+
+        def close_browser() -> None:
+            record_avoided_work("browsers_closed")
+            driver.quit()
+
+        handle = cancel_token.add_callback(close_browser)
     try:
-        timeout = 10
+        # the driver start-up time counts against the request deadline
+        timeout = get_page_load_timeout(deadline, max_timeout)
         start = time.time()
         driver.set_page_load_timeout(timeout)
         try:
             driver.get(url)
         except TimeoutException:
-            print(f"页面加载超时（{timeout}秒）")
-            return "搜索页面加载超时, 请重试"
+            print(f"页面加载超时（{timeout:.1f}秒）, 读取已加载内容")
+            try:
+                content = harvest_webpage_content(driver, PAGE_MAX_BYTES)
+            except Exception as e:
+                print(e)
+                content = ""
+            if not content:
+                return WEBPAGE_LOAD_TIMEOUT_MESSAGE, True
+            return content, True
         end = time.time()
         print(f"读取网页内容耗时: {end - start}s")
-        content = driver.execute_script("return document.body.innerText;")
-        return content
+        # a character is at least one byte, the byte cap is applied by the caller
+        content = get_inner_text(driver, PAGE_MAX_BYTES)
+        return content, False
     except Exception as e:
-        print(e)
-        return ""
+        # loading fails once the browser is closed by the cancellation
+        if cancel_token is None or not cancel_token.cancelled:
+            print(e)
+        return "", False
     finally:
-        driver.quit()
+        # the browser has already been closed if the callback was called
+        if cancel_token is None or cancel_token.remove_callback(handle):
+            driver.quit()
 
 
 def serper_search(
@@ -82,7 +294,11 @@ def serper_search(
 ) -> Tuple[int, Union[Dict, str]]:
     """
     Get google search results by serper api (https://serper.dev/).
+    Requests wait for the rate limiter, rate limited (429) ones are retried
+    with jittered backoff, all within timeout seconds. Return status 429 if
+    the request could not be sent in time.
     """
+    deadline = time.time() + timeout
     headers = {
         "X-API-KEY": SERPER_API_KEY,
         "Content-Type": "application/json",
@@ -94,78 +310,668 @@ def serper_search(
         "hl": "zh-CN",
         **{key: value for key, value in kwargs.items() if value is not None},
     }
-    try:
-        response = requests.post(
-            f"https://google.serper.dev/{search_type}",
-            headers=headers,
-            params=params,
-            proxies=None,
-            timeout=timeout,
+    for attempt in range(SERPER_MAX_ATTEMPTS):
+        try:
+            SERPER_RATE_LIMITER.acquire(
+                max_wait=min(SERPER_RATE_LIMITER.max_wait, deadline - time.time())
+            )
+        except RateLimitTimeout as e:
+            return 429, str(e)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return -1, "serper request timed out in the rate limiter queue"
+        try:
+            response = requests.post(
+                f"https://google.serper.dev/{search_type}",
+                headers=headers,
+                params=params,
+                proxies=None,
+                timeout=remaining,
+            )
+        except Exception as e:
+            return -1, str(e)
+        if response.status_code != 429:
+            if response.status_code == 200:
+                SERPER_RATE_LIMITER.record_success()
+            return response.status_code, response.json()
+        SERPER_RATE_LIMITER.record_rate_limited(
+            parse_retry_after(response.headers.get("Retry-After"))
         )
-    except Exception as e:
-        return -1, str(e)
-    return response.status_code, response.json()
+        print(f"serper限流, 第{attempt + 1}次重试")
+        backoff = random.uniform(0, SERPER_RETRY_BACKOFF * 2**attempt)
+        time.sleep(max(0.0, min(backoff, deadline - time.time())))
+    return 429, "serper rate limited"
+
+
+def get_cache_ttl(query: str) -> float:
+    args = get_args()
+    if is_time_sensitive(query):
+        return min(args.time_sensitive_cache_ttl, args.search_cache_ttl)
+    return args.search_cache_ttl
+
+
+def cached_serper_search(
+    query: str, min_remaining: float = 0.0
+) -> Tuple[int, Union[Dict, str]]:
+    """
+    serper_search through the serper cache, concurrent misses of a query share
+    one request. Results expiring within min_remaining seconds are refreshed.
+    """
+    if SERPER_CACHE is not None:
+        response = SERPER_CACHE.get(query, min_remaining)
+        if response is not None:
+            return 200, response
+    status_code, response = SERPER_FLIGHTS.do(query, serper_search, query, timeout=10)
+    if SERPER_CACHE is not None and status_code == 200:
+        SERPER_CACHE.put(query, response, get_cache_ttl(query))
+    return status_code, response
+
+
+def fetch_webpage_content(
+    url: str,
+    chrome_path: str,
+    chromedriver_path: str,
+    deadline: Optional[float],
+    max_timeout: float,
+    domain_health: Optional[DomainHealthTracker],
+    archive: Optional[SearchArchive] = None,
+    cancel_token: Optional[CancellationToken] = None,
+) -> Tuple[str, bool]:
+    """
+    Load one web page and record the outcome in the domain health tracker,
+    and the page in the archive. Cancelled loads are not recorded.
+    Links to documents (pdf, docx, pptx) are downloaded and parsed, not loaded
+    by chrome, which would not display them. A guessed link which is a web page
+    is read from the downloaded body.
+    The text is cut to PAGE_MAX_BYTES.
+    """
+    start = time.time()
+    content, partial = "", False
+    update_service_load("active_fetches", 1)
+    try:
+        document = None
+        if guess_document_type(url) is not None:
+            document = get_document_content(
+                url,
+                get_page_load_timeout(deadline, max_timeout),
+                DOCUMENT_MAX_BYTES,
+                DOCUMENT_MAX_PAGES,
+                DOCUMENT_MAX_CHARS,
+                cancel_token,
+                proxies=PROXIES,
+            )
+            if document is None:
+                DOCUMENT_STATS["web_pages"] += 1
+            elif document[2] == "html":
+                DOCUMENT_STATS["html_bodies"] += 1
+            else:
+                DOCUMENT_STATS["extracted"] += 1
+        if document is not None:
+            content, partial, _ = document
+        else:
+            content, partial = get_webpage_content(
+                url, chrome_path, chromedriver_path, deadline, max_timeout, cancel_token
+            )
+        content, capped = truncate_utf8(content, PAGE_MAX_BYTES)
+        if capped:
+            PAGE_STATS["capped"] += 1
+    finally:
+        update_service_load("active_fetches", -1)
+        # a cancelled load says nothing about the domain, its probe is released
+        cancelled = cancel_token is not None and cancel_token.cancelled
+        if domain_health is not None and cancelled:
+            domain_health.release_probe(get_domain(url))
+        elif domain_health is not None:
+            failed = not content or content == WEBPAGE_LOAD_TIMEOUT_MESSAGE
+            domain_health.record(
+                get_domain(url),
+                latency=time.time() - start,
+                failed=failed,
+                empty=not failed and len(content.strip()) < MIN_CONTENT_CHARS,
+            )
+    if archive is not None and not cancelled:
+        archive.record_page(url, content, partial, time.time() - start)
+    return content, partial
 
 
 def streaming_fetch_webpage_content(
-    results: dict, num_search_pages: int, chrome_path: str, chromedriver_path: str
-) -> Generator[Tuple[str, str], None, None]:
-    url_infos = results["organic"][:num_search_pages]
+    results: dict,
+    num_search_pages: int,
+    chrome_path: str,
+    chromedriver_path: str,
+    page_load_budget: float = DEFAULT_PAGE_LOAD_BUDGET,
+    domain_health: Optional[DomainHealthTracker] = None,
+    page_load_flights: Optional[SingleFlight] = None,
+    archive: Optional[SearchArchive] = None,
+    cancel_token: Optional[CancellationToken] = None,
+    page_cache: Optional[TTLCache] = None,
+    cache_ttl: float = 0.0,
+    cache_min_remaining: float = 0.0,
+    started_at: Optional[float] = None,
+) -> Generator[Tuple[Dict, str, bool], None, None]:
+    """
+    Load web pages concurrently, yield (url_info, content, partial) as they finish.
+    All pages share one deadline, page_load_budget after started_at (e.g. the
+    arrival of the request, now by default), so a slow page is cut off with the
+    content it has loaded so far instead of stretching the whole request.
+    With domain_health, results of unhealthy domains are skipped in favour of
+    later results and fast, reliable domains are started first.
+    With page_load_flights, a page already being loaded by another request is
+    not loaded again, the requests share its content.
+    With cancel_token, the loads are stopped and their browsers closed once the
+    token is cancelled, a shared load once all of its requests are cancelled.
+    With page_cache, pages cached for more than cache_min_remaining seconds are
+    not loaded, fully loaded pages are cached for cache_ttl seconds.
+    """
+    if domain_health is not None:
+        url_infos = domain_health.select(results["organic"], num_search_pages)
+    else:
+        url_infos = results["organic"][:num_search_pages]
+    if len(url_infos) == 0:
+        return
+    if started_at is None:
+        started_at = time.time()
+    deadline = started_at + page_load_budget
+
+    def fetch(url: str) -> Tuple[str, bool]:
+        if page_cache is not None:
+            content = page_cache.get(url, cache_min_remaining)
+            if content is not None:
+                # the page is not loaded, a probe of its domain is left to others
+                if domain_health is not None:
+                    domain_health.release_probe(get_domain(url))
+                return content, False
+        content, partial = load(url)
+        if (
+            page_cache is not None
+            and not partial
+            and len(content.strip()) >= MIN_CONTENT_CHARS
+        ):
+            page_cache.put(url, content, cache_ttl, size=len(content.encode("utf-8")))
+        return content, partial
 
-    with ThreadPoolExecutor(max_workers=len(url_infos)) as executor:
+    def load(url: str) -> Tuple[str, bool]:
+        if page_load_flights is None:
+            return fetch_webpage_content(
+                url,
+                chrome_path,
+                chromedriver_path,
+                deadline,
+                page_load_budget,
+                domain_health,
+                archive,
+                cancel_token,
+            )
+        try:
+            return page_load_flights.do(
+                url,
+                fetch_webpage_content,
+                url,
+                chrome_path,
+                chromedriver_path,
+                deadline,
+                page_load_budget,
+                domain_health,
+                archive,
+                # the load started by another request may end after our deadline
+                wait_timeout=max(0.0, deadline - time.time()) + CONTENT_HARVEST_MARGIN,
+                cancel_token=cancel_token,
+            )
+        except TimeoutError:
+            return WEBPAGE_LOAD_TIMEOUT_MESSAGE, True
+
+    executor = ThreadPoolExecutor(max_workers=len(url_infos))
+    try:
         future_to_url = {
-            executor.submit(
-                get_webpage_content, url_info["link"], chrome_path, chromedriver_path
-            ): url_info
-            for url_info in url_infos
+            executor.submit(fetch, url_info["link"]): url_info for url_info in url_infos
         }
         for future in as_completed(future_to_url):
+            if cancel_token is not None and cancel_token.cancelled:
+                break
             url_info = future_to_url[future]
             try:
-                result = future.result()
-                yield url_info, result
+                content, partial = future.result()
+                yield url_info, content, partial
             except Exception as exc:
                 print(f'{url_info["link"]} generated an exception: {exc}')
-                yield url_info, ""
+                yield url_info, "", False
+    finally:
+        # a cancelled request does not wait for shared loads it has left
+        executor.shutdown(wait=False)
+
+
+def replay_webpage_content(
+    results: dict, num_search_pages: int, archive: SearchArchive, latency_scale: float
+) -> Generator[Tuple[Dict, str, bool], None, None]:
+    """
+    Serve the recorded pages of a search in the order, and after the (scaled)
+    latencies, they were loaded in.
+    """
+    records = []
+    for url_info in results["organic"]:
+        record = archive.get_page(url_info["link"])
+        if record is not None:
+            records.append((record["latency"] * latency_scale, url_info, record))
+    records = sorted(records[:num_search_pages], key=lambda item: item[0])
+    start = time.time()
+    for latency, url_info, record in records:
+        time.sleep(max(0.0, start + latency - time.time()))
+        yield url_info, record["content"], record["partial"]
+
+
+def get_page_records(
+    data: Dict, record: Dict, content: str
+) -> Generator[str, None, None]:
+    """
+    Records of one page for the client of the request: the content is cut to
+    its page_max_chars, and sent in chunks if it reads chunked_pages.
+    """
+    page_max_chars = data.get("page_max_chars")
+    if page_max_chars is not None and len(content) > page_max_chars:
+        content = content[:page_max_chars]
+        PAGE_STATS["cut_to_client_budget"] += 1
+    chunk_bytes = PAGE_CHUNK_BYTES if data.get("chunked_pages") else None
+    num_records = 0
+    for line in make_page_records(record, content, chunk_bytes):
+        num_records += 1
+        yield line
+    if num_records > 1:
+        PAGE_STATS["chunked"] += 1
+
+
+def check_snippet_answer(data: Dict, response: Dict) -> Optional[Dict]:
+    """
+    Decide whether the answer box, knowledge graph and snippets of the serper
+    response answer the query well enough to skip loading the pages.
+    Only requests with a snippet_answer_threshold are checked.
+    """
+    threshold = data.get("snippet_answer_threshold")
+    if threshold is None:
+        return None
+    decision = score_snippet_answer(
+        data["query"], response, is_time_sensitive(data["query"])
+    )
+    decision["threshold"] = threshold
+    decision["fast_path"] = decision["score"] >= threshold
+    SNIPPET_ANSWER_STATS["checked"] += 1
+    if decision["fast_path"]:
+        SNIPPET_ANSWER_STATS["fast_path"] += 1
+        print(f"命中摘要快速路径: {data['query']}, {decision}")
+    return decision
+
+
+def search_snippet_answer(
+    query: str,
+    status_code: int,
+    response: Dict,
+    num_search_pages: int,
+    decision: Dict,
+) -> Generator[str, None, None]:
+    for url_info, content in get_snippet_documents(query, response, num_search_pages):
+        yield json.dumps(
+            {
+                "search_status_code": status_code,
+                "search_response": response,
+                "url_info": url_info,
+                "html_content": content,
+                "partial": False,
+                "source": "snippet",
+                "snippet_answer": decision,
+            },
+            ensure_ascii=False,
+        ) + "\n"
+
+
+async def replay_search(data: Dict):
+    record = ARCHIVE.get_serper(data["query"])
+    if record is None:
+        raise HTTPException(status_code=404, detail="回放存档中没有该查询")
+    await asyncio.sleep(record["latency"] * get_args().replay_latency_scale)
+    if record["status_code"] != 200:
+        raise HTTPException(status_code=500, detail="搜索网页超时, 请重试")
+
+    decision = check_snippet_answer(data, record["response"])
+    if decision is not None and decision["fast_path"]:
+        return StreamingResponse(
+            search_snippet_answer(
+                data["query"],
+                record["status_code"],
+                record["response"],
+                data["num_search_pages"],
+                decision,
+            ),
+            media_type="application/json",
+        )
+
+    def replay_docs_text_generator():
+        for url_info, content, partial in replay_webpage_content(
+            record["response"],
+            data["num_search_pages"],
+            ARCHIVE,
+            get_args().replay_latency_scale,
+        ):
+            yield from get_page_records(
+                data,
+                {
+                    "search_status_code": record["status_code"],
+                    "search_response": record["response"],
+                    "url_info": url_info,
+                    "partial": partial,
+                    "source": "replay",
+                    "snippet_answer": decision,
+                },
+                content,
+            )
+
+    return StreamingResponse(
+        replay_docs_text_generator(), media_type="application/json"
+    )
+
+
+def search_local_corpus(data: Dict) -> Optional[Generator[str, None, None]]:
+    """
+    Serve evergreen queries covered by the local corpus without serper and chrome.
+    """
+    query = data["query"]
+    if CORPUS is None or is_time_sensitive(query):
+        return None
+    try:
+        docs = CORPUS.search(
+            query, data["num_search_pages"], max_age=get_args().corpus_max_age
+        )
+    except Exception as e:
+        print(f"查询本地语料失败: {e}")
+        return None
+    if len(docs) == 0:
+        return None
+    print(f"命中本地语料: {query}")
+    response = {"organic": [url_info for url_info, _ in docs]}
+
+    def local_docs_text_generator():
+        for url_info, content in docs:
+            yield from get_page_records(
+                data,
+                {
+                    "search_status_code": 200,
+                    "search_response": response,
+                    "url_info": url_info,
+                    "partial": False,
+                    "source": "corpus",
+                },
+                content,
+            )
+
+    return local_docs_text_generator()
+
+
+def add_to_local_corpus(url_info: Dict, content: str, partial: bool) -> None:
+    if CORPUS is None or partial or len(content.strip()) < MIN_CONTENT_CHARS:
+        return
+    if RECENTLY_INDEXED.get(url_info["link"]) is not None:
+        return
+    RECENTLY_INDEXED.put(url_info["link"], True, get_args().search_cache_ttl)
+    CORPUS_INDEXER.submit(url_info, content)
+
+
+def is_idle() -> bool:
+    """
+    No live search is running and the browsers and the serper rate have room.
+    """
+    with SERVICE_LOAD_LOCK:
+        load = dict(SERVICE_LOAD)
+    return (
+        load["active_requests"] == 0
+        and load["active_fetches"] < get_args().browser_capacity * WARM_MAX_UTILIZATION
+        and SERPER_RATE_LIMITER.stats()["utilization"] < WARM_MAX_UTILIZATION
+    )
+
+
+def warm_query(
+    query: str, num_search_pages: int, cancel_token: CancellationToken
+) -> bool:
+    """
+    Refresh the cached serper results and pages of a query.
+    """
+    args = get_args()
+    status_code, response = cached_serper_search(query, WARM_REFRESH_AHEAD)
+    if status_code != 200:
+        return False
+    print(f"预热缓存: {query}")
+    for _ in streaming_fetch_webpage_content(
+        response,
+        num_search_pages=num_search_pages,
+        chrome_path=args.chrome,
+        chromedriver_path=args.chromedriver,
+        domain_health=DOMAIN_HEALTH,
+        page_load_flights=PAGE_LOAD_FLIGHTS,
+        cancel_token=cancel_token,
+        page_cache=PAGE_CACHE,
+        cache_ttl=get_cache_ttl(query),
+        cache_min_remaining=WARM_REFRESH_AHEAD,
+    ):
+        pass
+    return not cancel_token.cancelled
+
+
+CACHE_WARMER: Optional[CacheWarmer] = None
 
 
 @app.post("/search")
 async def search(request: Request):
+    # the page load budget of the client includes the serper search
+    received_at = time.time()
     data = await request.json()
     print(data)
+    args = get_args()
+
+    if args.replay:
+        return await replay_search(data)
+
+    # recorded searches always go to serper and chrome
+    if not args.record:
+        local_docs = await run_in_threadpool(search_local_corpus, data)
+        if local_docs is not None:
+            return StreamingResponse(local_docs, media_type="application/json")
+
+    # live searches take precedence over the cache warmer, cancelling its refresh
+    # closes browsers, which is not done in the event loop
+    if CACHE_WARMER is not None:
+        await run_in_threadpool(CACHE_WARMER.yield_to_live)
+    QUERY_TRACKER.record(data["query"], data["num_search_pages"])
 
     start = time.time()
-    status_code, response = serper_search(data["query"], timeout=10)
+    status_code, response = await run_in_threadpool(cached_serper_search, data["query"])
     end = time.time()
     print(f"搜索网页耗时: {end - start}s")
+    if args.record:
+        ARCHIVE.record_serper(data["query"], status_code, response, end - start)
 
+    if status_code == 429:
+        # the search client retries overloaded services
+        raise HTTPException(status_code=503, detail="搜索请求过多, 请稍后重试")
     if status_code != 200:
         raise HTTPException(status_code=500, detail="搜索网页超时, 请重试")
 
+    decision = check_snippet_answer(data, response)
+    if decision is not None and decision["fast_path"]:
+        return StreamingResponse(
+            search_snippet_answer(
+                data["query"],
+                status_code,
+                response,
+                data["num_search_pages"],
+                decision,
+            ),
+            media_type="application/json",
+        )
+
+    # pages already received from another replica by a retried search
+    exclude_links = set(data.get("exclude_links", []))
+    results = {
+        **response,
+        "organic": [
+            url_info
+            for url_info in response.get("organic", [])
+            if url_info["link"] not in exclude_links
+        ],
+    }
+
+    # cancelled when the client disconnects, e.g. its observation deadline passed
+    cancel_token = CancellationToken()
+    cancel_token.add_callback(lambda: record_avoided_work("search_requests_cancelled"))
+
     def html_docs_text_generator():
         start = time.time()
-        for url_info, content in streaming_fetch_webpage_content(
-            response,
-            num_search_pages=data["num_search_pages"],
-            chrome_path=args.chrome,
-            chromedriver_path=args.chromedriver,
-        ):
-            yield json.dumps(
-                {
-                    "search_status_code": status_code,
-                    "search_response": response,
-                    "url_info": url_info,
-                    "html_content": content,
-                },
-                ensure_ascii=False,
-            ) + "\n"
+        update_service_load("active_requests", 1)
+        try:
+            for url_info, content, partial in streaming_fetch_webpage_content(
+                results,
+                num_search_pages=data["num_search_pages"],
+                chrome_path=args.chrome,
+                chromedriver_path=args.chromedriver,
+                page_load_budget=float(
+                    data.get("page_load_budget", DEFAULT_PAGE_LOAD_BUDGET)
+                ),
+                domain_health=DOMAIN_HEALTH,
+                page_load_flights=PAGE_LOAD_FLIGHTS,
+                archive=ARCHIVE if args.record else None,
+                cancel_token=cancel_token,
+                page_cache=PAGE_CACHE,
+                cache_ttl=get_cache_ttl(data["query"]),
+                started_at=received_at,
+            ):
+                yield from get_page_records(
+                    data,
+                    {
+                        "search_status_code": status_code,
+                        "search_response": response,
+                        "url_info": url_info,
+                        "partial": partial,
+                        "source": "live",
+                        "snippet_answer": decision,
+                    },
+                    content,
+                )
+                # index the page after it has been sent
+                add_to_local_corpus(url_info, content, partial)
+        finally:
+            update_service_load("active_requests", -1)
         end = time.time()
         print(f"解析网页耗时: {end - start}s")
 
-    return StreamingResponse(html_docs_text_generator(), media_type="application/json")
+    return StreamingResponse(
+        stream_until_disconnected(request, html_docs_text_generator(), cancel_token),
+        media_type="application/json",
+    )
+
+
+@app.get("/load")
+async def get_load():
+    with SERVICE_LOAD_LOCK:
+        load = dict(SERVICE_LOAD)
+    # every page load runs in its own chrome, in-flight loads are the queue
+    load["queue_depth"] = load["active_fetches"]
+    capacity = get_args().browser_capacity
+    load["capacity"] = capacity
+    load["utilization"] = round(load["active_fetches"] / capacity, 3)
+    return load
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "serper_coalescing": SERPER_FLIGHTS.stats(),
+        "serper_rate_limit": SERPER_RATE_LIMITER.stats(),
+        "page_load_coalescing": PAGE_LOAD_FLIGHTS.stats(),
+        "archive": ARCHIVE.stats() if ARCHIVE is not None else None,
+        "snippet_answer": dict(SNIPPET_ANSWER_STATS),
+        "documents": dict(DOCUMENT_STATS),
+        "corpus": CORPUS_INDEXER.stats() if CORPUS_INDEXER is not None else None,
+        "pages": dict(PAGE_STATS),
+        "search_cache": {
+            "serper": SERPER_CACHE.stats() if SERPER_CACHE is not None else None,
+            "pages": PAGE_CACHE.stats() if PAGE_CACHE is not None else None,
+        },
+        "cache_warmer": CACHE_WARMER.stats() if CACHE_WARMER is not None else None,
+        "cancellation": get_avoided_work(),
+    }
+
+
+@app.get("/domain_health")
+async def get_domain_health():
+    return DOMAIN_HEALTH.snapshot()
+
+
+def warm_up() -> None:
+    start = time.time()
+    from selenium import webdriver  # noqa: F401
+
+    print(f"预热耗时: {time.time() - start}s")
+
+
+@app.on_event("startup")
+def init_service():
+    """
+    Build the state of the service from its arguments, before the other startup
+    hooks use it.
+    """
+    global DOMAIN_HEALTH, CORPUS, CORPUS_INDEXER, ARCHIVE, SERPER_RATE_LIMITER
+    global SERPER_CACHE, PAGE_CACHE, CACHE_WARMER
+    args = get_args()
+    DOMAIN_HEALTH = DomainHealthTracker(state_path=args.domain_health_path)
+    if args.corpus_path:
+        CORPUS = LocalCorpus(args.corpus_path)
+        CORPUS_INDEXER = CorpusIndexer(
+            CORPUS, args.corpus_max_age, args.corpus_max_documents
+        )
+    if args.record or args.replay:
+        ARCHIVE = SearchArchive(args.record or args.replay)
+    SERPER_RATE_LIMITER = AdaptiveRateLimiter(
+        args.serper_rate, args.serper_burst, max_wait=args.serper_max_wait
+    )
+    if args.search_cache_ttl > 0 and not args.record:
+        SERPER_CACHE = TTLCache(max_entries=10000)
+        PAGE_CACHE = TTLCache(max_entries=5000, max_size=256 * 1024 * 1024)
+    if SERPER_CACHE is not None and args.warm_serper_budget > 0 and not args.replay:
+        CACHE_WARMER = CacheWarmer(
+            QUERY_TRACKER,
+            warm_query,
+            SERPER_CACHE.expires_in,
+            is_idle,
+            serper_budget=args.warm_serper_budget,
+            num_queries=args.warm_num_queries,
+            min_score=WARM_MIN_SCORE,
+            refresh_ahead=WARM_REFRESH_AHEAD,
+            interval=WARM_INTERVAL,
+        )
+
+
+@app.on_event("startup")
+def start_warm_up():
+    # requests are accepted while warming up
+    threading.Thread(target=warm_up, daemon=True).start()
+    if CORPUS_INDEXER is not None:
+        CORPUS_INDEXER.start()
+
+
+@app.on_event("startup")
+def start_cache_warmer():
+    if CACHE_WARMER is not None:
+        CACHE_WARMER.start()
+
+
+@app.on_event("shutdown")
+def save_domain_health():
+    DOMAIN_HEALTH.save()
+
+
+@app.on_event("shutdown")
+def stop_cache_warmer():
+    if CACHE_WARMER is not None:
+        CACHE_WARMER.stop()
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run("search_service:app", host="0.0.0.0", port=args.port, reload=True)
+    uvicorn.run("search_service:app", host="0.0.0.0", port=get_args().port, reload=True)
@@ -0,0 +1,111 @@
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from infini_websearch.utils.cancellation import CancellationToken
+
+
+class Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        # cancelled once every caller of the call has been cancelled
+        self.cancel_token = CancellationToken()
+        self.num_callers = 0
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it runs wait for it and get the same
+    result (or exception). Nothing is cached once the call has finished.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls: Dict[Hashable, Call] = {}
+        self.num_calls = 0
+        self.num_shared = 0
+
+    def do(
+        self,
+        key: Hashable,
+        function: Callable,
+        *args,
+        wait_timeout: Optional[float] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        **kwargs,
+    ) -> Any:
+        """
+        wait_timeout: how long a waiting caller waits for the running call before
+            raising TimeoutError, the running call itself is not interrupted.
+        cancel_token: the function is called with a cancel_token of its own,
+            cancelled once the tokens of all callers have been cancelled. Callers
+            of a key either all pass a token or none does.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+                self.num_calls += 1
+            else:
+                self.num_shared += 1
+            call.num_callers += 1
+        handle = None
+        if cancel_token is not None:
+            handle = cancel_token.add_callback(partial(self.leave, call))
+            kwargs["cancel_token"] = call.cancel_token
+
+        try:
+            if not leader:
+                if not call.done.wait(wait_timeout):
+                    raise TimeoutError(f"waiting for in-flight call {key} timed out")
+                if call.error is not None:
+                    raise call.error
+                return call.result
+
+            try:
+                call.result = function(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+        finally:
+            # a caller that stopped waiting (timed out) leaves the call as well
+            if (
+                cancel_token is not None
+                and cancel_token.remove_callback(handle)
+                and not call.done.is_set()
+            ):
+                self.leave(call)
+
+    def leave(self, call: Call) -> None:
+        """
+        A caller has been cancelled, cancel the call if it was the last one.
+        """
+        with self.lock:
+            call.num_callers -= 1
+            cancel = call.num_callers == 0
+        if cancel:
+            call.cancel_token.cancel()
+
+    def stats(self) -> Dict:
+        """
+        coalescing_ratio: fraction of calls served by another in-flight call.
+        """
+        with self.lock:
+            num_total = self.num_calls + self.num_shared
+            return {
+                "calls": num_total,
+                "upstream_calls": self.num_calls,
+                "shared_calls": self.num_shared,
+                "in_flight": len(self.calls),
+                "coalescing_ratio": self.num_shared / num_total if num_total else 0.0,
+            }
@@ -1,13 +1,24 @@
+from infini_websearch.utils.cancellation import CancellationToken
 from infini_websearch.utils.misc import (
     extract_citations,
     format_search_results,
     functions2str,
     get_datetime_now,
 )
+from infini_websearch.utils.retrieval import PassageIndex, tokenize_for_retrieval
+from infini_websearch.utils.scheduler import AdmissionScheduler
+from infini_websearch.utils.session_store import SessionStore
+from infini_websearch.utils.timing import StageTimer
 
 __all__ = [
     "extract_citations",
     "format_search_results",
     "functions2str",
     "get_datetime_now",
+    "PassageIndex",
+    "tokenize_for_retrieval",
+    "SessionStore",
+    "AdmissionScheduler",
+    "StageTimer",
+    "CancellationToken",
 ]
@@ -0,0 +1,153 @@
+import asyncio
+import socket
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, AsyncGenerator, Callable, Dict, Iterator, Optional
+
+if TYPE_CHECKING:
+    import httpx
+    import requests
+    from starlette.requests import Request
+
+# work not done because its request was cancelled, e.g. browsers closed
+AVOIDED_WORK: Counter = Counter()
+AVOIDED_WORK_LOCK = threading.Lock()
+
+
+def record_avoided_work(name: str, count: int = 1) -> None:
+    with AVOIDED_WORK_LOCK:
+        AVOIDED_WORK[name] += count
+
+
+def get_avoided_work() -> Dict[str, int]:
+    with AVOIDED_WORK_LOCK:
+        return dict(AVOIDED_WORK)
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+def shutdown_socket(sock: Optional[socket.socket]) -> None:
+    """
+    Closing a connection does not wake up a thread blocked reading from it,
+    shutting its socket down does, and the server sees the client has gone.
+    """
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def abort_requests_response(response: "requests.Response") -> None:
+    """
+    Abort a streamed requests response read by another thread, the reader
+    fails and closes the response.
+    """
+    connection = getattr(response.raw, "_connection", None)
+    shutdown_socket(getattr(connection, "sock", None))
+
+
+def abort_httpx_response(response: "httpx.Response") -> None:
+    """
+    Abort a streamed httpx (openai) response read by another thread.
+    """
+    network_stream = response.extensions.get("network_stream")
+    if network_stream is not None:
+        shutdown_socket(network_stream.get_extra_info("socket"))
+
+
+class CancellationToken:
+    """
+    Cancellation of one request, shared by everything working on it.
+    Blocking work registers a callback (e.g. closing its connection or its
+    browser) for as long as it runs, the callbacks are called by cancel().
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks: Dict[int, Callable[[], None]] = {}
+        self.next_handle = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self) -> None:
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks = list(self.callbacks.values())
+            self.callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消回调失败: {e}")
+
+    def add_callback(self, callback: Callable[[], None]) -> Optional[int]:
+        """
+        Return the handle for remove_callback. If the token is already cancelled
+        the callback is called at once and None is returned.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                handle = self.next_handle
+                self.next_handle += 1
+                self.callbacks[handle] = callback
+                return handle
+        callback()
+        return None
+
+    def remove_callback(self, handle: Optional[int]) -> bool:
+        """
+        Return False if the callback has been called by cancel().
+        """
+        if handle is None:
+            return False
+        with self.lock:
+            return self.callbacks.pop(handle, None) is not None
+
+
+async def stream_until_disconnected(
+    request: "Request", lines: Iterator[str], cancel_token: CancellationToken
+) -> AsyncGenerator[str, None]:
+    """
+    Stream a blocking generator from the thread pool. The token is cancelled if
+    the client disconnects (or starlette cancels the response) before the end.
+    The disconnect is watched by a task of its own, the thread blocked in the
+    generator can not be interrupted, the callbacks of the token unblock it.
+    """
+    from starlette.concurrency import iterate_in_threadpool
+
+    watcher = asyncio.ensure_future(cancel_on_disconnect(request, cancel_token))
+    finished = False
+    try:
+        async for line in iterate_in_threadpool(lines):
+            if cancel_token.cancelled:
+                break
+            yield line
+        else:
+            finished = True
+    finally:
+        watcher.cancel()
+        if not finished:
+            cancel_token.cancel()
+
+
+async def cancel_on_disconnect(
+    request: "Request", cancel_token: CancellationToken, interval: float = 0.5
+) -> None:
+    """
+    Cancel the token once the client disconnects, for requests answered in one
+    response. Run it as a task and cancel the task with the answer.
+    """
+    while not cancel_token.cancelled:
+        if await request.is_disconnected():
+            cancel_token.cancel()
+            return
+        await asyncio.sleep(interval)
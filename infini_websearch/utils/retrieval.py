@@ -0,0 +1,272 @@
+import math
+import re
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]+")
+CJK_PATTERN = re.compile(r"[\u4e00-\u9fff]+")
+
+# queries about things that change quickly are never answered from pages
+# stored earlier (local corpus, session index), they always go to serper
+TIME_SENSITIVE_KEYWORDS = [
+    "今天",
+    "今日",
+    "明天",
+    "昨天",
+    "现在",
+    "目前",
+    "最新",
+    "最近",
+    "近期",
+    "本周",
+    "本月",
+    "今年",
+    "实时",
+    "天气",
+    "气温",
+    "汇率",
+    "股价",
+    "行情",
+    "新闻",
+    "比分",
+    "latest",
+    "today",
+    "now",
+    "news",
+    "weather",
+    "price",
+    "prices",
+]
+# english keywords are matched as whole words, "now" is not in "know" or "snow"
+ASCII_KEYWORD_PATTERN = re.compile(
+    r"\b(?:"
+    + "|".join(
+        re.escape(keyword) for keyword in TIME_SENSITIVE_KEYWORDS if keyword.isascii()
+    )
+    + r")\b"
+)
+
+
+def is_time_sensitive(query: str) -> bool:
+    query = query.lower()
+    if any(
+        keyword in query for keyword in TIME_SENSITIVE_KEYWORDS if not keyword.isascii()
+    ):
+        return True
+    if ASCII_KEYWORD_PATTERN.search(query):
+        return True
+    # mentions of the current or last year
+    current_year = time.localtime().tm_year
+    return str(current_year) in query or str(current_year - 1) in query
+
+
+def tokenize_for_retrieval(text: str) -> List[str]:
+    """
+    Latin words and digits are kept whole, CJK runs are split into character
+    bigrams (a single character is kept as is).
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if CJK_PATTERN.fullmatch(token):
+            if len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(map("".join, zip(token, token[1:])))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+def tokenize_query_words(query: str) -> List[List[str]]:
+    """
+    Retrieval terms of each word of a query (a latin word, a digit run or a CJK
+    run), for coverage checks by word: the bigrams of one name must not count
+    as several words of the query.
+    """
+    words = []
+    for token in TOKEN_PATTERN.findall(query.lower()):
+        terms = tokenize_for_retrieval(token)
+        if terms not in words:
+            words.append(terms)
+    return words
+
+
+def split_passages(text: str, max_chars: int = 400) -> List[str]:
+    """
+    Split page text into passages of about max_chars by merging lines.
+    """
+    passages, current = [], ""
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        while len(line) > max_chars:
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(line[:max_chars])
+            line = line[max_chars:]
+        if len(current) + len(line) + 1 > max_chars:
+            passages.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        passages.append(current)
+    return passages
+
+
+class PassageIndex:
+    """
+    In-memory BM25 index over passages of fetched web pages.
+    The total size of the indexed text is bounded by max_chars, the oldest
+    pages are evicted first.
+    """
+
+    def __init__(
+        self,
+        max_chars: int = 200000,
+        passage_max_chars: int = 400,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> None:
+        self.max_chars = max_chars
+        self.passage_max_chars = passage_max_chars
+        self.k1 = k1
+        self.b = b
+        # link -> {"url_info": ..., "passage_ids": [...], "num_chars": ...}
+        self.pages: OrderedDict = OrderedDict()
+        # passage id -> {"link": ..., "text": ..., "tf": Counter, "length": ...}
+        self.passages: Dict[int, Dict] = {}
+        self.postings: Dict[str, set] = {}
+        self.num_chars = 0
+        self.total_length = 0
+        self.next_id = 0
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    def add_page(self, url_info: Dict, text: str) -> None:
+        link = url_info["link"]
+        if link in self.pages:
+            self.remove_page(link)
+        passage_ids = []
+        for passage in split_passages(text, self.passage_max_chars):
+            tokens = tokenize_for_retrieval(passage)
+            if len(tokens) == 0:
+                continue
+            passage_id = self.next_id
+            self.next_id += 1
+            tf = Counter(tokens)
+            self.passages[passage_id] = {
+                "link": link,
+                "text": passage,
+                "tf": tf,
+                "length": len(tokens),
+            }
+            for term in tf:
+                self.postings.setdefault(term, set()).add(passage_id)
+            self.total_length += len(tokens)
+            passage_ids.append(passage_id)
+        num_chars = sum(len(self.passages[i]["text"]) for i in passage_ids)
+        self.pages[link] = {
+            "url_info": url_info,
+            "passage_ids": passage_ids,
+            "num_chars": num_chars,
+        }
+        self.num_chars += num_chars
+        while self.num_chars > self.max_chars and len(self.pages) > 1:
+            self.remove_page(next(iter(self.pages)))
+
+    def remove_page(self, link: str) -> None:
+        page = self.pages.pop(link)
+        for passage_id in page["passage_ids"]:
+            passage = self.passages.pop(passage_id)
+            for term in passage["tf"]:
+                postings = self.postings[term]
+                postings.discard(passage_id)
+                if len(postings) == 0:
+                    del self.postings[term]
+            self.total_length -= passage["length"]
+        self.num_chars -= page["num_chars"]
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[float, Dict]]:
+        """
+        Return the top_k (score, passage) pairs by BM25.
+        """
+        terms = set(tokenize_for_retrieval(query))
+        if len(terms) == 0 or len(self.passages) == 0:
+            return []
+        num_passages = len(self.passages)
+        avg_length = self.total_length / num_passages
+        scores: Dict[int, float] = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(
+                1 + (num_passages - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for passage_id in postings:
+                passage = self.passages[passage_id]
+                tf = passage["tf"][term]
+                norm = self.k1 * (1 - self.b + self.b * passage["length"] / avg_length)
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * tf * (
+                    self.k1 + 1
+                ) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [(score, self.passages[i]) for i, score in ranked[:top_k]]
+
+    def covers(
+        self,
+        query: str,
+        top_k: int = 5,
+        min_passage_coverage: float = 0.6,
+        min_total_coverage: float = 1.0,
+    ) -> bool:
+        """
+        Cheap relevance check: whether the indexed pages can answer the query.
+        Coverage counts query words, a word is covered by a passage containing
+        all of its terms. The best passage must contain most query words and
+        the top passages together (by default) all of them.
+        """
+        words = tokenize_query_words(query)
+        if len(words) == 0:
+            return False
+        results = self.search(query, top_k=top_k)
+        if len(results) == 0:
+            return False
+        covered_words = set()
+        best_coverage = 0.0
+        for _, passage in results:
+            passage_words = {
+                i
+                for i, word in enumerate(words)
+                if all(term in passage["tf"] for term in word)
+            }
+            covered_words |= passage_words
+            best_coverage = max(best_coverage, len(passage_words) / len(words))
+        return (
+            best_coverage >= min_passage_coverage
+            and len(covered_words) / len(words) >= min_total_coverage
+        )
+
+    def retrieve_pages(
+        self, query: str, top_k: int = 5, max_chars: int = 2000
+    ) -> List[Tuple[Dict, str]]:
+        """
+        Return (url_info, text) of the top passages grouped by page, the pages
+        are ordered by their best passage.
+        """
+        page_texts: OrderedDict = OrderedDict()
+        num_chars = 0
+        for _, passage in self.search(query, top_k=top_k):
+            if num_chars + len(passage["text"]) > max_chars and num_chars > 0:
+                break
+            page_texts.setdefault(passage["link"], []).append(passage["text"])
+            num_chars += len(passage["text"])
+        return [
+            (self.pages[link]["url_info"], "\n".join(texts))
+            for link, texts in page_texts.items()
+        ]
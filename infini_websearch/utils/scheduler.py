@@ -0,0 +1,208 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional, Tuple
+
+
+class Ticket:
+    def __init__(self, ticket_id: int, user_id: str, kind: str) -> None:
+        self.ticket_id = ticket_id
+        self.user_id = user_id
+        self.kind = kind
+        self.granted = False
+        self.done = False
+        self.submitted_at = time.time()
+        self.granted_at: Optional[float] = None
+
+
+class CapacityPool:
+    """
+    Slots of one kind of turn, with a fair (round robin across users) queue.
+    """
+
+    def __init__(self, limit: int, min_limit: int, max_limit: int) -> None:
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.active = 0
+        # user id -> queued tickets of the user, in round robin order
+        self.queues: OrderedDict = OrderedDict()
+
+    def num_queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def enqueue(self, ticket: Ticket) -> None:
+        if ticket.user_id not in self.queues:
+            self.queues[ticket.user_id] = deque()
+        self.queues[ticket.user_id].append(ticket)
+
+    def remove(self, ticket: Ticket) -> None:
+        queue = self.queues.get(ticket.user_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if len(queue) == 0:
+                del self.queues[ticket.user_id]
+
+    def dispatch(self) -> None:
+        """
+        Grant free slots, one ticket per user in turn.
+        """
+        while self.active < self.limit and len(self.queues) > 0:
+            user_id, queue = next(iter(self.queues.items()))
+            ticket = queue.popleft()
+            del self.queues[user_id]
+            # the user goes to the back of the round
+            if len(queue) > 0:
+                self.queues[user_id] = queue
+            ticket.granted = True
+            ticket.granted_at = time.time()
+            self.active += 1
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        Number of tickets that will be granted before this one.
+        """
+        queue = self.queues.get(ticket.user_id)
+        if ticket.granted or queue is None:
+            return 0
+        ind = queue.index(ticket)
+        position = 0
+        before = True
+        for user_id, other_queue in self.queues.items():
+            if user_id == ticket.user_id:
+                before = False
+                position += ind
+                continue
+            # users ahead in the round get one more turn than users behind
+            position += min(len(other_queue), ind + 1 if before else ind)
+        return position
+
+
+class AdmissionScheduler:
+    """
+    Admission control for chat and search turns.
+
+    Each kind of turn has its own capacity pool with a fair queue across users.
+    Pool limits adapt with AIMD: they shrink multiplicatively when the model
+    latency (EWMA of time to first token) exceeds target_model_latency, or for
+    search turns when the search service queue depth exceeds
+    max_search_queue_depth, and grow by one slot when there is headroom and the
+    pool is saturated.
+    """
+
+    def __init__(
+        self,
+        pools: Dict[str, Tuple[int, int, int]],
+        target_model_latency: float = 2.0,
+        max_search_queue_depth: int = 20,
+        search_kind: str = "search",
+        alpha: float = 0.2,
+        adjust_interval: float = 5.0,
+    ) -> None:
+        """
+        pools: kind -> (initial limit, min limit, max limit)
+        """
+        self.pools = {
+            kind: CapacityPool(limit, min_limit, max_limit)
+            for kind, (limit, min_limit, max_limit) in pools.items()
+        }
+        self.target_model_latency = target_model_latency
+        self.max_search_queue_depth = max_search_queue_depth
+        self.search_kind = search_kind
+        self.alpha = alpha
+        self.adjust_interval = adjust_interval
+        self.model_latency: Optional[float] = None
+        self.search_queue_depth = 0
+        self.last_adjust = time.time()
+        self.ticket_ids = itertools.count()
+        self.condition = threading.Condition()
+
+    def submit(self, user_id: str, kind: str) -> Ticket:
+        ticket = Ticket(next(self.ticket_ids), user_id, kind)
+        with self.condition:
+            pool = self.pools[kind]
+            pool.enqueue(ticket)
+            pool.dispatch()
+        return ticket
+
+    def wait(self, ticket: Ticket, timeout: float) -> bool:
+        """
+        Wait until the ticket is granted, return False on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: ticket.granted, timeout=timeout)
+
+    def position(self, ticket: Ticket) -> int:
+        with self.condition:
+            return self.pools[ticket.kind].position(ticket)
+
+    def release(self, ticket: Ticket) -> None:
+        """
+        Free the slot of a granted ticket, or leave the queue.
+        """
+        with self.condition:
+            if ticket.done:
+                return
+            ticket.done = True
+            pool = self.pools[ticket.kind]
+            if ticket.granted:
+                pool.active -= 1
+            else:
+                pool.remove(ticket)
+            pool.dispatch()
+            self.condition.notify_all()
+
+    def record_model_latency(self, latency: float) -> None:
+        with self.condition:
+            if self.model_latency is None:
+                self.model_latency = latency
+            else:
+                self.model_latency = (
+                    1 - self.alpha
+                ) * self.model_latency + self.alpha * latency
+            self.adjust()
+
+    def record_search_queue_depth(self, queue_depth: int) -> None:
+        with self.condition:
+            self.search_queue_depth = queue_depth
+            self.adjust()
+
+    def adjust(self) -> None:
+        """
+        AIMD update of the pool limits, called with the condition held.
+        """
+        now = time.time()
+        if now - self.last_adjust < self.adjust_interval:
+            return
+        self.last_adjust = now
+        model_overloaded = (
+            self.model_latency is not None
+            and self.model_latency > self.target_model_latency
+        )
+        for kind, pool in self.pools.items():
+            overloaded = model_overloaded or (
+                kind == self.search_kind
+                and self.search_queue_depth > self.max_search_queue_depth
+            )
+            if overloaded:
+                pool.limit = max(pool.min_limit, int(pool.limit * 0.75))
+            elif pool.active >= pool.limit and pool.num_queued() > 0:
+                pool.limit = min(pool.max_limit, pool.limit + 1)
+            pool.dispatch()
+        self.condition.notify_all()
+
+    def stats(self) -> Dict:
+        with self.condition:
+            return {
+                "model_latency": self.model_latency,
+                "search_queue_depth": self.search_queue_depth,
+                "pools": {
+                    kind: {
+                        "limit": pool.limit,
+                        "active": pool.active,
+                        "queued": pool.num_queued(),
+                    }
+                    for kind, pool in self.pools.items()
+                },
+            }
@@ -0,0 +1,243 @@
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from infini_websearch.utils.retrieval import PassageIndex
+
+
+def new_session() -> Dict:
+    return dict(messages=[], url_infos=[], passage_index=None)
+
+
+def estimate_session_bytes(session: Dict) -> int:
+    """
+    Approximate memory held by a session: message text, links and indexed pages.
+    """
+    num_bytes = 0
+    for message in session["messages"]:
+        num_bytes += len(message["content"].encode("utf-8"))
+    num_bytes += len(
+        json.dumps(session["url_infos"], ensure_ascii=False).encode("utf-8")
+    )
+    if session["passage_index"] is not None:
+        # most indexed text is CJK, 3 bytes per character in utf-8
+        num_bytes += session["passage_index"].num_chars * 3
+    return num_bytes
+
+
+class SessionStore:
+    """
+    Conversation state of all gradio sessions, the gr.State of a tab only
+    keeps its session id.
+
+    After each turn the messages outside the session window are compacted into
+    stubs that keep only the role and token count, and the session is capped at
+    max_session_bytes (oldest turns first, then indexed pages). Sessions idle for
+    idle_seconds, or the least recently used ones beyond max_sessions_in_memory,
+    are pickled to spill_dir and loaded back on their next access. Sessions
+    pinned by a turn in progress are never spilled, the turn keeps writing to
+    the session in memory.
+    """
+
+    def __init__(
+        self,
+        spill_dir: str,
+        max_sessions_in_memory: int = 1000,
+        max_session_bytes: int = 512 * 1024,
+        idle_seconds: float = 600.0,
+        spill_ttl_seconds: float = 24 * 3600.0,
+    ) -> None:
+        self.spill_dir = spill_dir
+        self.max_sessions_in_memory = max_sessions_in_memory
+        self.max_session_bytes = max_session_bytes
+        self.idle_seconds = idle_seconds
+        self.spill_ttl_seconds = spill_ttl_seconds
+        # session id -> session, least recently used first
+        self.sessions: OrderedDict = OrderedDict()
+        self.last_access: Dict[str, float] = {}
+        self.session_bytes: Dict[str, int] = {}
+        # session id -> number of turns in progress
+        self.pins: Dict[str, int] = {}
+        self.last_cleanup = time.time()
+        self.lock = threading.Lock()
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def spill_path(self, session_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{session_id}.pkl")
+
+    def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = new_session()
+            self.last_access[session_id] = time.time()
+            self.session_bytes[session_id] = 0
+        self.evict()
+        return session_id
+
+    def get(self, session_id: str) -> Dict:
+        """
+        Get a session, loading it back from disk if it was evicted.
+        An unknown (e.g. expired) session id starts an empty session.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.load(session_id)
+                self.sessions[session_id] = session
+                self.session_bytes[session_id] = estimate_session_bytes(session)
+            self.sessions.move_to_end(session_id)
+            self.last_access[session_id] = time.time()
+        self.evict()
+        return session
+
+    def reset(self, session_id: str) -> None:
+        with self.lock:
+            self.sessions[session_id] = new_session()
+            self.last_access[session_id] = time.time()
+            self.session_bytes[session_id] = 0
+        if os.path.exists(self.spill_path(session_id)):
+            os.remove(self.spill_path(session_id))
+
+    def pin(self, session_id: str) -> None:
+        """
+        Keep a session in memory until unpin(), e.g. while a turn runs.
+        """
+        with self.lock:
+            self.pins[session_id] = self.pins.get(session_id, 0) + 1
+
+    def unpin(self, session_id: str) -> None:
+        with self.lock:
+            self.pins[session_id] -= 1
+            if self.pins[session_id] == 0:
+                del self.pins[session_id]
+            # the turn has just used the session
+            if session_id in self.sessions:
+                self.sessions.move_to_end(session_id)
+                self.last_access[session_id] = time.time()
+
+    def load(self, session_id: str) -> Dict:
+        path = self.spill_path(session_id)
+        if not os.path.exists(path):
+            return new_session()
+        try:
+            with open(path, "rb") as f:
+                session = pickle.load(f)
+        except Exception as e:
+            print(f"读取会话失败: {e}")
+            session = new_session()
+        os.remove(path)
+        return session
+
+    def spill(self, session_id: str, session: Dict) -> None:
+        try:
+            with open(self.spill_path(session_id), "wb") as f:
+                pickle.dump(session, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print(f"保存会话失败: {e}")
+
+    def evict(self) -> None:
+        """
+        Move idle and least recently used sessions to disk.
+        """
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for session_id in list(self.sessions):
+                if session_id in self.pins:
+                    continue
+                if (
+                    len(self.sessions) > self.max_sessions_in_memory
+                    or now - self.last_access[session_id] > self.idle_seconds
+                ):
+                    evicted.append((session_id, self.sessions.pop(session_id)))
+                    self.session_bytes.pop(session_id, None)
+                    self.last_access.pop(session_id, None)
+                else:
+                    # the remaining sessions were accessed more recently
+                    break
+        for session_id, session in evicted:
+            self.spill(session_id, session)
+        if now - self.last_cleanup > 3600:
+            self.last_cleanup = now
+            self.cleanup()
+
+    def compact(self, session_id: str, session_window_size: int, tokenizer) -> None:
+        """
+        Replace messages outside the session window by token-count stubs and
+        cap the size of the session.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return
+            messages = session["messages"]
+            turn_start_inds = [
+                ind for ind, message in enumerate(messages) if message["role"] == "user"
+            ]
+            window_start_ind = (
+                turn_start_inds[-session_window_size]
+                if len(turn_start_inds) >= session_window_size
+                else 0
+            )
+            for ind in range(window_start_ind):
+                message = messages[ind]
+                if message.get("compacted") is True:
+                    continue
+                messages[ind] = {
+                    "role": message["role"],
+                    "content": "",
+                    "num_tokens": len(tokenizer.encode(message["content"])),
+                    "compacted": True,
+                }
+            num_bytes = self.cap_session(session, window_start_ind)
+            self.session_bytes[session_id] = num_bytes
+
+    def cap_session(self, session: Dict, window_start_ind: int) -> int:
+        num_bytes = estimate_session_bytes(session)
+        # drop compacted turns first
+        if num_bytes > self.max_session_bytes and window_start_ind > 0:
+            del session["messages"][:window_start_ind]
+            num_bytes = estimate_session_bytes(session)
+        passage_index: Optional[PassageIndex] = session["passage_index"]
+        while (
+            num_bytes > self.max_session_bytes
+            and passage_index is not None
+            and len(passage_index.pages) > 0
+        ):
+            passage_index.remove_page(next(iter(passage_index.pages)))
+            num_bytes = estimate_session_bytes(session)
+        return num_bytes
+
+    def stats(self) -> Dict:
+        """
+        Memory accounting of the sessions held in memory.
+        """
+        with self.lock:
+            session_bytes = dict(self.session_bytes)
+        num_spilled = len(
+            [name for name in os.listdir(self.spill_dir) if name.endswith(".pkl")]
+        )
+        return {
+            "num_sessions_in_memory": len(session_bytes),
+            "num_sessions_on_disk": num_spilled,
+            "total_bytes": sum(session_bytes.values()),
+            "max_session_bytes": max(session_bytes.values(), default=0),
+            "session_bytes": session_bytes,
+        }
+
+    def cleanup(self) -> None:
+        """
+        Delete sessions that stayed on disk longer than spill_ttl_seconds.
+        """
+        now = time.time()
+        for name in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, name)
+            if name.endswith(".pkl") and now - os.path.getmtime(path) > (
+                self.spill_ttl_seconds
+            ):
+                os.remove(path)
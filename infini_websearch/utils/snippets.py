@@ -0,0 +1,140 @@
+import re
+from typing import Dict, List, Tuple
+from urllib.parse import quote
+
+from infini_websearch.utils.retrieval import tokenize_for_retrieval
+
+# snippets alone never score more than this, they are cut off mid-sentence
+SNIPPET_MAX_SCORE = 0.8
+KNOWLEDGE_GRAPH_MAX_SCORE = 0.9
+# a knowledge graph without attributes only describes the entity, below the
+# default threshold
+KNOWLEDGE_GRAPH_DESCRIPTION_MAX_SCORE = 0.6
+# organic snippets considered when scoring
+NUM_SCORED_SNIPPETS = 3
+# snippets of a time sensitive query answer it only if this many of them carry
+# a number or date (a temperature, a price, a score)
+MIN_NUMERIC_SNIPPETS = 2
+NUMERIC_PATTERN = re.compile(r"\d")
+
+
+def get_answer_box_text(answer_box: Dict) -> str:
+    lines = [answer_box.get("title", "")]
+    for key in ["answer", "snippet"]:
+        if answer_box.get(key):
+            lines.append(answer_box[key])
+    lines.extend(answer_box.get("snippetHighlighted", []))
+    return "\n".join([line for line in lines if line])
+
+
+def get_knowledge_graph_text(knowledge_graph: Dict) -> str:
+    lines = [knowledge_graph.get(key, "") for key in ["title", "type", "description"]]
+    for name, value in knowledge_graph.get("attributes", {}).items():
+        lines.append(f"{name}: {value}")
+    return "\n".join([line for line in lines if line])
+
+
+def get_organic_text(url_info: Dict) -> str:
+    lines = [
+        url_info.get("title", ""),
+        url_info.get("date", ""),
+        url_info.get("snippet", ""),
+    ]
+    for name, value in url_info.get("attributes", {}).items():
+        lines.append(f"{name}: {value}")
+    return "\n".join([line for line in lines if line])
+
+
+def get_query_coverage(query: str, text: str) -> float:
+    query_terms = set(tokenize_for_retrieval(query))
+    if len(query_terms) == 0:
+        return 0.0
+    return len(query_terms & set(tokenize_for_retrieval(text))) / len(query_terms)
+
+
+def has_numeric_evidence(url_info: Dict) -> bool:
+    texts = [url_info.get("snippet", "")] + [
+        str(value) for value in url_info.get("attributes", {}).values()
+    ]
+    return any(NUMERIC_PATTERN.search(text) for text in texts)
+
+
+def score_snippet_answer(query: str, response: Dict, time_sensitive: bool) -> Dict:
+    """
+    Score whether the serper response carries an answer to the query, not only
+    matches its topic: an answer box is trusted as is, a knowledge graph is
+    scored by the fraction of query terms it covers (less without attributes).
+    Organic snippets nearly always cover the query terms, they only count for
+    time sensitive queries (weather, prices, scores) with numbers or dates in
+    them.
+    """
+    scores = {"answer_box": 0.0, "knowledge_graph": 0.0, "snippets": 0.0}
+    answer_box = response.get("answerBox")
+    if answer_box and (answer_box.get("answer") or answer_box.get("snippet")):
+        scores["answer_box"] = 1.0
+    knowledge_graph = response.get("knowledgeGraph")
+    if knowledge_graph:
+        max_score = (
+            KNOWLEDGE_GRAPH_MAX_SCORE
+            if knowledge_graph.get("attributes")
+            else KNOWLEDGE_GRAPH_DESCRIPTION_MAX_SCORE
+        )
+        scores["knowledge_graph"] = max_score * get_query_coverage(
+            query, get_knowledge_graph_text(knowledge_graph)
+        )
+    organic = response.get("organic", [])[:NUM_SCORED_SNIPPETS]
+    num_numeric = sum(1 for url_info in organic if has_numeric_evidence(url_info))
+    if (
+        time_sensitive
+        and len(organic) == NUM_SCORED_SNIPPETS
+        and num_numeric >= MIN_NUMERIC_SNIPPETS
+    ):
+        scores["snippets"] = SNIPPET_MAX_SCORE * get_query_coverage(
+            query, "\n".join([get_organic_text(url_info) for url_info in organic])
+        )
+    source = max(scores, key=scores.get)
+    return {
+        "score": round(scores[source], 3),
+        "source": source,
+        "scores": {name: round(score, 3) for name, score in scores.items()},
+    }
+
+
+def get_snippet_documents(
+    query: str, response: Dict, num_documents: int
+) -> List[Tuple[Dict, str]]:
+    """
+    Turn the answer box, the knowledge graph and the organic snippets of a
+    serper response into (url_info, text) documents, at most num_documents.
+    """
+    # structured answers without a source link cite the search itself
+    search_link = f"https://www.google.com/search?q={quote(query)}"
+    documents = []
+    answer_box = response.get("answerBox")
+    if answer_box:
+        url_info = {
+            "title": answer_box.get("title") or query,
+            "link": answer_box.get("link") or search_link,
+            "snippet": answer_box.get("answer") or answer_box.get("snippet", ""),
+        }
+        documents.append((url_info, get_answer_box_text(answer_box)))
+    knowledge_graph = response.get("knowledgeGraph")
+    if knowledge_graph:
+        url_info = {
+            "title": knowledge_graph.get("title") or query,
+            "link": knowledge_graph.get("descriptionLink")
+            or knowledge_graph.get("website")
+            or search_link,
+            "snippet": knowledge_graph.get("description", ""),
+        }
+        documents.append((url_info, get_knowledge_graph_text(knowledge_graph)))
+    for url_info in response.get("organic", []):
+        documents.append((url_info, get_organic_text(url_info)))
+
+    links, unique_documents = set(), []
+    for url_info, text in documents:
+        if url_info["link"] in links or not text:
+            continue
+        links.add(url_info["link"])
+        unique_documents.append((url_info, text))
+    return unique_documents[:num_documents]
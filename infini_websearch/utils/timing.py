@@ -0,0 +1,35 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator
+
+
+class StageTimer:
+    """
+    Wall time spent in each stage of a request (model, search, summarize, ...).
+
+    Stages are entered through stage(), subclasses may override it to bound the
+    concurrency of a stage across requests.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.time()
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Seconds per stage and in total since the timer was created.
+        """
+        timings = {name: round(seconds, 3) for name, seconds in self.timings.items()}
+        timings["total"] = round(time.time() - self.start, 3)
+        return timings
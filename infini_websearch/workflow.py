@@ -0,0 +1,585 @@
+import time
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from infini_websearch.actions import GoogleSearch, parse_function_calls_from_model_ouput
+from infini_websearch.actions.base_action import BaseAction
+from infini_websearch.configs import (
+    AGENT_MAX_OUTPUT_TOKENS,
+    AGENT_TEMPERATURE,
+    CHAT_MAX_OUTPUT_TOKENS,
+    CHAT_TEMPERATURE,
+    FUNCTION_CALLING_PROMPT_TEMPLATE,
+    FUNCTION_END_TOKEN,
+    FUNCTION_START_TOKEN,
+    MAX_ACTION_TURNS,
+    MAX_SEARCH_ATTEMPTS,
+    MODEL_NAME,
+    MODEL_SERVER_URL,
+    NUM_SEARCH_WEBPAGES,
+    OBSERVATION_DEADLINE,
+    OBSERVATION_MAX_TOKENS,
+    OBSERVATION_PROMPT_TEMPLATE,
+    PROXIES,
+    ROLE_PROMPT,
+    SEARCH_LOAD_POLL_INTERVAL,
+    SEARCH_SERVER_URLS,
+    SESSION_INDEX_MAX_CHARS,
+    SESSION_MAX_INPUT_TOKENS,
+    SESSION_WINDOW_SIZE,
+    SNIPPET_ANSWER_THRESHOLD,
+    STOP_TOKENS,
+    STREAM_BUFFER_SIZE,
+    STREAM_FLUSH_INTERVAL,
+    SUMMARY_PROMPT_TEMPLATE,
+    SUMMARY_QUORUM,
+    SUMMARY_RESERVE_SECONDS,
+    TIME_PROMPT_TEMPLATE,
+    WEBPAGE_EXTRACTIVE_MAX_TOKENS,
+    WEBPAGE_LOAD_TIMETOUT,
+    WEBPAGE_MAX_CHARS,
+    WEBPAGE_RAW_MAX_TOKENS,
+    WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
+    WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS,
+)
+from infini_websearch.model import (
+    get_vllm_model_output_function,
+    include_special_tokens,
+    split_text_by_special_token,
+)
+from infini_websearch.utils import (
+    CancellationToken,
+    PassageIndex,
+    StageTimer,
+    extract_citations,
+    functions2str,
+    get_datetime_now,
+)
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+# Add a space before the <a> tag to prevent rendering errors when multiple
+# <a></a> tags are adjacent to each other.
+HTML_CITATION_TEMPLATE = ' <a href="{link}" class="circle-link">{citation}</a>'
+MARKDOWN_CITATION_TEMPLATE = "[{citation}]({link})"
+
+# tool -> function name
+TOOLS_TO_ACTION_NAMES = {
+    "websearch": "googleWebSearch",
+}
+
+
+def get_actions_map() -> Dict[str, BaseAction]:
+    """
+    Function name -> action.
+    """
+    return {
+        "googleWebSearch": GoogleSearch(
+            server_url=SEARCH_SERVER_URLS,
+            num_search_webpages=NUM_SEARCH_WEBPAGES,
+            summary_prompt_template=SUMMARY_PROMPT_TEMPLATE,
+            observation_prompt_template=OBSERVATION_PROMPT_TEMPLATE,
+            webpage_summary_max_input_tokens=WEBPAGE_SUMMARY_MAX_INPUT_TOKENS,
+            webpage_load_timetout=WEBPAGE_LOAD_TIMETOUT,
+            proxies=PROXIES,
+            webpage_summary_max_output_tokens=WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS,
+            webpage_raw_max_tokens=WEBPAGE_RAW_MAX_TOKENS,
+            webpage_extractive_max_tokens=WEBPAGE_EXTRACTIVE_MAX_TOKENS,
+            observation_max_tokens=OBSERVATION_MAX_TOKENS,
+            observation_deadline=OBSERVATION_DEADLINE,
+            summary_reserve_seconds=SUMMARY_RESERVE_SECONDS,
+            summary_quorum=SUMMARY_QUORUM,
+            snippet_answer_threshold=SNIPPET_ANSWER_THRESHOLD,
+            max_search_attempts=MAX_SEARCH_ATTEMPTS,
+            webpage_max_chars=WEBPAGE_MAX_CHARS,
+            load_poll_interval=SEARCH_LOAD_POLL_INTERVAL,
+        ),
+    }
+
+
+def get_system_prompt(functions: Optional[List] = None) -> str:
+    """
+    Get system prompt for current conversation.
+    """
+    if functions is None:
+        functions = []
+    current_time, weekday = get_datetime_now()
+    time_info = TIME_PROMPT_TEMPLATE.format(current_time=current_time, weekday=weekday)
+    system_prompt = ROLE_PROMPT + "\n" + time_info
+    if len(functions) > 0:
+        system_prompt += "\n" + FUNCTION_CALLING_PROMPT_TEMPLATE.format(
+            functions=functions2str(functions)
+        )
+    return system_prompt
+
+
+def render_citations(text: str, url_infos: List[Dict], citation_template: str) -> str:
+    """
+    Replace [citation:x] by links to the search results.
+    """
+    citations = extract_citations(text)
+    if len(citations) == 0 or len(url_infos) == 0:
+        return text
+    for citation in citations:
+        url_ind = int(citation) - 1
+        # hardcoding for out-of-bounds
+        if url_ind < 0:
+            url_ind = 0
+        elif url_ind >= len(url_infos):
+            url_ind = len(url_infos) - 1
+        text = text.replace(
+            f"[citation:{citation}]",
+            citation_template.format(
+                citation=citation, link=url_infos[url_ind]["link"]
+            ),
+        )
+    return text
+
+
+def merge_function_calls(
+    function_calls: List[Tuple[Optional[str], Union[Dict, Optional[str]]]]
+) -> Tuple[Optional[str], Union[Dict, Optional[str]]]:
+    """
+    Merge the function calls of one turn into one action.
+    Queries of several googleWebSearch calls are searched together, other
+    functions support only one call per turn (the first valid one).
+    """
+    valid_calls = [
+        (function_name, function_arguments)
+        for function_name, function_arguments in function_calls
+        if function_name is not None
+    ]
+    if len(valid_calls) == 0:
+        # no function call, or the error message of the first one
+        return function_calls[0] if len(function_calls) > 0 else (None, None)
+    function_name, function_arguments = valid_calls[0]
+    if function_name != "googleWebSearch":
+        return function_name, function_arguments
+    queries = []
+    for name, arguments in valid_calls:
+        if name != "googleWebSearch" or not isinstance(arguments, dict):
+            continue
+        query = arguments.get("query")
+        queries.extend(query if isinstance(query, list) else [query])
+    return function_name, {**function_arguments, "query": queries}
+
+
+def truncate_messages(
+    messages: List[Dict],
+    tokenizer: "AutoTokenizer",
+    session_window_size: int,
+    max_input_tokens: int,
+    system_prompt: str,
+) -> List[Dict]:
+    """
+    truncate messages for model input by session_window_size and max_input_tokens
+    """
+    # get parts for each turn
+    turn_start_inds = []
+    for ind, message in enumerate(messages):
+        if message["role"] == "user":
+            turn_start_inds.append(ind)
+    # only latest turns are used as input
+    turn_start_inds_used = turn_start_inds[-session_window_size:]
+    messages_parts = []
+    for i in range(len(turn_start_inds_used)):
+        turn_start_ind = turn_start_inds_used[i]
+        turn_end_ind = (
+            len(messages)
+            if i + 1 >= len(turn_start_inds_used)
+            else turn_start_inds_used[i + 1]
+        )
+        messages_parts.append(messages[turn_start_ind:turn_end_ind])
+    # truncate by max_input_tokens
+    messages_truncated = []
+    for i, messages_part in enumerate(reversed(messages_parts)):
+        if (
+            i == 0
+            or len(
+                tokenizer.apply_chat_template(
+                    [{"role": "system", "content": system_prompt}]
+                    + messages_truncated
+                    + messages_part,
+                    tokenize=True,
+                )
+            )
+            < max_input_tokens
+        ):
+            messages_truncated = messages_part + messages_truncated
+        else:
+            break
+    return messages_truncated
+
+
+def get_passage_index(session: Dict) -> PassageIndex:
+    """
+    Get the passage index of fetched web pages for this session.
+    """
+    if session.get("passage_index") is None:
+        session["passage_index"] = PassageIndex(max_chars=SESSION_INDEX_MAX_CHARS)
+    return session["passage_index"]
+
+
+def get_observation_max_tokens(
+    messages: List[Dict],
+    tokenizer: "AutoTokenizer",
+    max_input_tokens: int,
+    system_prompt: str,
+) -> int:
+    """
+    Tokens left for the observation so that the current turn fits into
+    max_input_tokens without being truncated.
+    """
+    turn_start_ind = 0
+    for ind, message in enumerate(messages):
+        if message["role"] == "user":
+            turn_start_ind = ind
+    num_tokens = len(
+        tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_prompt}]
+            + messages[turn_start_ind:]
+            + [{"role": "observation", "content": ""}],
+            tokenize=True,
+            add_generation_prompt=True,
+        )
+    )
+    return max(0, max_input_tokens - num_tokens)
+
+
+class AgentWorkflow:
+    """
+    The search-augmented agent loop, shared by the gradio app and the API server.
+
+    run() works on a session (messages, url_infos, passage_index) and yields
+    events, the frontends decide how to render them:
+        1. [text]: chat message delta, citations rendered
+        2. [function_call]: function calling information delta
+        3. [function_call_end]: the complete function call
+        4. [tool_result]: a web page fetched by the search action
+        5. [tool_message]: a message (error) of the action
+        6. [observation]: the observation of the action, with the trace of
+            the search budget
+        7. [model_end]: end of a model response
+    """
+
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        actions_map: Optional[Dict[str, BaseAction]] = None,
+        model_latency_callback: Optional[Callable[[float], None]] = None,
+    ) -> None:
+        """
+        model_latency_callback: called with the time to first token of each
+            model response.
+        """
+        self.tokenizer = tokenizer
+        if actions_map is None:
+            actions_map = get_actions_map()
+        self.actions_map = actions_map
+        self.model_latency_callback = model_latency_callback
+
+    def warm_up(self) -> None:
+        """
+        Warm up the tokenizer and the connection to the model server, run in the
+        background so that traffic is accepted meanwhile.
+        """
+        start = time.time()
+        try:
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": "你好"}],
+                tokenize=True,
+                add_generation_prompt=True,
+            )
+            get_vllm_model_output_function(
+                url=MODEL_SERVER_URL,
+                model_name=MODEL_NAME,
+                chat_mode=False,
+                stream=False,
+                model_config={"max_tokens": 1},
+            )(messages=["你好"])
+        except Exception as e:
+            print(f"预热失败: {e}")
+        print(f"预热耗时: {time.time() - start}s")
+
+    def run(
+        self,
+        session: Dict,
+        websearch: bool,
+        cancel_token: Optional[CancellationToken] = None,
+        stage_timer: Optional[StageTimer] = None,
+        citation_template: str = HTML_CITATION_TEMPLATE,
+        progress: Optional[Callable[[Iterable], Iterable]] = None,
+    ) -> Generator[Dict, None, None]:
+        """
+        cancel_token: ends the run and aborts its model and search requests,
+            e.g. when the user presses stop or disconnects.
+        stage_timer: times the truncate, model, tool, search and summarize stages.
+        progress: wraps the action output, e.g. a progress bar.
+        """
+        if stage_timer is None:
+            stage_timer = StageTimer()
+        # get registered tools
+        registered_tools = []
+        if websearch is True:
+            registered_tools.append("websearch")
+            temperature = AGENT_TEMPERATURE
+            max_gen_length = AGENT_MAX_OUTPUT_TOKENS
+        else:
+            temperature = CHAT_TEMPERATURE
+            max_gen_length = CHAT_MAX_OUTPUT_TOKENS
+        registered_function_names = [
+            TOOLS_TO_ACTION_NAMES[tool] for tool in registered_tools
+        ]
+        registered_functions = [
+            self.actions_map[function_name]
+            for function_name in registered_function_names
+        ]
+        functions = [
+            function.function_defination
+            for function in registered_functions
+            if function.function_defination is not None
+        ]
+
+        # get system prompt
+        system_prompt = get_system_prompt(functions=functions)
+        # get model streaming output function
+        llm_streaming_output_func = get_vllm_model_output_function(
+            url=MODEL_SERVER_URL,
+            model_name=MODEL_NAME,
+            chat_mode=True,
+            stream=True,
+            model_config={
+                "temperature": temperature,
+                "max_tokens": max_gen_length,
+                "stop": STOP_TOKENS,
+            },
+            buffer_size=STREAM_BUFFER_SIZE,
+            flush_interval=STREAM_FLUSH_INTERVAL,
+        )
+
+        for _ in range(MAX_ACTION_TURNS * 2):
+            if cancel_token is not None and cancel_token.cancelled:
+                break
+            # ASSISTANT answers two times per action turn
+            # answer1: <|function_start|>xxx<|function_end|>
+            # answer2: observation -> final answer
+
+            """
+            retain SESSION_WINDOW_SIZE turns (max_sequence_length is short -> 4096)
+            """
+            with stage_timer.stage("truncate"):
+                messages_truncated = truncate_messages(
+                    messages=session["messages"],
+                    tokenizer=self.tokenizer,
+                    session_window_size=SESSION_WINDOW_SIZE,
+                    max_input_tokens=SESSION_MAX_INPUT_TOKENS,
+                    system_prompt=system_prompt,
+                )
+
+            messages_input = [
+                {"role": "system", "content": system_prompt}
+            ] + messages_truncated
+            # print input prompt
+            print(
+                self.tokenizer.apply_chat_template(
+                    messages_input, tokenize=False, add_generation_prompt=True
+                )
+            )
+
+            response_raw = ""
+            function_text = ""
+            """
+            streaming output status:
+                1. [chat]: generating chat message
+                2. [function start]: start generating function calling information ([chat] -> [function])
+                3. [function]: generating function calling information
+                4. [function end]: end generating function calling information ([function] -> [chat])
+            """
+            # in [function] status?
+            function_status = False
+            # a function call has been generated, only further calls are accepted
+            function_called = False
+            chunk_buffer = ""
+            with stage_timer.stage("model"):
+                request_start = time.time()
+                first_chunk = True
+                for chunk in llm_streaming_output_func(
+                    messages=messages_input, cancel_token=cancel_token
+                ):
+                    if first_chunk is True:
+                        latency = time.time() - request_start
+                        stage_timer.record("model_first_token", latency)
+                        if self.model_latency_callback is not None:
+                            self.model_latency_callback(latency)
+                        first_chunk = False
+                    chunk_buffer += chunk
+                    # '<|function_start|>' and '<|function_end|>' appear to be truncated ?
+                    if chunk_buffer.rfind("|>") < chunk_buffer.rfind("<|"):
+                        continue
+                    # [function start] status: ([chat] -> [function])
+                    if function_status is False and include_special_tokens(
+                        chunk_buffer, [FUNCTION_START_TOKEN]
+                    ):
+                        function_status = True
+                        chat_part, tool_part = split_text_by_special_token(
+                            chunk_buffer, FUNCTION_START_TOKEN
+                        )
+                        tool_part = FUNCTION_START_TOKEN + tool_part
+                        if not function_called and len(chat_part) > 0:
+                            yield {
+                                "type": "text",
+                                "content": render_citations(
+                                    chat_part, session["url_infos"], citation_template
+                                ),
+                            }
+                        function_text = tool_part
+                        response_raw += chat_part + tool_part
+                        chunk_buffer = ""
+                        yield {"type": "function_call", "content": tool_part}
+                    # [function end] status: ([function] -> [chat])
+                    elif function_status is True and include_special_tokens(
+                        chunk_buffer, [FUNCTION_END_TOKEN]
+                    ):
+                        chat_part, _ = split_text_by_special_token(
+                            chunk_buffer, FUNCTION_END_TOKEN
+                        )
+                        function_text += chat_part + FUNCTION_END_TOKEN
+                        response_raw += chat_part + FUNCTION_END_TOKEN
+                        chunk_buffer = ""
+                        yield {"type": "function_call_end", "content": function_text}
+                        # keep reading, several function calls may be generated per turn
+                        function_status = False
+                        function_called = True
+                        function_text = ""
+                    # [function] status
+                    elif function_status is True:
+                        function_text += chunk_buffer
+                        response_raw += chunk_buffer
+                        yield {"type": "function_call", "content": chunk_buffer}
+                        chunk_buffer = ""
+                    # chat message after function calls: wait for the next function call
+                    elif function_called is True:
+                        stripped_buffer = chunk_buffer.strip()
+                        if stripped_buffer and not FUNCTION_START_TOKEN.startswith(
+                            stripped_buffer[: len(FUNCTION_START_TOKEN)]
+                        ):
+                            break
+                    # [chat] status
+                    elif function_status is False:
+                        yield {
+                            "type": "text",
+                            "content": render_citations(
+                                chunk_buffer, session["url_infos"], citation_template
+                            ),
+                        }
+                        response_raw += chunk_buffer
+                        chunk_buffer = ""
+                    if cancel_token is not None and cancel_token.cancelled:
+                        break
+
+            session["messages"].append({"role": "assistant", "content": response_raw})
+            yield {"type": "model_end", "function_called": function_called}
+
+            # no tool registered or cancelled, end this turn
+            if len(registered_tools) == 0 or (
+                cancel_token is not None and cancel_token.cancelled
+            ):
+                break
+
+            function_calls = parse_function_calls_from_model_ouput(
+                response_raw,
+                registered_function_names,
+                speical_tokens_map=dict(
+                    function_start_token=FUNCTION_START_TOKEN,
+                    function_end_token=FUNCTION_END_TOKEN,
+                ),
+            )
+            function_name, function_arguments = merge_function_calls(function_calls)
+
+            # no tool use this turn, end this turn
+            if function_arguments is None:
+                break
+
+            # something is wrong, use function_arguments as observation (error
+            # message)
+            if function_name is None and isinstance(function_arguments, str):
+                session["messages"].append(
+                    {"role": "observation", "content": function_arguments}
+                )
+                yield {
+                    "type": "observation",
+                    "content": function_arguments,
+                    "url_infos": [],
+                }
+                continue
+
+            url_infos = []
+            action = self.actions_map[function_name]
+            observation, trace = None, None
+            with stage_timer.stage("tool"):
+                if function_name == "googleWebSearch":
+                    observation_genrator = action.run(
+                        user_question=session["messages"][-2]["content"],
+                        arguments=function_arguments,
+                        llm_completion_funcion=get_vllm_model_output_function(
+                            url=MODEL_SERVER_URL,
+                            model_name=MODEL_NAME,
+                            chat_mode=False,
+                            stream=False,
+                            model_config={
+                                "temperature": temperature,
+                                "max_tokens": WEBPAGE_SUMMARY_MAX_OUTPUT_TOKENS,
+                                "stop": STOP_TOKENS,
+                            },
+                        ),
+                        tokenizer=self.tokenizer,
+                        return_webpage_details=True,
+                        passage_index=get_passage_index(session),
+                        observation_max_tokens=get_observation_max_tokens(
+                            messages=session["messages"],
+                            tokenizer=self.tokenizer,
+                            max_input_tokens=SESSION_MAX_INPUT_TOKENS,
+                            system_prompt=system_prompt,
+                        ),
+                        stage_timer=stage_timer,
+                        cancel_token=cancel_token,
+                    )
+                    if progress is not None:
+                        observation_genrator = progress(observation_genrator)
+                    for item in observation_genrator:
+                        if isinstance(item, dict):
+                            if "observation" in item:
+                                observation = item["observation"]
+                                trace = item.get("trace")
+                                break
+                            url_infos.append(item["url_info"])
+                            yield {"type": "tool_result", **item}
+                        # error message
+                        elif isinstance(item, str):
+                            yield {"type": "tool_message", "content": item}
+                        else:
+                            raise NotImplementedError
+
+                    # update url_infos
+                    session["url_infos"] = url_infos
+                else:
+                    observation = action.run(function_arguments)
+
+            assert observation is not None
+            session["messages"].append({"role": "observation", "content": observation})
+            yield {
+                "type": "observation",
+                "content": observation,
+                "url_infos": url_infos,
+                "trace": trace,
+            }